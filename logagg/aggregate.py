@@ -0,0 +1,368 @@
+import re
+import math
+import calendar
+import datetime
+import collections
+
+from logagg.routing import parse_spec
+
+# A metric log taken in by an aggregation: the index of the aggregation,
+# the group the log falls in, its numeric fields, the number of logs it
+# stands for and its time in seconds since the epoch, None when unknown
+Aggregated = collections.namedtuple("Aggregated", "index key values weight timestamp")
+
+ISO_TIMESTAMP = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(\.\d+)?"
+    r"(?:Z|([+-])(\d{2}):?(\d{2}))?$"
+)
+
+
+def parse_timestamp(timestamp):
+    """Seconds since the epoch of an ISO 8601 timestamp, taken as UTC when
+    it has no offset, None when it is not one
+
+    >>> parse_timestamp('1970-01-01T00:01:40.5'), parse_timestamp('1970-01-01T01:01:40+01:00')
+    (100.5, 100)
+    >>> parse_timestamp('17/Aug/2017') is None
+    True
+    """
+    m = ISO_TIMESTAMP.match(timestamp) if isinstance(timestamp, basestring) else None
+    if m is None:
+        return None
+
+    year, month, day, hour, minute, second, fraction, sign, oh, om = m.groups()
+    try:
+        t = calendar.timegm(
+            (int(year), int(month), int(day), int(hour), int(minute), int(second))
+        )
+    except ValueError:
+        return None
+    if fraction:
+        t += float(fraction)
+    if sign:
+        offset = 3600 * int(oh) + 60 * int(om)
+        t += -offset if sign == "+" else offset
+    return t
+
+
+class Aggregation(object):
+    """Metric logs matching some Conditions summed up over intervals of
+    `interval` seconds, per event and values of the `tags` found in their
+    data or the log. The count of logs is kept, and under "fields" the
+    sum, min and max of each numeric field of data, `timings` getting a
+    histogram and quantiles too.
+
+    >>> a = parse_aggregation('formatter=logagg.formatters.nginx_access:interval=10:tags=status')
+    >>> from logagg.record import LogRecord
+    >>> log = LogRecord('/var/log/nginx.log', 'a line', 'logagg.formatters.nginx_access', 'host')
+    >>> log.update({'type': 'metric', 'event': 'nginx_event',
+    ...             'data': {'status': '200', 'request_time': 0.5, 'method': 'GET'}})
+    >>> a.matches(log), a.measure(log)
+    (True, (('nginx_event', 'logagg.formatters.nginx_access', ('200',)), {'request_time': 0.5}, 1.0))
+    """
+
+    INTERVAL = 10  # Seconds metric logs are summed up over
+    SUMMARY_KEYS = ("count", "interval", "fields")  # Keys of summaries, not tags
+    TAGS = ("host", "status", "backend")  # Fields logs are grouped by
+    TIMINGS = (
+        "request_time",
+        "upstream_response_time",
+        "resp_time",
+        "Tq",
+        "Tw",
+        "Tc",
+        "Tr",
+        "Tt",
+    )  # Fields given a histogram
+
+    def __init__(self, conditions, interval=INTERVAL, tags=TAGS, timings=TIMINGS):
+        clashing = set(tags) & set(self.SUMMARY_KEYS)
+        if clashing:
+            raise ValueError("tags %s clash with summary keys" % sorted(clashing))
+        self.conditions = conditions
+        self.interval = interval
+        self.tags = tuple(tags)
+        self.timings = frozenset(timings)
+
+    def matches(self, log):
+        return log.type == "metric" and not log.error and self.conditions.matches(log)
+
+    def measure(self, log):
+        """The group of a log, its numeric fields and the number of logs
+        it stands for"""
+        data = log.data
+        tags = tuple(data[t] if t in data else getattr(log, t, None) for t in self.tags)
+        key = log.event, log.formatter, tags
+
+        values = {}
+        for k, v in data.iteritems():
+            if isinstance(v, (int, long, float)) and not isinstance(v, bool):
+                values[k] = float(v)
+        # Runs of repeats were sent as one log
+        weight = values.pop("repeat_count", 1.0) / values.pop("sample_rate", 1.0)
+        for t in self.tags:
+            values.pop(t, None)
+        return key, values, weight
+
+
+def parse_aggregation(spec):
+    """Reads an aggregation given as <field>=<value>[,<value>...]:...
+    [:interval=<seconds>][:tags=<field>,...][:timings=<field>,...]
+
+    >>> parse_aggregation('interval=10:tags=host,count')
+    Traceback (most recent call last):
+    ...
+    ValueError: bad aggregation 'interval=10:tags=host,count': ValueError("tags ['count'] clash with summary keys",)
+    """
+    conditions, options = parse_spec(spec)
+    kwargs = {}
+    try:
+        if "interval" in options:
+            kwargs["interval"] = float(options.pop("interval"))
+        for name in ("tags", "timings"):
+            if name in options:
+                value = options.pop(name)
+                kwargs[name] = value.split(",") if value is not True else ()
+    except ValueError as e:
+        raise ValueError("bad aggregation %r: %r" % (spec, e))
+
+    if options:
+        raise ValueError(
+            "unknown options %s in aggregation %r" % (sorted(options), spec)
+        )
+    try:
+        return Aggregation(conditions, **kwargs)
+    except ValueError as e:
+        raise ValueError("bad aggregation %r: %r" % (spec, e))
+
+
+class Aggregations(object):
+    """Aggregations a metric log is matched against, the first it matches
+    taking it in"""
+
+    def __init__(self, aggregations=()):
+        self.aggregations = list(aggregations)
+
+    def __getitem__(self, index):
+        return self.aggregations[index]
+
+    def take(self, log):
+        """An Aggregated for a formatted log that is to be summed up rather
+        than sent, None for one that is to be sent"""
+        for index, a in enumerate(self.aggregations):
+            if a.matches(log):
+                key, values, weight = a.measure(log)
+                timestamp = parse_timestamp(log.timestamp)
+                return Aggregated(index, key, values, weight, timestamp)
+        return None
+
+
+HIST_BASE = 2 ** 0.25  # Ratio of the bounds of successive histogram buckets
+_LOG_HIST_BASE = math.log(HIST_BASE)
+QUANTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))
+
+
+def bucket(value):
+    """The histogram bucket of a value, bucket i holding values in
+    (HIST_BASE ** (i - 1), HIST_BASE ** i] and "zero" those <= 0.
+    Histograms of the same field merge by adding the counts of buckets.
+
+    >>> [bucket(v) for v in (0, 1, 1.1, 1.15, 8)]
+    ['zero', 0, 1, 1, 12]
+    """
+    if value > 0:
+        return int(math.ceil(math.log(value) / _LOG_HIST_BASE - 1e-9))
+    return "zero"
+
+
+def quantiles(hist):
+    """Upper bounds of the buckets the QUANTILES fall in
+
+    >>> sorted(quantiles({'zero': 1, '0': 97, '8': 2}).items())
+    [('p50', 1.0), ('p90', 1.0), ('p99', 4.0)]
+    """
+    buckets = sorted(
+        (float("-inf") if k == "zero" else int(k), c) for k, c in hist.iteritems()
+    )
+    total = float(sum(c for _, c in buckets))
+
+    result, seen, qs = {}, 0, list(QUANTILES)
+    for index, count in buckets:
+        seen += count
+        while qs and seen >= qs[0][1] * total:
+            bound = 0.0 if index == float("-inf") else HIST_BASE ** index
+            result[qs.pop(0)[0]] = round(bound, 6)
+    return result
+
+
+def add_partial(partials, x):
+    """Adds x to the partial sums of a running sum kept exact, as math.fsum
+    does, the sum being math.fsum(partials)"""
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+
+
+class _Stats(object):
+    __slots__ = ("partials", "min", "max", "hist")
+
+    def __init__(self, timing):
+        self.partials = []
+        self.min = float("inf")
+        self.max = float("-inf")
+        # Bucket -> weight of the values in it, for timings
+        self.hist = collections.defaultdict(float) if timing else None
+
+    def add(self, value, weight):
+        add_partial(self.partials, value * weight if weight != 1.0 else value)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if self.hist is not None:
+            self.hist[bucket(value)] += weight
+
+    def summary(self):
+        stats = dict(sum=math.fsum(self.partials), min=self.min, max=self.max)
+        if self.hist is not None:
+            stats["hist"] = dict(
+                (str(k), int(c) if c == int(c) else c) for k, c in self.hist.iteritems()
+            )
+            stats.update(quantiles(stats["hist"]))
+        return stats
+
+
+class _Group(object):
+    """Running count, sum, min, max and histogram of the fields of the logs
+    of a group, so that an interval holds no more than a few numbers per
+    field however many logs it takes in
+
+    >>> g = _Group(frozenset(['t']))
+    >>> for v, w in [(0.1, 1.0), (0.3, 1.0), (0.2, 2.0)]:
+    ...     g.add({'t': v, 'count': v}, w)
+    >>> s = g.summary()
+    >>> s['count'], s['fields']['t']['sum'], sorted(s['fields']['t']['hist'].items())
+    (4.0, 0.8, [('-13', 1), ('-6', 1), ('-9', 2)])
+    >>> s['fields']['count']['max']
+    0.3
+    """
+
+    __slots__ = ("timings", "count", "nlogs", "stats")
+
+    def __init__(self, timings):
+        self.timings = timings
+        # Logs the group stands for and logs taken in
+        self.count = 0.0
+        self.nlogs = 0
+        # field -> _Stats of the logs having it
+        self.stats = {}
+
+    def add(self, values, weight):
+        self.count += weight
+        self.nlogs += 1
+        for k, v in values.iteritems():
+            stats = self.stats.get(k)
+            if stats is None:
+                stats = self.stats[k] = _Stats(k in self.timings)
+            stats.add(v, weight)
+
+    def summary(self):
+        """The count of logs and the sum, min and max of each field under
+        "fields", where fields named like the keys of summaries go too"""
+        count = self.count if self.count != self.nlogs else self.nlogs
+        fields = dict((k, s.summary()) for k, s in self.stats.iteritems())
+        return dict(count=count, fields=fields)
+
+
+class IntervalBuffer(object):
+    """The metric logs of one file taken in by aggregations, grouped for
+    the interval their timestamp falls in, or the current one for logs
+    without one. The summaries of an interval go out in the batch opened
+    with the first log taken in, so that the file is not checkpointed
+    past logs that were summed up and not sent yet. They are due once the
+    interval is over, or once it was open as long for intervals ahead of
+    the clock.
+
+    >>> from logagg.batchqueue import AckTracker
+    >>> acks = AckTracker('freader')
+    >>> aggs = Aggregations([parse_aggregation('interval=10:tags=status:timings=t')])
+    >>> buf = IntervalBuffer(aggs, acks)
+    >>> for i, t in enumerate([0.1, 0.3, 0.2]):
+    ...     buf.add(Aggregated(0, ('e', 'f', ('200',)), {'t': t}, 1.0, None), 1, None, (7, i), now=101)
+    >>> buf.due(105), buf.due(110)
+    (False, True)
+    >>> [(b.lane, ts, s['count'], s['fields']['t']['sum'], s['fields']['t']['max'], s['status'])
+    ...  for b, e, f, ts, s in buf.flush(110)]
+    [(1, '1970-01-01T00:01:40', 3, 0.6, 0.3, '200')]
+    >>> acks.position
+    (7, 2)
+
+    Logs read late, such as when a file is caught up on, go to the
+    interval of their timestamp
+
+    >>> for i, ts in enumerate([52, 58, 61]):
+    ...     buf.add(Aggregated(0, ('e', 'f', ('200',)), {'t': 1}, 1.0, ts), 1, None, (7, i), now=111)
+    >>> [(ts, s['count']) for b, e, f, ts, s in sorted(buf.flush(111), key=lambda d: d[3])]
+    [('1970-01-01T00:00:50', 2), ('1970-01-01T00:01:00', 1)]
+    """
+
+    def __init__(self, aggregations, acks):
+        self.aggregations = aggregations
+        self.acks = acks
+        # (aggregation index, lane, topic, start of the interval) ->
+        # (batch, time the interval is due from, group key -> _Group)
+        self.open = {}
+
+    def add(self, aggregated, lane, topic, position, now):
+        index = aggregated.index
+        interval = self.aggregations[index].interval
+        t = aggregated.timestamp if aggregated.timestamp is not None else now
+        start = math.floor(t / interval) * interval
+
+        slot = index, lane, topic, start
+        entry = self.open.get(slot)
+        if entry is None:
+            batch = self.acks.new_batch(lane, topic)
+            entry = self.open[slot] = (batch, min(start, now), {})
+
+        groups = entry[2]
+        group = groups.get(aggregated.key)
+        if group is None:
+            group = groups[aggregated.key] = _Group(self.aggregations[index].timings)
+        group.add(aggregated.values, aggregated.weight)
+        # The log counts as handed out, its batch being sent with the summaries
+        self.acks.skip(position)
+
+    def due(self, now):
+        return any(
+            now >= since + self.aggregations[slot[0]].interval
+            for slot, (_, since, _) in self.open.iteritems()
+        )
+
+    def flush(self, now=None):
+        """Returns (batch, event, formatter, timestamp, summary data) for
+        each group of the intervals over, of all of them when `now` is
+        None. The summaries are to be appended to their batch."""
+        done = []
+        for slot, (batch, since, groups) in self.open.items():
+            index, _, _, start = slot
+            a = self.aggregations[index]
+            if now is not None and now < since + a.interval:
+                continue
+            del self.open[slot]
+
+            timestamp = datetime.datetime.utcfromtimestamp(start).isoformat()
+            for (event, formatter, tags), group in groups.iteritems():
+                data = group.summary()
+                data.update(zip(a.tags, tags))
+                data["interval"] = a.interval
+                done.append((batch, event, formatter, timestamp, data))
+        return done
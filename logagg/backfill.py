@@ -0,0 +1,166 @@
+import io
+import os
+import itertools
+import ujson as json
+
+from logagg import util
+from logagg.repeats import RepeatCollapser
+
+# LogCollector used by backfill and parse worker processes to format records
+_collector = None
+
+
+class FileRotatedError(Exception):
+    """The file being backfilled was rotated away from its path, the rest
+    of it is to be read by the collector from where it got to"""
+
+
+def init_worker(collector):
+    """Pool initializer, the collector reaches the forked worker as is"""
+    global _collector
+    _collector = collector
+
+
+def format_records(args):
+    """Formats a batch of (record, position) pairs read from a file, runs
+    in a worker. Returns the (serialized log, lane, topic) of the logs
+    with their positions, logs not matching LOG_STRUCTURE being left out,
+    along with the logs rate limits dropped, see `Limits.take_drops`.
+
+    >>> from logagg.collector import LogCollector
+    >>> init_worker(LogCollector([], 30))
+    >>> records = [('2017-08-17T07:56:33.489+0200 I REPL     [x] up', (7, 47)),
+    ...            ('2017-08-17T07:56:33.515+0200 W NETWORK  [y] down', (7, 97))]
+    >>> logs, drops = format_records(
+    ...     ('/var/log/mongodb.log', 'logagg.formatters.mongodb', records))
+    >>> [(json.loads(l)['data']['component'], lane, p) for (l, lane, _), p in logs]
+    [(u'REPL', 1, (7, 47)), (u'NETWORK', 1, (7, 97))]
+    """
+    fpath, formatter, records = args
+    fmtfn = _collector.get_formatter_fn(formatter)
+
+    logs = []
+    for record, position in records:
+        log = _collector.format_record(fpath, record, formatter, fmtfn)
+        if log is not None:
+            logs.append((log, position))
+
+    return logs, _collector.limits.take_drops()
+
+
+def find_record_start(f, offset, ispartial, limit):
+    """Returns the offset of the first record that starts after `offset`
+    in the open file `f`, or `limit` when there is none before it.
+
+    >>> import tempfile
+    >>> f = tempfile.TemporaryFile()
+    >>> f.write('a\\n b\\n c\\nd\\ne\\n')
+    >>> find_record_start(f, 1, util.ispartial, 12)
+    8
+    >>> find_record_start(f, 9, util.ispartial, 12)
+    10
+    >>> find_record_start(f, 11, util.ispartial, 12)
+    12
+    """
+    f.seek(offset)
+    # offset may be anywhere inside a line, skip to the start of the next one
+    pos = offset + len(f.readline())
+
+    while pos < limit:
+        line = f.readline()
+        if not line.endswith("\n"):
+            break
+        if not ispartial(line[:-1]):
+            return pos
+        pos += len(line)
+
+    return limit
+
+
+def split_ranges(fpath, start, end, ispartial, range_size):
+    """Cuts the bytes from `start` to `end` of a file into ranges of about
+    `range_size` bytes that begin at record starts, so that no multi-line
+    record is split between two ranges. Bytes after the last cut are not
+    part of any range.
+
+    >>> import tempfile
+    >>> f = tempfile.NamedTemporaryFile()
+    >>> f.write('a\\n b\\nc\\n d\\n e\\nf\\ng\\n'); f.flush()
+    >>> split_ranges(f.name, 0, 17, util.ispartial, 2)
+    [(0, 5), (5, 13)]
+    """
+    cuts = [start]
+    with io.open(fpath, "rb") as f:
+        pos = start + range_size
+        while pos < end:
+            cut = find_record_start(f, pos, ispartial, end)
+            if cut >= end:
+                break
+            cuts.append(cut)
+            pos = cut + range_size
+
+    return zip(cuts, cuts[1:])
+
+
+def parse_range(args):
+    """Formats the records in a byte range of a file, runs in a backfill
+    worker. Runs of repeats are collapsed and records sampled as those
+    read by the collector are.
+    Returns the (serialized log, lane, topic) of the logs with the (inode,
+    offset) at which each of them ends, the position of the end of the
+    range and the logs rate limits dropped.
+
+    >>> import tempfile
+    >>> from logagg.collector import LogCollector
+    >>> from logagg.sampling import parse_limit
+    >>> init_worker(LogCollector([], 30))
+
+    >>> f = tempfile.NamedTemporaryFile()
+    >>> f.write('{"level": "info", "timestamp": "2018-02-07T06:37:00.297610Z", "event": "started", "type": "log", "id": "1"}\\n'
+    ...         'not json\\n'); f.flush()
+    >>> inode, size = os.stat(f.name).st_ino, os.stat(f.name).st_size
+    >>> logs, position, drops = parse_range(
+    ...     (f.name, inode, 0, size, 'logagg.formatters.basescript'))
+    >>> [(json.loads(l)['event'], lane, p[1]) for (l, lane, _), p in logs]
+    [(u'started', 1, 108), (u'event', 0, 117)]
+    >>> position == (inode, size), drops
+    (True, [])
+
+    >>> init_worker(LogCollector([], 30, limits=[
+    ...     parse_limit('rate-limit', 'file=%s:rate=1:burst=1' % f.name)]))
+    >>> logs, position, drops = parse_range(
+    ...     (f.name, inode, 0, size, 'logagg.formatters.basescript'))
+    >>> len(logs), drops == [(0, f.name, 1)]
+    (1, True)
+
+    >>> f.write('not json\\n' * 3); f.flush()
+    >>> init_worker(LogCollector([], 30, dedup_window=5))
+    >>> logs, position, drops = parse_range(
+    ...     (f.name, inode, 108, size + 27, 'logagg.formatters.basescript'))
+    >>> [(json.loads(l)['data'].get('repeat_count'), p[1]) for (l, _, _), p in logs]
+    [(4, 144)]
+
+    >>> parse_range((f.name, inode + 1, 0, size, 'logagg.formatters.basescript')) # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    FileRotatedError: the file was rotated
+    """
+    fpath, inode, start, end, formatter = args
+    fmtfn = _collector.get_formatter_fn(formatter)
+
+    with io.open(fpath, "rb") as f:
+        if os.fstat(f.fileno()).st_ino != inode:
+            raise FileRotatedError(fpath, inode)
+        f.seek(start)
+        data = f.read(end - start)
+
+    assembler = _collector.new_assembler(fmtfn)
+    records = itertools.chain(
+        assembler.feed(data[:-1], inode, start), assembler.flush()
+    )
+    if _collector.dedup_window:
+        records = RepeatCollapser(_collector.dedup_window).collapse(records, hold=False)
+    records = _collector.limits.sample(fpath, formatter, records)
+    logs, drops = format_records((fpath, formatter, records))
+
+    return logs, (inode, end), drops
@@ -0,0 +1,460 @@
+import time
+import threading
+import itertools
+import collections
+
+from logagg import util
+
+
+class LogBatch(object):
+    """Serialized logs of one lane and topic read from one file, handed
+    over from a reader thread to the sender as a whole. Batches are made by the
+    AckTracker of the file, `acks`.
+
+    >>> b = LogBatch('acks')
+    >>> b.append('{"a": 1}', (7, 10))
+    >>> b.append('{"b": 2}', (7, 20))
+    >>> b.logs, b.position, b.nbytes
+    (['{"a": 1}', '{"b": 2}'], (7, 20), 18)
+    """
+
+    __slots__ = (
+        "acks",
+        "lane",
+        "topic",
+        "logs",
+        "definitions",
+        "position",
+        "nbytes",
+        "queued_at",
+        "start",
+        "seq",
+        "acked",
+    )
+
+    def __init__(self, acks, lane=0, topic=None):
+        self.acks = acks
+        # Index of the lane of the queue the batch goes to
+        self.lane = lane
+        # nsq topic the logs go to, None for the topic of the sender
+        self.topic = topic
+        self.logs = []
+        # template id -> serialized log defining the template, for the
+        # templates of the logs, sent ahead of them in the same nsq message
+        self.definitions = {}
+        # (inode, offset) at which the last log of the batch ends
+        self.position = None
+        # Bytes of the logs, counting the newline each is sent with
+        self.nbytes = 0
+        # Time the batch was put in the queue
+        self.queued_at = None
+        # Position of the log of the file before the first of the batch,
+        # number of the last log of the batch among those of the file and
+        # whether the batch was sent, kept by the AckTracker
+        self.start = None
+        self.seq = 0
+        self.acked = False
+
+    def append(self, log, position):
+        self.logs.append(log)
+        self.position = position
+        self.nbytes += len(log) + 1
+
+    def add_definition(self, template_id, log):
+        self.definitions[template_id] = log
+        self.nbytes += len(log) + 1
+
+
+class AckTracker(object):
+    """Works out the position up to which a file can be checkpointed while
+    its logs are sent in batches of several lanes, not in file order.
+
+    Batches are opened in the order of their first logs, so the logs
+    before the first one of the oldest batch not sent yet were all sent.
+
+    >>> acks = AckTracker('freader')
+    >>> b = acks.new_batch(1); acks.append(b, 'a', (7, 10))
+    >>> acks.ack([b])
+    (7, 10)
+
+    >>> info = acks.new_batch(1); acks.append(info, 'b', (7, 20))
+    >>> error = acks.new_batch(0); acks.append(error, 'c', (7, 30))
+    >>> acks.append(info, 'd', (7, 40))
+    >>> acks.ack([error])
+    (7, 10)
+    >>> acks.ack([info])
+    (7, 40)
+    """
+
+    def __init__(self, freader):
+        self.freader = freader
+        # Logs of the file handed out so far and where the last one ends
+        self.nlogs = 0
+        self.position = None
+
+        # Batches opened and not yet sent along with those before them
+        self._open = collections.deque()
+        # (seq, position) of the last log of the batches sent
+        self._sent = (0, None)
+        self._lock = threading.Lock()
+
+    def new_batch(self, lane=0, topic=None):
+        batch = LogBatch(self, lane, topic)
+        batch.start = self.position
+        with self._lock:
+            self._open.append(batch)
+        return batch
+
+    def append(self, batch, log, position):
+        self.nlogs += 1
+        batch.append(log, position)
+        batch.seq = self.nlogs
+        self.position = position
+
+    def skip(self, position):
+        """Counts the logs up to `position` as handed out without being
+        appended to a batch, as when they are summed up in a batch opened
+        before them"""
+        self.position = position
+
+    def ack(self, batches):
+        """Marks batches of the file as sent. Returns the position up to
+        which all the logs of the file were sent, None when unknown."""
+        with self._lock:
+            for batch in batches:
+                batch.acked = True
+
+            while self._open and self._open[0].acked:
+                batch = self._open.popleft()
+                if batch.seq > self._sent[0]:
+                    self._sent = (batch.seq, batch.position)
+
+            if self._open:
+                return self._open[0].start
+            return self._sent[1]
+
+
+def batch_logs(batches):
+    """The logs of batches, in the order they are sent to nsq, each batch
+    starting with its template definitions
+
+    >>> b = LogBatch('acks'); b.append('a', (7, 2)); b.append('b', (7, 4))
+    >>> b.add_definition('6f43', 't')
+    >>> batch_logs([b, b])
+    ['t', 'a', 'b', 't', 'a', 'b']
+    """
+    return list(
+        itertools.chain.from_iterable(b.definitions.values() + b.logs for b in batches)
+    )
+
+
+class _Lane(object):
+    """Batches of one priority, queued per source file and taken from the
+    sources in turn"""
+
+    __slots__ = (
+        "name",
+        "weight",
+        "max_nbytes",
+        "nbytes",
+        "nbatches",
+        "sources",
+        "order",
+    )
+
+    def __init__(self, name, weight, max_nbytes):
+        self.name = name
+        self.weight = weight
+        self.max_nbytes = max_nbytes
+        self.nbytes = 0
+        self.nbatches = 0
+        # source -> its batches, oldest first
+        self.sources = {}
+        # Sources with batches, the one to take from next first
+        self.order = collections.deque()
+
+    def put(self, batch):
+        batches = self.sources.get(batch.acks)
+        if batches is None:
+            batches = self.sources[batch.acks] = collections.deque()
+            self.order.append(batch.acks)
+
+        batches.append(batch)
+        self.nbytes += batch.nbytes
+        self.nbatches += 1
+
+    def oldest(self):
+        return min(b[0].queued_at for b in self.sources.itervalues())
+
+    def take(self, out, max_nbytes):
+        """Moves whole batches adding up to at most `max_nbytes` to `out`,
+        a batch of each source in turn, or the first one alone when it is
+        bigger and `out` is empty. Returns the bytes moved."""
+        nbytes = nbatches = 0
+        while self.order:
+            source = self.order[0]
+            batches = self.sources[source]
+            n = batches[0].nbytes
+            if nbytes + n > max_nbytes and (nbytes or out):
+                break
+
+            out.append(batches.popleft())
+            nbytes += n
+            nbatches += 1
+            self.order.popleft()
+            if batches:
+                self.order.append(source)
+            else:
+                del self.sources[source]
+
+        self.nbytes -= nbytes
+        self.nbatches -= nbatches
+        return nbytes
+
+
+class BatchQueue(object):
+    """Hands batches of logs over from reader threads to the sender,
+    bounded by the number of bytes queued rather than of logs.
+
+    Batches go to the lane their `lane` indexes, lanes being given as
+    (name, weight) in order of priority. Each lane holds its share of
+    `max_nbytes`, a lane over its share borrowing the room left in the
+    queue as a whole. Readers putting a batch block only once both its
+    lane and the queue are full, until the sender takes batches off them.
+    As a lane within its share is never held up by the others borrowing,
+    the queue holds up to twice `max_nbytes`. A send is shared between
+    the lanes by their weights, the room lanes leave going to the ones of
+    higher priority. Within a lane, batches are taken from each file in
+    turn.
+
+    >>> q = BatchQueue(max_nbytes=24)
+    >>> for i in range(3):
+    ...     b = LogBatch('acks')
+    ...     b.append('x' * 7, (7, i))
+    ...     q.put(b)
+    >>> len(q), q.nbytes
+    (3, 24)
+
+    A put beyond the budget waits for the sender to take batches
+
+    >>> t = threading.Thread(target=q.put, args=(b,)); t.start()
+    >>> t.join(0.1); t.is_alive()
+    True
+    >>> [b.position for b in q.get(max_nbytes=16)]
+    [(7, 0), (7, 1)]
+    >>> t.join(1); t.is_alive(), len(q)
+    (False, 2)
+
+    get waits for `min_nbytes` to be queued, or for the oldest batch to
+    have been queued for `max_age` seconds
+
+    >>> [b.position for b in q.get(max_nbytes=100, min_nbytes=100, max_age=0.05)]
+    [(7, 2), (7, 2)]
+
+    or returns nothing when neither happened within `timeout`
+
+    >>> q.get(max_nbytes=100, timeout=0.05)
+    []
+
+    Errors go first, a file flooding a lane does not hold up the others
+
+    >>> q = BatchQueue(max_nbytes=100, lanes=(('error', 3), ('info', 1)))
+    >>> for source, lane, n in [('a', 1, 4), ('b', 1, 1), ('c', 0, 1)]:
+    ...     for i in range(n):
+    ...         b = LogBatch(source, lane); b.append('x' * 9, (source, i)); q.put(b)
+    >>> q.depths()
+    [('error', 1, 10), ('info', 5, 50)]
+    >>> [b.position for b in q.get(max_nbytes=40)]
+    [('c', 0), ('a', 0), ('b', 0), ('a', 1)]
+
+    A flood in one lane does not block the readers of the others
+
+    >>> q = BatchQueue(max_nbytes=40, lanes=(('error', 1), ('info', 1)))
+    >>> for i in range(5):
+    ...     b = LogBatch('a', 1); b.append('x' * 9, ('a', i))
+    ...     if i < 4: q.put(b)
+    >>> t = threading.Thread(target=q.put, args=(b,)); t.start()
+    >>> t.join(0.1); t.is_alive()
+    True
+    >>> b = LogBatch('c', 0); b.append('x' * 9, ('c', 0)); q.put(b)
+    >>> q.depths()
+    [('error', 1, 10), ('info', 4, 40)]
+    >>> [b.position for b in q.get(max_nbytes=20)]
+    [('c', 0), ('a', 0)]
+    >>> t.join(1); t.is_alive(), q.depths()
+    (False, [('error', 0, 0), ('info', 4, 40)])
+    """
+
+    def __init__(self, max_nbytes, lanes=(("default", 1),)):
+        self.max_nbytes = max_nbytes
+        lane_nbytes = max_nbytes / len(lanes)
+        self.lanes = [_Lane(name, weight, lane_nbytes) for name, weight in lanes]
+        self.nbytes = 0
+        self.nbatches = 0
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self.nbatches
+
+    def depths(self):
+        """(name, number of batches, bytes) queued in each lane"""
+        with self._cond:
+            return [(l.name, l.nbatches, l.nbytes) for l in self.lanes]
+
+    def put(self, batch):
+        lane = self.lanes[batch.lane]
+        with self._cond:
+            # A batch over the budget by itself still goes through
+            while (
+                lane.nbatches
+                and lane.nbytes + batch.nbytes > lane.max_nbytes
+                and self.nbytes + batch.nbytes > self.max_nbytes
+            ):
+                self._cond.wait()
+
+            batch.queued_at = time.time()
+            lane.put(batch)
+            self.nbytes += batch.nbytes
+            self.nbatches += 1
+            self._cond.notify_all()
+
+    def _take(self, max_nbytes):
+        batches, nbytes = [], 0
+        lanes = [l for l in self.lanes if l.nbatches]
+        weights = float(sum(l.weight for l in lanes))
+
+        # Every lane gets its share of the send, what is left of it goes
+        # to the lanes in order of priority
+        for lane in lanes:
+            nbytes += lane.take(batches, max_nbytes * lane.weight / weights)
+        for lane in lanes:
+            nbytes += lane.take(batches, max_nbytes - nbytes)
+
+        self.nbytes -= nbytes
+        self.nbatches -= len(batches)
+        return batches
+
+    def get(self, max_nbytes, min_nbytes=0, max_age=0, timeout=None):
+        """Returns whole batches adding up to at most `max_nbytes`, or the
+        first one alone when it is bigger. Waits until `min_nbytes` are
+        queued or the oldest batch was queued `max_age` seconds ago, for
+        no longer than `timeout` seconds unless it is None."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                wait = None
+                if self.nbatches:
+                    if self.nbytes >= min_nbytes:
+                        break
+                    oldest = min(l.oldest() for l in self.lanes if l.nbatches)
+                    wait = oldest + max_age - now
+                    if wait <= 0:
+                        break
+
+                if deadline is not None:
+                    if now >= deadline:
+                        return []
+                    wait = min(wait, deadline - now) if wait else deadline - now
+                self._cond.wait(wait)
+
+            batches = self._take(max_nbytes)
+            self._cond.notify_all()
+            return batches
+
+
+class FlushScheduler(object):
+    """Decides when the sender takes batches off the queue, bounding the
+    time logs wait in it by `max_latency` seconds.
+
+    Waiting longer than a send takes does not make sends any bigger, as
+    logs queue up during the send anyway. So a flush waits for as many
+    bytes as flow in during a send, both being moving averages. A quiet
+    host sends a log as soon as it is queued, a busy one sends batches
+    that grow with the load up to `max_nbytes`.
+
+    >>> q = BatchQueue(max_nbytes=1024)
+    >>> s = FlushScheduler(q, max_latency=0.05, max_nbytes=64)
+    >>> b = LogBatch('acks'); b.append('x' * 9, (7, 10)); q.put(b)
+    >>> [b.position for b in s.get()], s.target_nbytes
+    ([(7, 10)], 0.0)
+
+    >>> s.rate, s.send_seconds = 10000.0, 0.01
+    >>> s.target_nbytes
+    64
+    >>> q.put(b); [b.position for b in s.get()]
+    [(7, 10)]
+    >>> s.stats['nflushes'], s.stats['max_nbytes'], s.stats['max_delay'] >= 0.05
+    (2, 10, True)
+    """
+
+    SMOOTHING = 0.2  # Weight of the latest flush in the moving averages
+    STATS_INTERVAL = 60  # How often the achieved batch sizes and delays are logged
+
+    def __init__(self, queue, max_latency, max_nbytes, log=util.DUMMY):
+        self.queue = queue
+        self.max_latency = max_latency
+        self.max_nbytes = max_nbytes
+        self.log = log
+
+        # Bytes per second flowing into the queue and seconds a send takes
+        self.rate = 0.0
+        self.send_seconds = 0.0
+        self._last_flush_ts = None
+
+        self.stats = None
+        self._reset_stats()
+
+    @property
+    def target_nbytes(self):
+        return min(self.rate * self.send_seconds, self.max_nbytes)
+
+    def _average(self, current, value):
+        return current + self.SMOOTHING * (value - current)
+
+    def _reset_stats(self):
+        self.stats = dict(nflushes=0, nbytes=0, max_nbytes=0, delay=0.0, max_delay=0.0)
+        self._stats_since = time.time()
+
+    def get(self, timeout=None):
+        """Returns the batches to send next, nothing when none were due
+        within `timeout` seconds unless it is None"""
+        batches = self.queue.get(
+            self.max_nbytes, self.target_nbytes, self.max_latency, timeout
+        )
+        now = time.time()
+        if not batches:
+            return batches
+
+        nbytes = sum(b.nbytes for b in batches)
+        if self._last_flush_ts is not None:
+            elapsed = max(now - self._last_flush_ts, 0.001)
+            self.rate = self._average(self.rate, nbytes / elapsed)
+        self._last_flush_ts = now
+
+        delay = now - batches[0].queued_at
+        stats = self.stats
+        stats["nflushes"] += 1
+        stats["nbytes"] += nbytes
+        stats["max_nbytes"] = max(stats["max_nbytes"], nbytes)
+        stats["delay"] += delay
+        stats["max_delay"] = max(stats["max_delay"], delay)
+
+        if now - self._stats_since >= self.STATS_INTERVAL:
+            self.log.info(
+                "flush_stats",
+                type="metric",
+                nflushes=stats["nflushes"],
+                avg_nbytes=stats["nbytes"] / stats["nflushes"],
+                max_nbytes=stats["max_nbytes"],
+                avg_delay=stats["delay"] / stats["nflushes"],
+                max_delay=stats["max_delay"],
+                target_nbytes=self.target_nbytes,
+            )
+            self._reset_stats()
+
+        return batches
+
+    def sent(self, seconds):
+        """Tells how long sending the last batches took"""
+        self.send_seconds = self._average(self.send_seconds, seconds)
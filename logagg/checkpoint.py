@@ -0,0 +1,226 @@
+import os
+import time
+import errno
+import threading
+
+from deeputil import keeprunning
+
+from logagg import util
+
+
+class CheckpointJournal(object):
+    """Offsets of all tracked files in a single append-only journal.
+
+    Offsets are staged with `update` and written together, as one append,
+    by `commit`. The journal is compacted into a snapshot of the latest
+    offsets once it grows well beyond that, dropping the paths that no
+    longer exist and were not checkpointed since the previous compaction.
+    Each line of the journal is "<inode> <offset> <fingerprint> <fpath>",
+    tab separated.
+
+    With the "interval" fsync policy, commits are synced to disk by a
+    thread every FSYNC_INTERVAL seconds.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> jpath = os.path.join(d, 'checkpoint.journal')
+
+    >>> j = CheckpointJournal(jpath)
+    >>> j.update('/var/log/a.log', 11, 120, '4:abcd')
+    >>> j.update('/var/log/b.log', 12, 40, None)
+    >>> j.get('/var/log/a.log') is None
+    True
+    >>> j.commit()
+    >>> j.update('/var/log/a.log', 11, 240, '4:abcd')
+    >>> j.commit()
+    >>> j.close()
+
+    The latest offsets are loaded on startup, a write torn by a crash is
+    ignored
+
+    >>> with open(jpath, 'a') as f: f.write('11\\t3')
+    >>> j = CheckpointJournal(jpath)
+    >>> j.get('/var/log/a.log'), j.get('/var/log/b.log')
+    ((11, 240, '4:abcd'), (12, 40, None))
+    >>> j.update('/var/log/b.log', 12, 80, None)
+    >>> j.commit()
+    >>> len(open(jpath).readlines())
+    4
+
+    Compacting drops /var/log/a.log, which does not exist and was not
+    checkpointed since the journal was loaded
+
+    >>> j.compact()
+    >>> open(jpath).readlines()
+    ['12\\t80\\t-\\t/var/log/b.log\\n']
+    >>> j.close()
+    >>> CheckpointJournal(jpath).checkpoints == j.checkpoints
+    True
+
+    >>> shutil.rmtree(d)
+    """
+
+    FSYNC_POLICIES = ("always", "interval", "never")
+    FSYNC_INTERVAL = 1  # Seconds between fsyncs with the "interval" policy
+    COMPACT_MIN_NBYTES = 4 * (1024 ** 2)  # Journal size never compacted below
+    COMPACT_RATIO = 4  # Compact when the journal is this many times its last snapshot
+
+    def __init__(self, fpath, fsync="interval", log=util.DUMMY):
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError("unknown_fsync_policy: %s" % fsync)
+
+        self.fpath = fpath
+        self.fsync = fsync
+        self.log = log
+
+        # fpath -> (inode, offset, fingerprint) of committed checkpoints
+        self.checkpoints = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Paths checkpointed since the journal was last compacted
+        self._updated = set()
+        # Whether commits were written since the last fsync
+        self._unsynced = False
+        self._thread = None
+        self._closed = False
+
+        d = os.path.dirname(fpath)
+        if d and not os.path.isdir(d):
+            os.makedirs(d)
+
+        self._nbytes = self._load()
+        self._snapshot_nbytes = self._nbytes
+        self._fh = open(fpath, "ab")
+
+    def _load(self):
+        try:
+            f = open(self.fpath, "rb")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return 0
+            raise
+
+        nbytes = 0
+        with f:
+            for line in f:
+                try:
+                    self._parse(line)
+                except ValueError:
+                    break
+                nbytes += len(line)
+
+        # Drop whatever a crash left half written, appends go after it
+        if nbytes != os.path.getsize(self.fpath):
+            self.log.warning("dropping_torn_checkpoint_journal_tail", fpath=self.fpath)
+            with open(self.fpath, "r+b") as f:
+                f.truncate(nbytes)
+
+        self.log.info(
+            "loaded_checkpoint_journal", fpath=self.fpath, nfiles=len(self.checkpoints)
+        )
+        return nbytes
+
+    def _parse(self, line):
+        if not line.endswith("\n"):
+            raise ValueError("incomplete_line")
+
+        inode, offset, fp, fpath = line[:-1].split("\t", 3)
+        fp = None if fp == "-" else fp
+        self.checkpoints[fpath] = (int(inode), int(offset), fp)
+
+    def _serialize(self, checkpoints):
+        return "".join(
+            "%d\t%d\t%s\t%s\n" % (inode, offset, fp or "-", fpath)
+            for fpath, (inode, offset, fp) in checkpoints.iteritems()
+        )
+
+    def get(self, fpath):
+        """Returns the committed (inode, offset, fingerprint) of fpath"""
+        return self.checkpoints.get(fpath)
+
+    def update(self, fpath, inode, offset, fp):
+        """Stages the offset of fpath to be written by the next commit"""
+        with self._lock:
+            self._pending[fpath] = (inode, offset, fp)
+
+    def _sync(self):
+        os.fsync(self._fh.fileno())
+        self._unsynced = False
+
+    @keeprunning(FSYNC_INTERVAL, on_error=util.log_exception)
+    def _sync_forever(self):
+        time.sleep(self.FSYNC_INTERVAL)
+        with self._lock:
+            if self._closed:
+                raise keeprunning.terminate
+            if self._unsynced:
+                self._sync()
+
+    def commit(self):
+        """Appends every staged offset to the journal in a single write"""
+        with self._lock:
+            if not self._pending:
+                return
+
+            pending, self._pending = self._pending, {}
+            data = self._serialize(pending)
+            self._fh.write(data)
+            self._fh.flush()
+            if self.fsync == "always":
+                self._sync()
+            elif self.fsync == "interval":
+                self._unsynced = True
+                if self._thread is None:
+                    self._thread = util.start_daemon_thread(self._sync_forever)
+
+            self.checkpoints.update(pending)
+            self._updated.update(pending)
+            self._nbytes += len(data)
+            limit = max(
+                self.COMPACT_MIN_NBYTES, self.COMPACT_RATIO * self._snapshot_nbytes
+            )
+            if self._nbytes > limit:
+                self._compact()
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        """Replaces the journal by a snapshot of the latest checkpoints"""
+        for fpath in self.checkpoints.keys():
+            if fpath not in self._updated and not os.path.exists(fpath):
+                del self.checkpoints[fpath]
+        self._updated = set()
+
+        tmp_fpath = self.fpath + ".tmp"
+        data = self._serialize(self.checkpoints)
+        with open(tmp_fpath, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._fh.close()
+        os.rename(tmp_fpath, self.fpath)
+        self._fh = open(self.fpath, "ab")
+        self._unsynced = False
+
+        # The rename is durable only once the directory is synced
+        fd = os.open(os.path.dirname(os.path.abspath(self.fpath)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        self.log.debug(
+            "compacted_checkpoint_journal", old_nbytes=self._nbytes, nbytes=len(data)
+        )
+        self._nbytes = self._snapshot_nbytes = len(data)
+
+    def close(self):
+        self.commit()
+        with self._lock:
+            if self.fsync != "never":
+                self._sync()
+            self._closed = True
+            self._fh.close()
@@ -2,23 +2,30 @@ import os
 import sys
 import time
 import ujson as json
-import glob
-import uuid
 import Queue
 import socket
-import datetime
-from operator import attrgetter
+import threading
+import itertools
+import collections
+import multiprocessing
 import traceback
 
 from deeputil import AttrDict, keeprunning
-from pygtail import Pygtail
 from logagg import util
+from logagg import backfill
+from logagg.batchqueue import BatchQueue, AckTracker, FlushScheduler
+from logagg.nsqsender import pack_messages, unpack_messages
+from logagg.checkpoint import CheckpointJournal
 from logagg.formatters import RawLog
-
-# TODO
-"""
-After a downtime of collector, pygtail is missing logs from rotational files
-"""
+from logagg.reader import ChunkedReader, RecordAssembler
+from logagg.routing import Router
+from logagg.rules import RuleSet
+from logagg.sampling import Limits, Sampled
+from logagg.aggregate import Aggregations, Aggregated, IntervalBuffer
+from logagg.templates import TemplateMiners, Templated
+from logagg.repeats import RepeatCollapser, Repeated
+from logagg.record import LOG_STRUCTURE, LOG_VALIDATOR, LogRecord, log_ids
+from logagg.tailer import Tailer, FilePattern
 
 
 def load_formatter_fn(formatter):
@@ -35,65 +42,116 @@ def load_formatter_fn(formatter):
 class LogCollector(object):
     DESC = "Collects the log information and sends to NSQTopic"
 
-    QUEUE_MAX_SIZE = 2000  # Maximum number of messages in in-mem queue
-    MAX_NBYTES_TO_SEND = 4.5 * (
-        1024 ** 2
-    )  # Number of bytes from in-mem queue minimally required to push
-    MIN_NBYTES_TO_SEND = 512 * 1024  # Minimum number of bytes to send to nsq in mpub
-    MAX_SECONDS_TO_PUSH = 1  # Wait till this much time elapses before pushing
-    LOG_FILE_POLL_INTERVAL = 0.25  # Wait time to pull log file for new lines added
-    QUEUE_READ_TIMEOUT = 1  # Wait time when doing blocking read on the in-mem q
-    PYGTAIL_ACK_WAIT_TIME = 0.05  # TODO: Document this
+    QUEUE_MAX_NBYTES = 16 * (1024 ** 2)  # Bytes queued in memory before readers wait
+    LANES = (
+        ("urgent", 8),
+        ("normal", 4),
+        ("debug", 1),
+    )  # (name, weight) of the queue lanes, in order of priority
+    LEVEL_LANES = dict(
+        [(l, 0) for l in ("critical", "fatal", "error", "exception", "alert", "emerg")]
+        + [(l, 2) for l in ("debug", "trace")]
+    )  # Lanes by level, other levels and logs without one go to NORMAL_LANE
+    NORMAL_LANE = 1
+    HANDOFF_BATCH_NBYTES = 256 * 1024  # Bytes of logs readers queue at once
+    MAX_NBYTES_TO_SEND = 4.5 * (1024 ** 2)  # Most bytes of logs sent to nsq in one mpub
+    MAX_SECONDS_TO_PUSH = 1  # Longest time a log waits in the queue to be sent
+    NSQ_RETRY_INTERVAL = 1  # Wait time to try nsq again after it was unavailable
+    SEND_CONFIRM_INTERVAL = 0.05  # How often sends in flight are checked for completion
+    SPILL_DRAIN_SECONDS = 5  # Time spent sending spilled logs before taking new ones
+    LOG_FILE_POLL_INTERVAL = 0.25  # Wait time to poll files inotify cannot watch
+    TAILER_WAIT_TIMEOUT = 1  # Max time the tailer blocks waiting for file changes
+    NUM_READER_THREADS = 4  # Threads reading and parsing lines of changed files
+    BACKFILL_MIN_NBYTES = 64 * (1024 ** 2)  # Unread bytes that trigger a backfill
+    BACKFILL_RANGE_NBYTES = 8 * (1024 ** 2)  # Bytes parsed by a backfill worker at once
+    PARSE_BATCH_SIZE = 1000  # Records sent to a parse worker at once
+    INTERVAL_FLUSH_LOGS = 1000  # Metric logs summed up between sends of intervals over
+    MAX_RECORD_NBYTES = 1024 ** 2  # Longer records are split into pieces
+    MULTILINE_FLUSH_INTERVAL = 2  # Idle time after which a file's last record is sent
+    MAX_TEMPLATE_DEFINITIONS = (
+        20000
+    )  # Template definitions kept, the least used dropped
     SCAN_FPATTERNS_INTERVAL = (
         30
-    )  # How often to scan filesystem for files matching fpatterns
+    )  # How often to glob fpatterns whose directories cannot be watched
     HOST = socket.gethostname()
     HEARTBEAT_RESTART_INTERVAL = 30  # Wait time if heartbeat sending stops
+    CHECKPOINT_FPATH = "/var/log/logagg/checkpoint.journal"  # Offsets of all files
 
-    LOG_STRUCTURE = {
-        "id": basestring,
-        "timestamp": basestring,
-        "file": basestring,
-        "host": basestring,
-        "formatter": basestring,
-        "raw": basestring,
-        "type": basestring,
-        "level": basestring,
-        "event": basestring,
-        "data": dict,
-        "error": bool,
-        "error_tb": basestring,
-    }
+    LOG_STRUCTURE = LOG_STRUCTURE
 
     def __init__(
-        self, fpaths, heartbeat_interval, nsq_sender=util.DUMMY, log=util.DUMMY
+        self,
+        fpaths,
+        heartbeat_interval,
+        nsq_sender=util.DUMMY,
+        log=util.DUMMY,
+        backfill_workers=0,
+        checkpoints=None,
+        parse_workers=0,
+        spill=None,
+        max_latency=MAX_SECONDS_TO_PUSH,
+        routes=(),
+        rules=(),
+        limits=(),
+        aggregations=(),
+        templates=(),
+        dedup_window=0,
     ):
         self.fpaths = fpaths
         self.nsq_sender = nsq_sender
         self.heartbeat_interval = heartbeat_interval
         self.log = log
-
-        # Log fpath to thread mapping
-        self.log_reader_threads = {}
+        # Number of processes formatting big unread parts of files, 0 disables
+        self.backfill_workers = backfill_workers
+        self.backfill_pool = None
+        # Number of processes records are formatted on, 0 formats them in
+        # the reader threads
+        self.parse_workers = parse_workers
+        self.parse_pool = None
+        # Journal the offsets of all the files read are checkpointed to
+        self.checkpoints = checkpoints
+        # SpillLog logs go to while nsq is unavailable, None waits for nsq
+        self.spill = spill
+        # Picks the nsq topic of each log from the routes given
+        self.router = Router(routes)
+        # Project, redact or drop formatted logs before they are serialized
+        self.rules = RuleSet(rules)
+        # Samples and rate limits keeping floods of logs out, along with
+        # the tracker of the summaries of what they dropped
+        self.limits = Limits(limits)
+        self._summary_acks = AckTracker(None)
+        # Metric logs summed up over intervals rather than sent one by one,
+        # buffered per file by AckTracker
+        self.aggregations = Aggregations(aggregations)
+        self.interval_buffers = {}
+        # Miners shipping messages as template ids and parameters, and the
+        # definitions of the templates handed out by them
+        self.templates = TemplateMiners(templates)
+        self.template_definitions = collections.OrderedDict()
+        self._templates_lock = threading.Lock()
+        # Seconds consecutive repeats of a record are collapsed for, 0
+        # sends each of them
+        self.dedup_window = dedup_window
+
+        # (FilePattern, formatter) for each fpattern, parsed on start
+        self.fpatterns = []
+        # Log fpath to log file info mapping
+        self.log_files = {}
         # Handle name to formatter fn obj map
         self.formatters = {}
-        self.queue = Queue.Queue(maxsize=self.QUEUE_MAX_SIZE)
-
-    def _remove_redundancy(self, log):
-        """Removes duplicate data from 'data' inside log dict and brings it
-        out.
-
-        >>> lc = LogCollector('file=/path/to/log_file.log:formatter=logagg.formatters.basescript', 30)
+        self.queue = BatchQueue(self.QUEUE_MAX_NBYTES, self.LANES)
+        self.flusher = FlushScheduler(
+            self.queue, max_latency, self.MAX_NBYTES_TO_SEND, log=log
+        )
 
-        >>> log = {'id' : 46846876, 'type' : 'log',
-        ...         'data' : {'a' : 1, 'b' : 2, 'type' : 'metric'}}
-        >>> lc._remove_redundancy(log)
-        {'data': {'a': 1, 'b': 2}, 'type': 'metric', 'id': 46846876}
-        """
-        for key in log:
-            if key in log and key in log["data"]:
-                log[key] = log["data"].pop(key)
-        return log
+        # One tailer watches all tracked files and hands the changed ones
+        # to a fixed pool of reader threads through changed_files
+        self.tailer = Tailer(poll_interval=self.LOG_FILE_POLL_INTERVAL, log=log)
+        self.changed_files = Queue.Queue()
+        # fpath -> whether it changed again while queued or being read
+        self._files_pending = {}
+        self._files_lock = threading.Lock()
 
     def validate_log_format(self, log):
         """
@@ -136,314 +194,801 @@ class LogCollector(object):
         'passed'
         """
 
-        keys_in_log = set(log)
-        keys_in_log_structure = set(self.LOG_STRUCTURE)
-        try:
-            assert keys_in_log == keys_in_log_structure
-        except AssertionError as e:
+        problem = LOG_VALIDATOR.check_dict(log)
+        if problem is not None:
             self.log.warning(
-                "formatted_log_structure_rejected",
-                key_not_found=list(keys_in_log_structure - keys_in_log),
-                extra_keys_found=list(keys_in_log - keys_in_log_structure),
-                num_logs=1,
-                type="metric",
+                "formatted_log_structure_rejected", num_logs=1, type="metric", **problem
             )
             return "failed"
 
-        for key in log:
-            try:
-                assert isinstance(log[key], self.LOG_STRUCTURE[key])
-            except AssertionError as e:
-                self.log.warning(
-                    "formatted_log_structure_rejected",
-                    key_datatype_not_matched=key,
-                    datatype_expected=type(self.LOG_STRUCTURE[key]),
-                    datatype_got=type(log[key]),
-                    num_logs=1,
-                    type="metric",
-                )
-                return "failed"
-
         return "passed"
 
-    def _full_from_frags(self, frags):
-        full_line = "\n".join([l for l, _ in frags])
-        line_info = frags[-1][-1]
-        return full_line, line_info
+    def _iter_logs(self, freader, assembler):
+        """Yields (record, position) for every record read from freader,
+        position being the (inode, offset) at which the record ends.
 
-    def _iter_logs(self, freader, fmtfn):
+        The last record read is held back by the assembler as lines read
+        later may continue it, until the file stayed idle for
+        MULTILINE_FLUSH_INTERVAL seconds, unless the reader cut its last
+        line short of the newline.
+
+        >>> lc = LogCollector('file=/path/to/log_file.log:formatter=logagg.formatters.basescript', 30)
+        >>> class Reader(object):
+        ...     cut = False
+        ...     def __init__(self, chunks): self.chunks = chunks
+        ...     def read_chunks(self): return self.chunks
+        >>> assembler = RecordAssembler(util.ispartial)
+        >>> reader = Reader([('a\\n b', 7, 0), (' c\\nd\\n e\\nf', 7, 5)])
+        >>> for record, position in lc._iter_logs(reader, assembler):
+        ...     print(record, position)
+        ('a\\n b\\n c', (7, 8))
+        ('d\\n e', (7, 13))
+
+        >>> lc.MULTILINE_FLUSH_INTERVAL = 0
+        >>> list(lc._iter_logs(Reader([(' g', 7, 15)]), assembler))
+        [('f\\n g', (7, 18))]
+        """
         # FIXME: does not handle partial lines
         # at the start of a file properly
 
-        frags = []
+        for data, inode, offset in freader.read_chunks():
+            for record in assembler.feed(data, inode, offset):
+                yield record
 
-        for line_info in freader:
-            line = line_info["line"][:-1]  # remove new line char at the end
+        if freader.cut:
+            return
+        since = assembler.pending_since
+        if since is not None and time.time() - since >= self.MULTILINE_FLUSH_INTERVAL:
+            for record in assembler.flush():
+                yield record
 
-            if not fmtfn.ispartial(line) and frags:
-                yield self._full_from_frags(frags)
-                frags = []
+    def get_formatter_fn(self, formatter):
+        fmtfn = self.formatters.get(formatter)
+        if fmtfn is None:
+            fmtfn = self.formatters[formatter] = load_formatter_fn(formatter)
+        return fmtfn
 
-            frags.append((line, line_info))
+    def new_assembler(self, fmtfn):
+        demuxer = getattr(fmtfn, "demuxer", None)
+        if demuxer is not None:
+            return demuxer(self.get_formatter_fn, self.MAX_RECORD_NBYTES)
+        return RecordAssembler(fmtfn.ispartial, self.MAX_RECORD_NBYTES)
 
-        if frags:
-            yield self._full_from_frags(frags)
+    def lane_of(self, log):
+        """Index of the queue lane of a formatted LogRecord
 
-    def assign_default_log_values(self, fpath, line, formatter):
+        >>> lc = LogCollector('file=/path/to/log_file.log:formatter=logagg.formatters.basescript', 30)
+        >>> log = LogRecord('/var/log/a.log', 'a line', 'formatter', 'host')
+        >>> log.update({'level': 'debug'}); log.finalize(); lc.lane_of(log)
+        2
+        >>> log.level = 'ERROR'; lc.lane_of(log)
+        0
+
+        Logs of formatters giving no level are not taken as debug logs
+
+        >>> log = LogRecord('/var/log/a.log', 'a line', 'formatter', 'host')
+        >>> log.finalize(); log.level, lc.lane_of(log)
+        ('debug', 1)
+        >>> log.error = True; lc.lane_of(log)
+        0
+        """
+        if log.error:
+            return 0
+        if not log.level_given:
+            return self.NORMAL_LANE
+
+        lane = self.LEVEL_LANES.get(log.level)
+        if lane is None:
+            lane = self.LEVEL_LANES.get(log.level.lower(), self.NORMAL_LANE)
+        return lane
+
+    def format_record(self, fpath, record, formatter, fmtfn):
+        """Formats a record handed out by the assembler of fpath, see
+        `format_log`. Returns the serialized log along with its lane and
+        topic, or None. Demuxers hand out records as (line, fmtfn, fields),
+        records kept by sampling come as Sampled and runs of repeats as
+        Repeated.
+
+        Logs standing for others left out by sampling and rate limits
+        carry the fraction of those that were kept in `data.sample_rate`.
+        Runs of repeats are sent as their first log, carrying their number
+        in `data.repeat_count` and the timestamps of the first and last
+        of them in `data.first_timestamp` and `data.last_timestamp`.
+        Metric logs taken in by an aggregation come as Aggregated in place
+        of the serialized log, logs whose message was replaced by a
+        template as Templated.
         """
+        sample_rate = 1.0
+        if isinstance(record, Sampled):
+            record, sample_rate = record
+
+        repeated = None
+        if isinstance(record, Repeated):
+            repeated, record = record, record.record
+
+        log = self._format_record(fpath, record, formatter, fmtfn)
+        if log is None:
+            return None
+
+        if repeated is not None:
+            # Only the last of the repeats left out is formatted, for its timestamp
+            last = self._format_record(fpath, repeated.last, formatter, fmtfn)
+            log.data["repeat_count"] = repeated.count
+            log.data["first_timestamp"] = log.timestamp
+            log.data["last_timestamp"] = (last or log).timestamp
+
+        rate = self.limits.admit(log)
+        if rate is None:
+            return None
+        sample_rate *= rate
+        if sample_rate < 1:
+            log.data["sample_rate"] = sample_rate
+
+        lane, topic = self.lane_of(log), self.router.topic_of(log)
+        if self.aggregations.aggregations:
+            aggregated = self.aggregations.take(log)
+            if aggregated is not None:
+                return aggregated, lane, topic
+
+        if self.templates.miners:
+            encoded = self.templates.encode(log)
+            if encoded is not None:
+                tid, definition = encoded
+                return Templated(log.to_json(), tid, definition), lane, topic
+
+        return log.to_json(), lane, topic
+
+    def _format_record(self, fpath, record, formatter, fmtfn):
+        if isinstance(record, tuple):
+            line, fmtfn, fields = record
+        else:
+            line, fields = record, None
+        return self._format_log(fpath, line, formatter, fmtfn, fields)
+
+    def format_log(self, fpath, line, formatter, fmtfn, fields=None):
+        """Formats a record read from fpath and returns it serialized, or
+        None when the formatted log does not match LOG_STRUCTURE. `fields`
+        override the default values of the log, a None `fmtfn` leaves the
+        line unformatted.
+
         >>> lc = LogCollector('file=/path/to/log_file.log:formatter=logagg.formatters.basescript', 30)
-        >>> from pprint import pprint
-
-        >>> formatter = 'logagg.formatters.mongodb'
-        >>> fpath = '/var/log/mongodb/mongodb.log'
-        >>> line = 'some log line here'
-
-        >>> default_log = lc.assign_default_log_values(fpath, line, formatter)
-        >>> pprint(default_log) #doctest: +ELLIPSIS
-        {'data': {},
-         'error': False,
-         'error_tb': '',
-         'event': 'event',
-         'file': '/var/log/mongodb/mongodb.log',
-         'formatter': 'logagg.formatters.mongodb',
-         'host': '...',
-         'id': None,
-         'level': 'debug',
-         'raw': 'some log line here',
-         'timestamp': '...',
-         'type': 'log'}
+        >>> fmtfn = load_formatter_fn('logagg.formatters.mongodb')
+        >>> line = '2017-08-17T07:56:33.489+0200 I REPL     [signalProcessingThread] shutting down'
+        >>> log = json.loads(lc.format_log('/var/log/mongodb.log', line,
+        ...                     'logagg.formatters.mongodb', fmtfn))
+        >>> log['timestamp'], log['data']['component'], log['error']
+        (u'2017-08-17T07:56:33.489+0200', u'REPL', False)
         """
-        return dict(
-            id=None,
-            file=fpath,
-            host=self.HOST,
-            formatter=formatter,
-            event="event",
-            data={},
-            raw=line,
-            timestamp=datetime.datetime.utcnow().isoformat(),
-            type="log",
-            level="debug",
-            error=False,
-            error_tb="",
-        )
+        log = self._format_log(fpath, line, formatter, fmtfn, fields)
+        return log.to_json() if log is not None else None
+
+    def _format_log(self, fpath, line, formatter, fmtfn, fields):
+        log = LogRecord(fpath, line, formatter, self.HOST)
+        if fields:
+            log.update(fields)
+
+        try:
+            _log = fmtfn(line) if fmtfn is not None else None
+
+            if isinstance(_log, RawLog):
+                formatter, raw_log = _log["formatter"], _log["raw"]
+                log.update(_log)
+                _log = self.get_formatter_fn(formatter)(raw_log)
+
+            if _log:
+                log.update(_log)
+        except (SystemExit, KeyboardInterrupt) as e:
+            raise
+        except:
+            log.error = True
+            log.error_tb = traceback.format_exc()
+            self.log.exception("error_during_handling_log_line", log=log.raw)
+
+        log.finalize()
+        problem = log.validate()
+        if problem is not None:
+            self.log.warning(
+                "formatted_log_structure_rejected", num_logs=1, type="metric", **problem
+            )
+            return None
+
+        if not self.rules.apply(log):
+            return None
+        return log
 
-    @keeprunning(LOG_FILE_POLL_INTERVAL, on_error=util.log_exception)
     def collect_log_lines(self, log_file):
+        """Reads what was added to a file since it was last read, formats
+        its records and queues the logs. Big unread parts are formatted on
+        the backfill pool when there is one.
+
+        >>> import tempfile
+        >>> f = tempfile.NamedTemporaryFile()
+        >>> for i in range(200):
+        ...     f.write('2017-08-17T07:56:33.489+0200 I REPL     [x] record %d\\n' % i)
+        >>> f.flush()
+        >>> lc = LogCollector([], 30, backfill_workers=2,
+        ...                   checkpoints=CheckpointJournal(tempfile.mktemp()))
+        >>> lc.BACKFILL_MIN_NBYTES, lc.BACKFILL_RANGE_NBYTES = 1024, 2048
+        >>> lc.MULTILINE_FLUSH_INTERVAL = 0
+        >>> lc.backfill_pool = multiprocessing.Pool(2, backfill.init_worker, (lc,))
+        >>> fmt = 'logagg.formatters.mongodb'
+        >>> log_file = dict(fpath=f.name, formatter=fmt, formatter_fn=load_formatter_fn(fmt))
+        >>> lc.collect_log_lines(log_file)
+        >>> lc.backfill_pool.terminate()
+        >>> logs = [json.loads(l) for b in lc.queue.get(10 ** 9, timeout=0) for l in b.logs]
+        >>> [l['data']['message'] for l in logs] == ['record %d' % i for i in range(200)]
+        True
+        >>> log_file['freader'].offset == os.path.getsize(f.name)
+        True
+        """
         L = log_file
         fpath = L["fpath"]
         fmtfn = L["formatter_fn"]
         formatter = L["formatter"]
 
-        freader = Pygtail(fpath)
-        for line, line_info in self._iter_logs(freader, fmtfn):
-            log = self.assign_default_log_values(fpath, line, formatter)
+        # The reader is kept across calls so that reading resumes from
+        # where the previous call stopped, not from the acked offset
+        freader = L.get("freader")
+        if freader is None:
+            freader = L["freader"] = ChunkedReader(
+                fpath, self.checkpoints, max_nbytes=self.MAX_RECORD_NBYTES
+            )
+            L["acks"] = AckTracker(freader)
+            L["assembler"] = self.new_assembler(fmtfn)
+            if self.dedup_window:
+                L["repeats"] = RepeatCollapser(self.dedup_window)
 
-            try:
-                _log = fmtfn(line)
+        self._report_limits()
 
-                if isinstance(_log, RawLog):
-                    formatter, raw_log = _log["formatter"], _log["raw"]
-                    log.update(_log)
-                    _log = load_formatter_fn(formatter)(raw_log)
+        if self.backfill_pool is not None:
+            self._backfill(log_file, freader)
 
-                log.update(_log)
-            except (SystemExit, KeyboardInterrupt) as e:
-                raise
-            except:
-                log["error"] = True
-                log["error_tb"] = traceback.format_exc()
-                self.log.exception("error_during_handling_log_line", log=log["raw"])
-
-            if log["id"] == None:
-                log["id"] = uuid.uuid1().hex
-
-            log = self._remove_redundancy(log)
-            if self.validate_log_format(log) == "failed":
-                continue
-
-            self.queue.put(
-                dict(log=json.dumps(log), freader=freader, line_info=line_info)
+        if self.parse_pool is not None:
+            self._collect_on_parse_pool(log_file, freader)
+        else:
+            records = self._read_records(L, freader)
+            logs = (
+                (self.format_record(fpath, record, formatter, fmtfn), position)
+                for record, position in records
             )
-            self.log.debug("tally:put_into_self.queue", size=self.queue.qsize())
-
-        while not freader.is_fully_acknowledged():
-            t = self.PYGTAIL_ACK_WAIT_TIME
-            self.log.debug("waiting_for_pygtail_to_fully_ack", wait_time=t)
-            time.sleep(t)
-        time.sleep(self.LOG_FILE_POLL_INTERVAL)
-
-    def _get_msgs_from_queue(self, msgs, timeout):
-        msgs_pending = []
-        read_from_q = False
-        ts = time.time()
-
-        msgs_nbytes = sum(len(m["log"]) for m in msgs)
-
-        while 1:
-            try:
-                msg = self.queue.get(block=True, timeout=self.QUEUE_READ_TIMEOUT)
-                read_from_q = True
-                self.log.debug("tally:get_from_self.queue")
-
-                _msgs_nbytes = msgs_nbytes + len(msg["log"])
-                _msgs_nbytes += 1  # for newline char
-
-                if _msgs_nbytes > self.MAX_NBYTES_TO_SEND:
-                    msgs_pending.append(msg)
-                    self.log.debug("msg_bytes_read_mem_queue_exceeded")
-                    break
-
-                msgs.append(msg)
-                msgs_nbytes = _msgs_nbytes
-
-                # FIXME condition never met
-                if time.time() - ts >= timeout and msgs:
-                    self.log.debug("msg_reading_timeout_from_mem_queue_got_exceeded")
-                    break
-                    # TODO: What if a single log message itself is bigger than max bytes limit?
-
-            except Queue.Empty:
-                self.log.debug("queue_empty")
-                time.sleep(self.QUEUE_READ_TIMEOUT)
-                if not msgs:
-                    continue
-                else:
-                    return msgs_pending, msgs_nbytes, read_from_q
-
-        self.log.debug("got_msgs_from_mem_queue")
-        return msgs_pending, msgs_nbytes, read_from_q
+            self._queue_logs(L["acks"], logs)
+
+        self._flush_intervals(L["acks"], time.time())
+
+    def _read_records(self, log_file, freader):
+        """The (record, position) pairs read from a file, runs of repeats
+        collapsed and samples taken"""
+        records = self._iter_logs(freader, log_file["assembler"])
+        repeats = log_file.get("repeats")
+        if repeats is not None:
+            records = repeats.collapse(records)
+        return self.limits.sample(log_file["fpath"], log_file["formatter"], records)
+
+    def _collect_on_parse_pool(self, log_file, freader):
+        """Ships the records read from a file in batches to the parse pool
+        and queues the formatted logs in file order"""
+        fpath, formatter = log_file["fpath"], log_file["formatter"]
+
+        jobs = collections.deque()
+        records = self._read_records(log_file, freader)
+        while True:
+            batch = list(itertools.islice(records, self.PARSE_BATCH_SIZE))
+            if not batch:
+                break
 
-    @keeprunning(0, on_error=util.log_exception)  # FIXME: what wait time var here?
-    def send_to_nsq(self, state):
-        msgs = []
-        should_push = False
+            args = (fpath, formatter, batch)
+            jobs.append(self.parse_pool.apply_async(backfill.format_records, (args,)))
 
-        while not should_push:
-            cur_ts = time.time()
-            self.log.debug("should_push", should_push=should_push)
-            time_since_last_push = cur_ts - state.last_push_ts
+            # Keep a bounded number of formatted batches waiting to be queued
+            if len(jobs) > self.parse_workers:
+                self._queue_parsed(log_file["acks"], *jobs.popleft().get())
 
-            msgs_pending, msgs_nbytes, read_from_q = self._get_msgs_from_queue(
-                msgs, self.MAX_SECONDS_TO_PUSH
-            )
+        while jobs:
+            self._queue_parsed(log_file["acks"], *jobs.popleft().get())
 
-            have_enough_msgs = msgs_nbytes >= self.MIN_NBYTES_TO_SEND
-            is_max_time_elapsed = time_since_last_push >= self.MAX_SECONDS_TO_PUSH
+    def _queue_parsed(self, acks, logs, drops):
+        self.limits.add_drops(drops)
+        self._queue_logs(acks, logs)
 
-            should_push = len(msgs) > 0 and (is_max_time_elapsed or have_enough_msgs)
-            self.log.debug(
-                "deciding_to_push",
-                should_push=should_push,
-                time_since_last_push=time_since_last_push,
-                msgs_nbytes=msgs_nbytes,
+    def _report_limits(self):
+        """Queues a metric log for each file or event rate limits dropped
+        logs of since the last report"""
+        for per, key, stats in self.limits.summaries():
+            self.log.warning("logs_rate_limited", per=per, key=key, **stats)
+
+            fpath = key if per == "file" else ""
+            log = LogRecord(fpath, "", "logagg.sampling", self.HOST)
+            log.update(
+                dict(
+                    type="metric",
+                    event="logs_rate_limited",
+                    level="warning",
+                    data=dict(stats, per=per, key=key),
+                )
             )
+            log.finalize()
+
+            summary = log.to_json(), self.lane_of(log), self.router.topic_of(log)
+            self._queue_logs(self._summary_acks, [(summary, None)])
+
+    def _queue_logs(self, acks, logs):
+        """Queues the (log, position) pairs read from the file of `acks` in
+        batches of about HANDOFF_BATCH_NBYTES per lane and topic, logs
+        being (serialized log, lane, topic) or None when left out"""
+        batches = {}
+        naggregated = 0
+        for log, position in logs:
+            if log is None:
+                continue
+
+            log, lane, topic = log
+            if isinstance(log, Aggregated):
+                buf = self.interval_buffers.get(acks)
+                if buf is None:
+                    buf = self.interval_buffers[acks] = IntervalBuffer(
+                        self.aggregations, acks
+                    )
+                now = time.time()
+                buf.add(log, lane, topic, position, now)
+
+                # Intervals over are sent as the file is read rather than
+                # once it was, which could be long when catching up on it.
+                # Those before the time of the log are over in the file.
+                naggregated += 1
+                if naggregated % self.INTERVAL_FLUSH_LOGS == 0:
+                    if log.timestamp is not None:
+                        now = min(now, log.timestamp)
+                    self._flush_intervals(acks, now)
+                continue
+
+            key = lane, topic
+            batch = batches.get(key)
+            if batch is None:
+                batch = batches[key] = acks.new_batch(lane, topic)
+
+            if isinstance(log, Templated):
+                self._add_template_definition(batch, log)
+                log = log.log
+            acks.append(batch, log, position)
+            if batch.nbytes >= self.HANDOFF_BATCH_NBYTES:
+                self.queue.put(batches.pop(key))
+
+        for key in sorted(batches):
+            self.queue.put(batches[key])
+        self.log.debug("tally:put_into_self.queue", nbytes=self.queue.nbytes)
+
+    def _add_template_definition(self, batch, templated):
+        """Adds the log defining the template of a Templated log to its
+        batch. Every batch carries the definitions of the templates of its
+        logs, as the nsq messages they are sent in may each reach another
+        forwarder. Definitions are kept in the order they were last used,
+        those of templates that changed since falling out of use first."""
+        tid = templated.template_id
+        if tid in batch.definitions:
+            return
+
+        definitions = self.template_definitions
+        with self._templates_lock:
+            definition = definitions.pop(tid, None) or templated.definition
+            if definition is None:
+                return
+            definitions[tid] = definition
+            if len(definitions) > self.MAX_TEMPLATE_DEFINITIONS:
+                definitions.popitem(last=False)
+
+        # Each definition sent is a log of its own
+        batch.add_definition(tid, json.dumps(dict(definition, id=log_ids.next())))
+
+    def _flush_intervals(self, acks, now):
+        """Queues the summaries of the metric logs of a file over the
+        intervals that ended, in the batches holding the file back from
+        being checkpointed past them"""
+        buf = self.interval_buffers.get(acks)
+        if buf is None or not buf.due(now):
+            return
+
+        batches = collections.OrderedDict()
+        for batch, event, formatter, timestamp, data in buf.flush(now):
+            log = LogRecord(acks.freader.filename, "", formatter, self.HOST)
+            log.update(dict(type="metric", event=event, timestamp=timestamp, data=data))
+            log.finalize()
+            acks.append(batch, log.to_json(), acks.position)
+            batches[batch] = True
+
+        for batch in batches:
+            self.queue.put(batch)
+
+    def _backfill(self, log_file, freader):
+        """Formats a big unread part of a file in parallel on the backfill
+        pool and queues the logs in file order. The reader is moved past
+        each range once its logs are queued, so it carries on tailing from
+        the end of the last range. Once the file is rotated away from its
+        path, the ranges left are given up and the reader tails the rest
+        of the rotated file from the end of the last range queued.
+
+        >>> import tempfile
+        >>> fpath = os.path.join(tempfile.mkdtemp(), 'mongodb.log')
+        >>> line = '2017-08-17T07:56:33.489+0200 I REPL     [x] record %d\\n'
+        >>> with open(fpath, 'w') as f: f.write(line % 0)
+        >>> lc = LogCollector([], 30, backfill_workers=2,
+        ...                   checkpoints=CheckpointJournal(tempfile.mktemp()))
+        >>> lc.BACKFILL_MIN_NBYTES, lc.BACKFILL_RANGE_NBYTES = 1024, 2048
+        >>> lc.MULTILINE_FLUSH_INTERVAL = 0
+        >>> lc.backfill_pool = multiprocessing.Pool(2, backfill.init_worker, (lc,))
+        >>> fmt = 'logagg.formatters.mongodb'
+        >>> log_file = dict(fpath=fpath, formatter=fmt, formatter_fn=load_formatter_fn(fmt))
+        >>> lc.collect_log_lines(log_file)
+
+        >>> with open(fpath, 'a') as f: f.write(''.join(line % i for i in range(1, 200)))
+        >>> os.rename(fpath, fpath + '.1')
+        >>> with open(fpath, 'w') as f: f.write(line % 200 + line % 201)
+        >>> lc.collect_log_lines(log_file)
+        >>> lc.backfill_pool.terminate()
+        >>> logs = [json.loads(l) for b in lc.queue.get(10 ** 9, timeout=0) for l in b.logs]
+        >>> [l['data']['message'] for l in logs] == ['record %d' % i for i in range(202)]
+        True
+        """
+        fpath, fmtfn = log_file["fpath"], log_file["formatter_fn"]
+
+        inode, start, size = freader.unread()
+        if size - start < self.BACKFILL_MIN_NBYTES:
+            return
+
+        # The record held back ends where the backfill starts, after the
+        # run of repeats held back if any
+        records = log_file["assembler"].flush()
+        repeats = log_file.get("repeats")
+        if repeats is not None:
+            records = repeats.collapse(records, hold=False)
+        logs = (
+            (self.format_record(fpath, record, log_file["formatter"], fmtfn), position)
+            for record, position in records
+        )
+        self._queue_logs(log_file["acks"], logs)
+
+        ranges = backfill.split_ranges(
+            fpath, start, size, fmtfn.ispartial, self.BACKFILL_RANGE_NBYTES
+        )
+        self.log.info(
+            "backfilling_log_file",
+            fpath=fpath,
+            nbytes=size - start,
+            nranges=len(ranges),
+        )
 
+        jobs = collections.deque()
         try:
-            if isinstance(self.nsq_sender, type(util.DUMMY)):
-                for m in msgs:
-                    self.log.info("final_log_format", log=m["log"])
-            else:
-                self.log.debug("trying_to_push_to_nsq", msgs_length=len(msgs))
-                self.nsq_sender.handle_logs(msgs)
-                self.log.debug("pushed_to_nsq", msgs_length=len(msgs))
-            self.confirm_success(msgs)
-            msgs = msgs_pending
-            state.last_push_ts = time.time()
-        except (SystemExit, KeyboardInterrupt):
-            raise
-        finally:
-            if read_from_q:
-                self.queue.task_done()
+            for start, end in ranges:
+                args = (fpath, inode, start, end, log_file["formatter"])
+                jobs.append(
+                    self.backfill_pool.apply_async(backfill.parse_range, (args,))
+                )
 
-    def confirm_success(self, msgs):
-        ack_fnames = set()
+                # Keep a bounded number of parsed ranges waiting to be queued
+                if len(jobs) > 2 * self.backfill_workers:
+                    self._queue_backfilled(log_file["acks"], *jobs.popleft().get())
 
-        for msg in reversed(msgs):
-            freader = msg["freader"]
-            fname = freader.filename
+            while jobs:
+                self._queue_backfilled(log_file["acks"], *jobs.popleft().get())
+        except backfill.FileRotatedError:
+            # The reader still has the rotated file open, the ranges left
+            # are read from it, the results of those in flight are dropped
+            self.log.warning(
+                "file_rotated_during_backfill", fpath=fpath, offset=freader.offset
+            )
+            return
 
-            if fname in ack_fnames:
-                continue
+        self.log.info("backfilled_log_file", fpath=fpath, offset=freader.offset)
 
-            ack_fnames.add(fname)
-            freader.update_offset_file(msg["line_info"])
+    def _queue_backfilled(self, acks, logs, position, drops):
+        self.limits.add_drops(drops)
+        self._queue_logs(acks, logs)
+        acks.freader.seek(position[1])
 
-    @keeprunning(SCAN_FPATTERNS_INTERVAL, on_error=util.log_exception)
-    def _scan_fpatterns(self, state):
-        """
-        For a list of given fpatterns, this starts a thread
-        collecting log lines from file
+    def _schedule_file(self, fpath):
+        """Queues fpath to be read unless it is already pending. A file
+        that changes while pending is queued once more after it is read.
 
-        >>> os.path.isfile = lambda path: path == '/path/to/log_file.log'
         >>> lc = LogCollector('file=/path/to/log_file.log:formatter=logagg.formatters.basescript', 30)
+        >>> lc._schedule_file('/var/log/a.log')
+        >>> lc._schedule_file('/var/log/a.log')
+        >>> lc.changed_files.qsize()
+        1
+        >>> fpath = lc.changed_files.get()
+        >>> lc._unschedule_file(fpath)
+        >>> lc.changed_files.qsize()
+        1
+        >>> lc._unschedule_file(lc.changed_files.get())
+        >>> lc.changed_files.qsize(), lc._files_pending
+        (0, {})
+        """
+        with self._files_lock:
+            if fpath in self._files_pending:
+                self._files_pending[fpath] = True
+                return
+            self._files_pending[fpath] = False
+        self.changed_files.put(fpath)
+
+    def _unschedule_file(self, fpath):
+        with self._files_lock:
+            changed_again = self._files_pending.pop(fpath)
+            if changed_again:
+                self._files_pending[fpath] = False
+
+        if changed_again:
+            self.changed_files.put(fpath)
+
+    @keeprunning(LOG_FILE_POLL_INTERVAL, on_error=util.log_exception)
+    def tail_files(self):
+        for fpath in self.tailer.wait(self.TAILER_WAIT_TIMEOUT):
+            if fpath not in self.log_files:
+                self._discover(fpath)
+                continue
+            self._schedule_file(fpath)
+
+    @keeprunning(MULTILINE_FLUSH_INTERVAL, on_error=util.log_exception)
+    def flush_idle_records(self):
+        # Files holding back a record for too long are read again, which
+        # sends the record
+        time.sleep(self.MULTILINE_FLUSH_INTERVAL / 2.0)
+        now = time.time()
+        for fpath, log_f in self.log_files.items():
+            assembler = log_f.get("assembler")
+            since = assembler.pending_since if assembler else None
+            if since is not None and now - since >= self.MULTILINE_FLUSH_INTERVAL:
+                self._schedule_file(fpath)
+                continue
 
-        >>> print(lc.fpaths)
-        file=/path/to/log_file.log:formatter=logagg.formatters.basescript
+            # Runs of repeats are sent once they went on for the dedup window
+            repeats = log_f.get("repeats")
+            since = repeats.pending_since if repeats else None
+            if since is not None and now - since >= self.dedup_window:
+                self._schedule_file(fpath)
+                continue
 
-        >>> print('formatters loaded:', lc.formatters)
-        {}
-        >>> print('log file reader threads started:', lc.log_reader_threads)
-        {}
-        >>> state = AttrDict(files_tracked=list())
-        >>> print('files bieng tracked:', state.files_tracked)
-        []
+            # Files summing up metric logs are read again to send the
+            # summaries of intervals that ended
+            buf = self.interval_buffers.get(log_f.get("acks"))
+            if buf is not None and buf.due(now):
+                self._schedule_file(fpath)
+                continue
 
+            # Files idle for long are read again, which closes them until
+            # they change, so that idle files hold no file descriptor
+            freader = log_f.get("freader")
+            if freader is not None and freader.is_idle(now):
+                self._schedule_file(fpath)
 
-        >>> if not state.files_tracked:
-        >>>     lc._scan_fpatterns(state)
-        >>>     print('formatters loaded:', lc.formatters)
-        >>>     print('log file reader threads started:', lc.log_reader_threads)
-        >>>     print('files bieng tracked:', state.files_tracked)
+    @keeprunning(LOG_FILE_POLL_INTERVAL, on_error=util.log_exception)
+    def read_changed_files(self):
+        fpath = self.changed_files.get()
+        try:
+            self.collect_log_lines(self.log_files[fpath])
+        finally:
+            self._unschedule_file(fpath)
 
+    @keeprunning(0, on_error=util.log_exception)  # FIXME: what wait time var here?
+    def send_to_nsq(self, state):
+        dummy = isinstance(self.nsq_sender, type(util.DUMMY))
+        # Spilled logs being left to send, or sends in flight to confirm,
+        # do not wait on readers being idle
+        spilled = self.spill is not None and len(self.spill) > 0
+        timeout = self.NSQ_RETRY_INTERVAL if spilled else None
+        if not dummy and self.nsq_sender.nin_flight:
+            timeout = self.SEND_CONFIRM_INTERVAL
+
+        batches = self.flusher.get(timeout)
+        self.log.debug(
+            "got_msgs_from_mem_queue",
+            nbatches=len(batches),
+            nbytes=sum(b.nbytes for b in batches),
+        )
 
+        if not batches:
+            pass
+        elif dummy:
+            for b in batches:
+                for log in b.logs:
+                    self.log.info("final_log_format", log=log)
+            self.confirm_success(batches)
+        elif self.spill is None:
+            self.log.debug("trying_to_push_to_nsq", nbatches=len(batches))
+            for _batches in self.by_topic(batches).itervalues():
+                self.nsq_sender.send_async(_batches)
+        else:
+            for topic, _batches in self.by_topic(batches).iteritems():
+                self._send_or_spill(topic, self.nsq_sender.messages(_batches), state)
+            self.confirm_success(batches)
+
+        # Sends complete in any order but are confirmed in the order they
+        # were started
+        for _batches, seconds in [] if dummy else self.nsq_sender.completed():
+            self.log.debug("pushed_to_nsq", nbatches=len(_batches))
+            self.flusher.sent(seconds)
+            self.confirm_success(_batches)
+
+        if spilled:
+            self._drain_spill(state)
+
+    @staticmethod
+    def by_topic(batches):
+        """Batches grouped by the topic they go to, in the order the first
+        batch of each topic comes in
+
+        >>> from logagg.batchqueue import LogBatch
+        >>> batches = [LogBatch(None, topic=t) for t in (None, 'metrics', None)]
+        >>> [(t, len(b)) for t, b in LogCollector.by_topic(batches).iteritems()]
+        [(None, 2), ('metrics', 1)]
         """
+        topics = collections.OrderedDict()
+        for batch in batches:
+            topics.setdefault(batch.topic, []).append(batch)
+        return topics
+
+    def _send_or_spill(self, topic, msgs, state):
+        """Sends msgs to nsq, or to the spill when nsq is unavailable or
+        logs spilled earlier are still to be sent, keeping them in order.
+        Waits for nsq only when the spill is full."""
+        if not len(self.spill) and time.time() >= state.nsq_retry_ts:
+            ts = time.time()
+            if self.nsq_sender.try_send(msgs, topic):
+                self.flusher.sent(time.time() - ts)
+                return
+            state.nsq_retry_ts = time.time() + self.NSQ_RETRY_INTERVAL
+
+        # Spilled records start with the topic of their logs, empty for
+        # the topic of the sender
+        if self.spill.append("%s\n%s" % (topic or "", pack_messages(msgs))):
+            self.log.debug("spilled_logs", nmsgs=len(msgs), nspilled=len(self.spill))
+            return
+
+        self.log.warning("spill_full_waiting_for_nsq", nbytes=self.spill.nbytes)
+        self.nsq_sender.send(msgs, topic)
+
+    def _drain_spill(self, state):
+        """Sends spilled logs, oldest first, for up to SPILL_DRAIN_SECONDS"""
+        if time.time() < state.nsq_retry_ts:
+            return
+
+        deadline = time.time() + self.SPILL_DRAIN_SECONDS
+        nsent = 0
+        while time.time() < deadline:
+            data, cursor = self.spill.peek()
+            if data is None:
+                break
+            topic, data = data.split("\n", 1)
+            if not self.nsq_sender.try_send(unpack_messages(data), topic or None):
+                state.nsq_retry_ts = time.time() + self.NSQ_RETRY_INTERVAL
+                break
+            self.spill.advance(cursor)
+            nsent += 1
+
+        if nsent:
+            self.log.info("sent_spilled_logs", nrecords=nsent, nspilled=len(self.spill))
+
+    def confirm_success(self, batches):
+        """Checkpoints, for all files at once, the offsets up to which all
+        the logs of each file were sent"""
+        files = collections.OrderedDict()
+        for batch in batches:
+            files.setdefault(batch.acks, []).append(batch)
+
+        for acks, _batches in files.iteritems():
+            position = acks.ack(_batches)
+            if position is not None:
+                acks.freader.checkpoint(position)
+
+        self.checkpoints.commit()
+
+    def _parse_fpatterns(self):
+        """
+        >>> lc = LogCollector(['file=/var/log/*/app-*.log:formatter=logagg.formatters.basescript'], 30)
+        >>> [(p.prefix, f) for p, f in lc._parse_fpatterns()]
+        [('/var/log', 'logagg.formatters.basescript')]
+        """
+        fpatterns = []
         for f in self.fpaths:
             fpattern, formatter = (a.split("=")[1] for a in f.split(":", 1))
-            self.log.debug("scan_fpatterns", fpattern=fpattern, formatter=formatter)
-            # TODO code for scanning fpatterns for the files not yet present goes here
-            fpaths = glob.glob(fpattern)
-            # Load formatter_fn if not in list
-            fpaths = list(set(fpaths) - set(state.files_tracked))
-            for fpath in fpaths:
-                try:
-                    formatter_fn = self.formatters.get(
-                        formatter, load_formatter_fn(formatter)
-                    )
-                    self.log.info("found_formatter_fn", fn=formatter)
-                    self.formatters[formatter] = formatter_fn
-                except (SystemExit, KeyboardInterrupt):
-                    raise
-                except (ImportError, AttributeError):
-                    self.log.exception("formatter_fn_not_found", fn=formatter)
-                    sys.exit(-1)
-                # Start a thread for every file
-                self.log.info("found_log_file", log_file=fpath)
-                log_f = dict(
-                    fpath=fpath,
-                    fpattern=fpattern,
-                    formatter=formatter,
-                    formatter_fn=formatter_fn,
-                )
-                log_key = (fpath, fpattern, formatter)
-                if log_key not in self.log_reader_threads:
-                    self.log.info("starting_collect_log_lines_thread", log_key=log_key)
-                    # There is no existing thread tracking this log file. Start one
-                    log_reader_thread = util.start_daemon_thread(
-                        self.collect_log_lines, (log_f,)
-                    )
-                    self.log_reader_threads[log_key] = log_reader_thread
-                state.files_tracked.append(fpath)
+            fpatterns.append((FilePattern(fpattern), formatter))
+        return fpatterns
+
+    def _track_file(self, fpath, fpattern, formatter):
+        if fpath in self.log_files:
+            return
+
+        # Load formatter_fn if not in list
+        try:
+            formatter_fn = self.get_formatter_fn(formatter)
+            self.log.info("found_formatter_fn", fn=formatter)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except (ImportError, AttributeError):
+            self.log.exception("formatter_fn_not_found", fn=formatter)
+            sys.exit(-1)
+
+        self.log.info("tailing_log_file", log_file=fpath)
+        self.log_files[fpath] = dict(
+            fpath=fpath,
+            fpattern=fpattern,
+            formatter=formatter,
+            formatter_fn=formatter_fn,
+        )
+        self.tailer.add(fpath)
+
+    def _add_fpattern(self, fpattern, formatter):
+        """Watches the directories matching files of fpattern can appear
+        in and tracks the files already there. Returns whether all those
+        directories are watched.
+
+        >>> import tempfile, shutil
+        >>> d = tempfile.mkdtemp()
+        >>> os.mkdir(os.path.join(d, 'web'))
+        >>> open(os.path.join(d, 'web', 'app.log'), 'w').close()
+        >>> lc = LogCollector(['file=%s/*/*.log:formatter=logagg.formatters.basescript' % d], 30)
+        >>> lc.fpatterns = lc._parse_fpatterns()
+        >>> [lc._add_fpattern(p, f) for p, f in lc.fpatterns]
+        [True]
+        >>> [os.path.relpath(f, d) for f in lc.log_files]
+        ['web/app.log']
+
+        Files showing up later are found from the tailer's events
+
+        >>> os.mkdir(os.path.join(d, 'db'))
+        >>> open(os.path.join(d, 'db', 'app.log'), 'w').close()
+        >>> for _ in range(3):
+        ...     for path in lc.tailer.wait(timeout=0.1):
+        ...         lc._discover(path)
+        >>> sorted(os.path.relpath(f, d) for f in lc.log_files)
+        ['db/app.log', 'web/app.log']
+
+        >>> lc.tailer.close()
+        >>> shutil.rmtree(d)
+        """
+        watched = True
+        for dpath in fpattern.glob_dirs():
+            watched = self.tailer.add_dir(dpath) and watched
+
+        for fpath in fpattern.glob_files():
+            self._track_file(fpath, fpattern.pattern, formatter)
+
+        return watched
+
+    def _discover(self, path):
+        """Tracks `path`, created in a watched directory, if it matches
+        an fpattern or watches it if it is a directory leading to them"""
+        for fpattern, formatter in self.fpatterns:
+            if fpattern.match(path):
+                if os.path.isfile(path):
+                    self._track_file(path, fpattern.pattern, formatter)
+                    return
+            elif fpattern.match_dir(path) and os.path.isdir(path):
+                # Files may have been created in it before it got watched
+                self._add_fpattern(fpattern, formatter)
+
+    @keeprunning(SCAN_FPATTERNS_INTERVAL, on_error=util.log_exception)
+    def _scan_fpatterns(self, state):
+        """
+        Globs the fpatterns whose directories are not all watched, which
+        is every fpattern when inotify is unavailable. Files matching
+        watched fpatterns are found as they get created by `_discover`.
+        """
+        for fpattern, formatter in self.fpatterns:
+            watched = state.watched.get(fpattern.pattern)
+            if watched and fpattern.prefix in self.tailer.dirs:
+                continue
+
+            self.log.debug(
+                "scan_fpatterns", fpattern=fpattern.pattern, formatter=formatter
+            )
+            state.watched[fpattern.pattern] = self._add_fpattern(fpattern, formatter)
         time.sleep(self.SCAN_FPATTERNS_INTERVAL)
 
     @keeprunning(HEARTBEAT_RESTART_INTERVAL, on_error=util.log_exception)
     def send_heartbeat(self, state):
         # Sends continuous heartbeats to a seperate topic in nsq
-        if self.log_reader_threads:
-            for f in self.log_reader_threads:
-                files_tracked = self.log_reader_threads.keys()
-        else:
-            files_tracked = ""
+        files_tracked = [
+            (f["fpath"], f["fpattern"], f["formatter"]) for f in self.log_files.values()
+        ]
 
         heartbeat_payload = {
             "host": self.HOST,
@@ -451,16 +996,39 @@ class LogCollector(object):
             "timestamp": time.time(),
             "nsq_topic": self.nsq_sender.topic_name,
             "files_tracked": files_tracked,
+            "flush_stats": self.flusher.stats,
+            "queue_depths": dict(
+                (name, nbytes) for name, _, nbytes in self.queue.depths()
+            ),
         }
         self.nsq_sender.handle_heartbeat(heartbeat_payload)
         state.heartbeat_number += 1
         time.sleep(self.heartbeat_interval)
 
     def start(self):
-        state = AttrDict(files_tracked=list())
+        if self.checkpoints is None:
+            self.checkpoints = CheckpointJournal(self.CHECKPOINT_FPATH, log=self.log)
+
+        # Fork the backfill and parse workers before any other thread is running
+        if self.backfill_workers:
+            self.backfill_pool = multiprocessing.Pool(
+                self.backfill_workers, backfill.init_worker, (self,)
+            )
+        if self.parse_workers:
+            self.parse_pool = multiprocessing.Pool(
+                self.parse_workers, backfill.init_worker, (self,)
+            )
+
+        self.fpatterns = self._parse_fpatterns()
+        state = AttrDict(watched=dict())
         util.start_daemon_thread(self._scan_fpatterns, (state,))
 
-        state = AttrDict(last_push_ts=time.time())
+        util.start_daemon_thread(self.tail_files)
+        util.start_daemon_thread(self.flush_idle_records)
+        for _ in range(self.NUM_READER_THREADS):
+            util.start_daemon_thread(self.read_changed_files)
+
+        state = AttrDict(nsq_retry_ts=0)
         util.start_daemon_thread(self.send_to_nsq, (state,))
 
         state = AttrDict(heartbeat_number=0)
@@ -2,25 +2,87 @@ from nsq.reader import Reader
 from basescript import BaseScript
 from logagg.collector import LogCollector
 from logagg.forwarder import LogForwarder
-from logagg.nsqsender import NSQSender
+from logagg.nsqsender import NSQSender, CODECS
+from logagg.nsqtcp import NSQTCPSender
+from logagg.nsqpool import NSQPool
+from logagg.checkpoint import CheckpointJournal
+from logagg.spill import SpillLog
+from logagg.routing import parse_route
+from logagg.rules import parse_rule
+from logagg.sampling import parse_limit
+from logagg.aggregate import parse_aggregation
+from logagg.templates import parse_miner
 from logagg import util
 
 
 class LogaggCommand(BaseScript):
     DESC = "Logagg command line tool"
 
+    def _nsq_sender(self):
+        args = self.args
+        tcp_locs = args.nsqd_tcp_address or []
+        http_locs = args.nsqd_http_address or []
+        if tcp_locs and http_locs and len(tcp_locs) != len(http_locs):
+            raise SystemExit(
+                "--nsqd-http-address is to name the http address of every "
+                "nsqd of --nsqd-tcp-address, in the same order"
+            )
+
+        # (tcp address, http address) of each nsqd, either may be None
+        nodes = map(None, tcp_locs, http_locs)
+
+        common = (args.nsqtopic, args.depth_limit_at_nsq, self.log)
+        kwargs = dict(
+            max_in_flight=args.nsq_max_in_flight, envelope_codec=args.envelope_codec
+        )
+        if args.nsqlookupd_http_address or len(nodes) > 1:
+            return NSQPool(
+                *common,
+                nodes=nodes,
+                lookupd_http_addresses=args.nsqlookupd_http_address or (),
+                **kwargs
+            )
+        if not nodes:
+            return util.DUMMY
+
+        tcp_loc, http_loc = nodes[0]
+        if tcp_loc:
+            return NSQTCPSender(tcp_loc, *common, http_loc=http_loc, **kwargs)
+        return NSQSender(http_loc, *common, **kwargs)
+
     def collect(self):
-        if not self.args.nsqd_http_address:
-            nsq_sender = util.DUMMY
-        else:
-            nsq_sender = NSQSender(
-                self.args.nsqd_http_address,
-                self.args.nsqtopic,
-                self.args.depth_limit_at_nsq,
-                self.log,
+        if self.args.mine_templates and not self.args.envelope_codec:
+            raise SystemExit(
+                "--mine-templates needs --envelope-codec, so that the templates "
+                "go in the nsq messages of the logs using them"
+            )
+
+        spill = None
+        nsq_sender = self._nsq_sender()
+        if nsq_sender is not util.DUMMY and self.args.spill_dir:
+            spill = SpillLog(
+                self.args.spill_dir, max_nbytes=self.args.spill_max_nbytes, log=self.log
             )
+        checkpoints = CheckpointJournal(
+            self.args.checkpoint_file, fsync=self.args.checkpoint_fsync, log=self.log
+        )
         collector = LogCollector(
-            self.args.file, self.args.heartbeat_interval, nsq_sender, self.log
+            self.args.file,
+            self.args.heartbeat_interval,
+            nsq_sender,
+            self.log,
+            backfill_workers=self.args.backfill_workers,
+            checkpoints=checkpoints,
+            parse_workers=self.args.parse_workers,
+            spill=spill,
+            max_latency=self.args.max_latency,
+            routes=[parse_route(r) for r in self.args.route or ()],
+            rules=[parse_rule(r) for r in self.args.rule or ()],
+            limits=[parse_limit("sample", s) for s in self.args.sample or ()]
+            + [parse_limit("rate-limit", r) for r in self.args.rate_limit or ()],
+            aggregations=[parse_aggregation(a) for a in self.args.aggregate or ()],
+            templates=[parse_miner(t) for t in self.args.mine_templates or ()],
+            dedup_window=self.args.dedup_window,
         )
         collector.start()
 
@@ -46,7 +108,12 @@ class LogaggCommand(BaseScript):
             max_in_flight=2500,
         )
 
-        forwarder = LogForwarder(nsq_receiver, targets, self.log)
+        forwarder = LogForwarder(
+            nsq_receiver,
+            targets,
+            self.log,
+            expand_templates=not self.args.keep_templates,
+        )
         forwarder.start()
 
     def define_subcommands(self, subcommands):
@@ -72,10 +139,85 @@ class LogaggCommand(BaseScript):
             default="test_topic",
             help="Topic name to publish messages. Ex: logs_and_metrics",
         )
+        collect_cmd.add_argument(
+            "--route",
+            nargs="+",
+            help="Sends the logs matching a route to its topic instead of "
+            "--nsqtopic, the first route matched winning. Logs are matched by "
+            "type, event, level, formatter or file glob, "
+            "format: topic=<topic>:<field>=<value>[,<value>...]..., "
+            "eg: topic=metrics:type=metric topic=nginx:file=/var/log/nginx/*.log",
+        )
+        collect_cmd.add_argument(
+            "--rule",
+            nargs="+",
+            help="Changes the formatted logs matching a rule, in order, before "
+            "they are sent. Logs are matched as by --route, actions are drop, "
+            "keep=<data keys>, hash=<data keys>, redact=<data keys> and drop_raw, "
+            "format: <field>=<value>[,<value>...]:...:<action>[=<key>[,<key>...]]..., "
+            "eg: formatter=logagg.formatters.haproxy:drop_raw:hash=_headers "
+            "event=healthcheck:drop",
+        )
+        collect_cmd.add_argument(
+            "--sample",
+            nargs="+",
+            help="Keeps the logs matching a sample, as by --route, with "
+            "probability <rate>. Logs kept carry data.sample_rate, "
+            "format: <field>=<value>[,<value>...]:...:rate=<rate>, "
+            "eg: file=/var/log/app/debug.log:rate=0.01",
+        )
+        collect_cmd.add_argument(
+            "--rate-limit",
+            nargs="+",
+            help="Keeps about <rate> logs a second, per file or per event, of "
+            "those matching the limit, sampling the rest. Logs kept carry "
+            "data.sample_rate and a logs_rate_limited metric tells what was "
+            "dropped. Limits on files and formatters only apply before lines "
+            "are parsed, format: <field>=<value>[,<value>...]:...:rate=<rate>"
+            "[:burst=<logs>][:per=file|event], eg: file=/var/log/app/*.log:rate=1000",
+        )
+        collect_cmd.add_argument(
+            "--aggregate",
+            nargs="+",
+            help="Sums up the metric logs matching an aggregation, as by "
+            "--route, over intervals, sending one log per event and values "
+            "of the tags with the count, sum, min and max of each numeric "
+            "field, and a histogram and quantiles of timings, "
+            "format: <field>=<value>[,<value>...]:...[:interval=<seconds>]"
+            "[:tags=<field>,...][:timings=<field>,...], "
+            "eg: formatter=logagg.formatters.haproxy:interval=10:tags=status,backend",
+        )
+        collect_cmd.add_argument(
+            "--mine-templates",
+            nargs="+",
+            help="Clusters the messages of the logs matching a miner, as by "
+            "--route, into templates and ships them as a template id and "
+            "parameters, the templates being sent ahead as logs of type "
+            "template in each envelope, which needs --envelope-codec. "
+            "The message is the key of data named by field, "
+            "message by default, or the event, "
+            "format: <field>=<value>[,<value>...]:...[:field=<key>|event]"
+            "[:similarity=<fraction>], "
+            "eg: formatter=logagg.formatters.basescript:field=event",
+        )
         collect_cmd.add_argument(
             "--nsqd-http-address",
-            nargs="?",
-            help="nsqd http address where we send the messages, eg. localhost:4151",
+            nargs="+",
+            help="nsqd http address where we send the messages, eg. localhost:4151. "
+            "Given many, messages are spread across them",
+        )
+        collect_cmd.add_argument(
+            "--nsqd-tcp-address",
+            nargs="+",
+            help="nsqd tcp address messages are published to with MPUB instead "
+            "of over http, eg. localhost:4150. The depth of the topic is only "
+            "watched when --nsqd-http-address is given too",
+        )
+        collect_cmd.add_argument(
+            "--nsqlookupd-http-address",
+            nargs="+",
+            help="nsqlookupd http address the nsqd nodes to send to are looked "
+            "up from, eg. localhost:4161. Messages are spread across them",
         )
         collect_cmd.add_argument(
             "--depth-limit-at-nsq",
@@ -83,6 +225,21 @@ class LogaggCommand(BaseScript):
             default=10000000,
             help="To limit the depth at nsq topic",
         )
+        collect_cmd.add_argument(
+            "--nsq-max-in-flight",
+            type=int,
+            default=NSQSender.MAX_IN_FLIGHT,
+            help="Number of mpub requests sent to nsq at once, to each nsqd when "
+            "sending to many. Offsets are checkpointed only once all the sends "
+            "before them completed",
+        )
+        collect_cmd.add_argument(
+            "--envelope-codec",
+            choices=sorted(CODECS),
+            help="Packs many logs into each nsq message, compressed with the "
+            "codec, instead of sending one message per log. The forwarder "
+            "unpacks them",
+        )
         collect_cmd.add_argument(
             "--heartbeat-interval",
             type=int,
@@ -90,6 +247,60 @@ class LogaggCommand(BaseScript):
             help='Time interval at which regular heartbeats to a nsqTopic \
                     "heartbeat" to know which hosts are running logagg',
         )
+        collect_cmd.add_argument(
+            "--backfill-workers",
+            type=int,
+            default=0,
+            help="Number of processes used to parse big unread parts of "
+            "log files in parallel, eg. after a downtime. 0 disables backfill",
+        )
+        collect_cmd.add_argument(
+            "--parse-workers",
+            type=int,
+            default=0,
+            help="Number of processes formatting the records read from log "
+            "files, to use more than one core. 0 formats them in the collector",
+        )
+        collect_cmd.add_argument(
+            "--checkpoint-file",
+            default=LogCollector.CHECKPOINT_FPATH,
+            help="Journal to which the offsets of all collected files are saved",
+        )
+        collect_cmd.add_argument(
+            "--checkpoint-fsync",
+            choices=CheckpointJournal.FSYNC_POLICIES,
+            default="interval",
+            help="When to fsync the checkpoint journal: on every commit, "
+            "at most once a second or never",
+        )
+        collect_cmd.add_argument(
+            "--max-latency",
+            type=float,
+            default=LogCollector.MAX_SECONDS_TO_PUSH,
+            help="Longest time in seconds a log read waits to be sent. Logs "
+            "are sent right away unless they come in faster than they are sent",
+        )
+        collect_cmd.add_argument(
+            "--spill-dir",
+            help="Directory logs are spilled to while nsq is unavailable, "
+            "so that files keep being read. Not given waits for nsq",
+        )
+        collect_cmd.add_argument(
+            "--spill-max-nbytes",
+            type=int,
+            default=SpillLog.MAX_NBYTES,
+            help="Disk space the spilled logs may take, beyond which the "
+            "collector waits for nsq",
+        )
+        collect_cmd.add_argument(
+            "--dedup-window",
+            type=float,
+            default=0,
+            help="Seconds for which consecutive records of a file that are "
+            "identical, or identical apart from their timestamp, are sent as "
+            "one log with their count and first and last timestamps, "
+            "0 sends each of them",
+        )
 
         forward_cmd = subcommands.add_parser(
             "forward",
@@ -118,6 +329,13 @@ class LogaggCommand(BaseScript):
             'format: "forwarder=<forwarder-classpath>:host=<hostname>:port=<port-number>:user=<user-name>:password=<password>:db=<database-name>:collection=<collection-name>",'
             "Ex: forwarder=logagg.forwarders.MongoDBForwarder:host=localhost:port=27017:user=some_user:password=xxxxx:db=logagg:collection=cluster_logs_and_metrics",
         )
+        forward_cmd.add_argument(
+            "--keep-templates",
+            action="store_true",
+            help="Stores the logs shipped as template ids and parameters as "
+            "they are, rather than rebuilding their messages, the templates "
+            "being stored as logs of type template",
+        )
 
 
 def main():
@@ -0,0 +1,214 @@
+import time
+import ujson as json
+
+from logagg import util
+from logagg.reader import RecordAssembler
+
+
+class _PendingRecord(object):
+    __slots__ = ("lines", "nbytes", "fmtfn", "fields", "start", "since")
+
+    def __init__(self, line, fmtfn, fields, start):
+        self.lines = [line]
+        self.nbytes = len(line)
+        self.fmtfn = fmtfn
+        self.fields = fields
+        # Offset of the envelope the record starts in
+        self.start = start
+        self.since = time.time()
+
+
+class DockerLogDemuxer(object):
+    """Reassembles the records of a file written by the docker file log
+    driver, where every line is a JSON envelope holding one line output
+    by a container.
+
+    Envelopes are decoded once. Lines are grouped by the container and
+    stream they come from, each group joining partial lines into records
+    on its own, so that tracebacks of containers logging at the same time
+    are not mixed up. The formatter named by a line is loaded through
+    `load_formatter`, which is expected to cache them.
+
+    Has the interface of RecordAssembler, records being handed out as
+    (line, fmtfn, fields) tuples, `fields` overriding the default values
+    of the log. As records of other streams may still be held back, the
+    position handed out with a record is the start of the oldest envelope
+    not fully handed out yet.
+
+    >>> from logagg.collector import load_formatter_fn
+    >>> def envelope(cid, msg, stream='stdout'):
+    ...     return json.dumps(dict(container_id=cid, stream=stream, msg=msg))
+    >>> def message(text):
+    ...     return json.dumps(dict(message=text, host='h', timestamp='t',
+    ...                            extra=dict(formatter='logagg.formatters.mongodb')))
+
+    >>> d = DockerLogDemuxer(load_formatter_fn)
+    >>> lines = [envelope('a', 'Traceback:'), envelope('b', 'started'),
+    ...          envelope('a', '  File "x.py"'), envelope('b', 'ready'),
+    ...          envelope('a', 'ValueError')]
+    >>> data = '\\n'.join(lines)
+    >>> ends = [sum(len(l) + 1 for l in lines[:i + 1]) for i in range(len(lines))]
+    >>> out = list(d.feed(data, 7, 0))
+    >>> [(line, fmtfn, fields) for (line, fmtfn, fields), _ in out]
+    [(u'started', None, None), (u'Traceback:\\n  File "x.py"', None, None)]
+    >>> [p[1] for _, p in out] == [0, ends[2]]
+    True
+
+    >>> out = list(d.flush())
+    >>> [line for (line, _, _), _ in out]
+    [u'ready', u'ValueError']
+    >>> [p[1] for _, p in out] == [ends[3], ends[4]]
+    True
+
+    Messages naming a formatter are formatted with it
+
+    >>> out = list(d.feed(envelope('a', message('2017-08-17 I REPL [x] up')), 7, 10))
+    >>> out += list(d.flush())
+    >>> (line, fmtfn, fields), _ = out[0]
+    >>> line, fmtfn.__name__, sorted(fields.items())
+    (u'2017-08-17 I REPL [x] up', 'mongodb', [('formatter', u'logagg.formatters.mongodb'), ('host', u'h'), ('raw', u'2017-08-17 I REPL [x] up'), ('timestamp', u't')])
+
+    Messages longer than `max_nbytes` are handed out in pieces
+
+    >>> d = DockerLogDemuxer(load_formatter_fn, max_nbytes=12)
+    >>> out = list(d.feed(envelope('a', '0123456789abcdefghij'), 7, 0))
+    >>> out += list(d.flush())
+    >>> [(line, p[1]) for (line, _, _), p in out]
+    [(u'0123456[...]', 0), (u'789abcd[...]', 0), (u'efghij', 68)]
+    """
+
+    CONTAINER_KEYS = ("container_id", "container_name")
+    STREAM_KEYS = ("stream", "source")
+
+    def __init__(self, load_formatter, max_nbytes=RecordAssembler.MAX_NBYTES):
+        self.load_formatter = load_formatter
+        self.max_nbytes = max_nbytes
+
+        # (container, stream) -> record being assembled for it
+        self.pending = {}
+        self.inode = None
+        # Offset right after the last envelope fed
+        self.end = 0
+
+    @property
+    def pending_since(self):
+        if not self.pending:
+            return None
+        return min(p.since for p in self.pending.itervalues())
+
+    def _first(self, envelope, keys):
+        for k in keys:
+            v = envelope.get(k)
+            if v is not None:
+                return v
+        return None
+
+    def decode(self, line):
+        """Returns (key, text, fmtfn, fields) for an envelope. `fmtfn` is
+        None for messages not naming a formatter, complete records are
+        returned with their log values in `fields`."""
+        envelope = json.loads(line)
+        key = (
+            self._first(envelope, self.CONTAINER_KEYS),
+            self._first(envelope, self.STREAM_KEYS),
+        )
+        msg = envelope.get("msg", "")
+
+        log = None
+        # Plain text is not decoded again, which would raise and catch an
+        # error for every line
+        if msg[:1] == "{":
+            try:
+                log = json.loads(msg)
+            except ValueError:
+                pass
+        if not isinstance(log, dict):
+            # Plain text output of the container
+            return key, msg, None, None
+
+        formatter = (log.get("extra") or {}).get("formatter")
+        if not formatter:
+            return key, msg, None, dict(timestamp=log.get("timestamp"), data=log)
+
+        text = log.get("message") or ""
+        fields = dict(
+            formatter=formatter,
+            raw=text,
+            host=log.get("host"),
+            timestamp=log.get("timestamp"),
+        )
+        return key, text, self.load_formatter(formatter), fields
+
+    def _position(self, end):
+        starts = [p.start for p in self.pending.itervalues()]
+        return self.inode, min(starts + [end])
+
+    def _record(self, p, split=False):
+        line = "\n".join(p.lines)
+        if split:
+            line += RecordAssembler.SPLIT_MARKER
+        if p.fields is not None:
+            p.fields["raw"] = line
+        return line, p.fmtfn, p.fields
+
+    def feed(self, data, inode, offset):
+        if inode != self.inode:
+            for r in self.flush():
+                yield r
+            self.inode = inode
+
+        pos = offset
+        for line in data.split("\n"):
+            start = pos
+            pos += len(line) + 1
+            self.end = pos
+
+            try:
+                key, text, fmtfn, fields = self.decode(line)
+            except (ValueError, TypeError, AttributeError):
+                # Not an envelope, pass the line on as is
+                key, text, fmtfn, fields = None, line, None, None
+
+            done = []
+            p = self.pending.get(key)
+            if p is not None:
+                ispartial = (p.fmtfn or util).ispartial
+                if p.fmtfn is fmtfn and ispartial(text.partition("\n")[0]):
+                    if p.nbytes + len(text) < self.max_nbytes:
+                        p.lines.append(text)
+                        p.nbytes += len(text) + 1
+                        p.since = time.time()
+                        continue
+                    done.append(self._record(p, split=True))
+                else:
+                    done.append(self._record(p))
+                del self.pending[key]
+
+            if fields is not None and fmtfn is None:
+                # A structured message, complete by itself
+                done.append((text, None, fields))
+            else:
+                # Messages too long for one record are handed out in pieces
+                n = self.max_nbytes - len(RecordAssembler.SPLIT_MARKER)
+                while len(text) > self.max_nbytes:
+                    piece = text[:n] + RecordAssembler.SPLIT_MARKER
+                    done.append(
+                        (
+                            piece,
+                            fmtfn,
+                            None if fields is None else dict(fields, raw=piece),
+                        )
+                    )
+                    text = text[n:]
+                self.pending[key] = _PendingRecord(text, fmtfn, fields, start)
+
+            position = self._position(pos)
+            for record in done:
+                yield record, position
+
+    def flush(self):
+        """Yields all the records held back, oldest first"""
+        pending = sorted(self.pending.iteritems(), key=lambda kv: kv[1].start)
+        for key, p in pending:
+            del self.pending[key]
+            yield self._record(p), self._position(self.end)
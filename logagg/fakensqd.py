@@ -0,0 +1,143 @@
+import socket
+import threading
+import collections
+import SocketServer
+
+from logagg.nsqsender import unpack_messages, UINT32
+
+FRAME_RESPONSE = 0
+FRAME_ERROR = 1
+HEARTBEAT = "_heartbeat_"
+
+
+def frame(frame_type, data):
+    """A frame as nsqd sends it, sized to hold its type and data"""
+    return UINT32.pack(len(data) + 4) + UINT32.pack(frame_type) + data
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.lock = threading.Lock()
+        self.server.nsqd._connected(self)
+
+    def finish(self):
+        self.server.nsqd._disconnected(self)
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def send(self, frame_type, data):
+        with self.lock:
+            self.request.sendall(frame(frame_type, data))
+
+    def _read_body(self):
+        (size,) = UINT32.unpack(self.rfile.read(UINT32.size))
+        return self.rfile.read(size)
+
+    def handle(self):
+        nsqd = self.server.nsqd
+        if self.rfile.read(4) != "  V2":
+            return
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.rstrip("\n").split(" ")
+            name, args = command[0], command[1:]
+
+            if name == "NOP":
+                nsqd.nops += 1
+                continue
+
+            if name == "IDENTIFY":
+                self._read_body()
+                messages = None
+            elif name == "PUB":
+                messages = [self._read_body()]
+            elif name == "MPUB":
+                messages = unpack_messages(self._read_body())
+            else:
+                self.send(FRAME_ERROR, "E_INVALID invalid command %s" % name)
+                return
+
+            error, nsqd.fail_next = nsqd.fail_next, None
+            if error is not None:
+                self.send(FRAME_ERROR, error)
+                continue
+
+            if messages is not None:
+                nsqd.messages[args[0]].extend(messages)
+            self.send(FRAME_RESPONSE, "OK")
+
+
+class _Server(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeNSQD(object):
+    """Stands in for nsqd in tests, speaking enough of its TCP protocol to
+    publish to. Messages published are kept per topic in `messages`.
+
+    >>> nsqd = FakeNSQD(); nsqd.start()
+    >>> s = socket.create_connection(nsqd.address.split(':'))
+    >>> s.sendall('  V2' + 'PUB logs\\n' + UINT32.pack(1) + 'a')
+    >>> s.recv(64) == frame(FRAME_RESPONSE, 'OK')
+    True
+    >>> nsqd.messages['logs']
+    ['a']
+    >>> s.close(); nsqd.stop()
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.server = _Server((host, port), _Handler)
+        self.server.nsqd = self
+        self.address = "%s:%d" % self.server.server_address
+
+        # topic -> messages published to it
+        self.messages = collections.defaultdict(list)
+        # Error frame the next command that expects a response gets
+        self.fail_next = None
+        self.nconnections = 0
+        self.nops = 0
+
+        self._handlers = set()
+        self._lock = threading.Lock()
+
+    def _connected(self, handler):
+        with self._lock:
+            self._handlers.add(handler)
+            self.nconnections += 1
+
+    def _disconnected(self, handler):
+        with self._lock:
+            self._handlers.discard(handler)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def heartbeat(self):
+        """Sends a heartbeat to every client, as nsqd does periodically"""
+        with self._lock:
+            handlers = list(self._handlers)
+        for h in handlers:
+            h.send(FRAME_RESPONSE, HEARTBEAT)
+
+    def drop_connections(self):
+        with self._lock:
+            handlers = list(self._handlers)
+        for h in handlers:
+            try:
+                h.request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def stop(self):
+        self.drop_connections()
+        self.server.shutdown()
+        self.server.server_close()
@@ -2,6 +2,8 @@ import re
 import ujson as json
 import datetime
 
+from logagg.dockerlog import DockerLogDemuxer
+
 
 class RawLog(dict):
     pass
@@ -22,6 +24,11 @@ def docker_file_log_driver(line):
     return dict(timestamp=log.get("timestamp"), data=log, type="log")
 
 
+# Files of the docker log driver are read through a demuxer that decodes
+# each envelope once and reassembles records per container and stream
+docker_file_log_driver.demuxer = DockerLogDemuxer
+
+
 HAPROXY_HEADERS = re.compile(r"{(.*)} ")
 
 
@@ -466,6 +473,12 @@ def elasticsearch_ispartial_log(line):
     True
     >>> elasticsearch_ispartial_log(line3)
     True
+
+    >>> from logagg.util import split_records
+    >>> split_records('\\n'.join([line1, line2, line3, line1]),
+    ...     elasticsearch_ispartial_log) == [
+    ...         '\\n'.join([line1, line2, line3]), line1]
+    True
     """
     match_result = []
 
@@ -475,4 +488,7 @@ def elasticsearch_ispartial_log(line):
     return True
 
 
+# A line starting (after optional whitespace) with "[" begins a new record
+elasticsearch_ispartial_log.boundary = re.compile(r"\n(?=[^\S\n]*\[)")
+
 elasticsearch.ispartial = elasticsearch_ispartial_log
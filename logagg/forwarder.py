@@ -5,6 +5,8 @@ from copy import deepcopy
 from multiprocessing.pool import ThreadPool
 
 from logagg import util
+from logagg.nsqsender import envelope_nrecords, unpack_envelope
+from logagg.templates import TemplateCache
 import ujson as json
 
 
@@ -20,12 +22,15 @@ class LogForwarder(object):
 
     WAIT_TIME_TARGET_FAILURE = 2
 
-    def __init__(self, message_source, targets, log=util.DUMMY):
+    def __init__(self, message_source, targets, log=util.DUMMY, expand_templates=True):
 
         self.message_source = message_source
         self.targets = targets
         self.log = log
         self._pool = ThreadPool()
+        # Rebuilds the messages shipped as template ids and parameters,
+        # None stores them as they are along with the templates
+        self.templates = TemplateCache() if expand_templates else None
 
     def start(self):
 
@@ -52,12 +57,15 @@ class LogForwarder(object):
 
     def read_from_q(self):
         msgs = []
+        # Log records the messages hold, envelopes holding many
+        nrecords = 0
         last_push_ts = time.time()
 
         while True:
             try:
                 msg = self.msgqueue.get(block=True, timeout=self.QUEUE_TIMEOUT)
                 msgs.append(msg)
+                nrecords += envelope_nrecords(msg.body)
 
             except Queue.Empty:
                 time.sleep(self.QUEUE_EMPTY_SLEEP_TIME)
@@ -66,7 +74,7 @@ class LogForwarder(object):
             cur_ts = time.time()
             time_since_last_push = cur_ts - last_push_ts
 
-            is_msg_limit_reached = len(msgs) >= self.MAX_MESSAGES_TO_PUSH
+            is_msg_limit_reached = nrecords >= self.MAX_MESSAGES_TO_PUSH
             is_max_time_elapsed = time_since_last_push >= self.MAX_SECONDS_TO_PUSH
 
             should_push = len(msgs) > 0 and (
@@ -81,6 +89,7 @@ class LogForwarder(object):
                     self.log.debug("ack_to_nsq_is_done_for_msgs", num_msgs=len(msgs))
 
                     msgs = []
+                    nrecords = 0
                     last_push_ts = time.time()
 
             except (SystemExit, KeyboardInterrupt):
@@ -108,9 +117,28 @@ class LogForwarder(object):
                 time.sleep(self.WAIT_TIME_TARGET_FAILURE)
                 # FIXME: also implement some sort of backoff sleep
 
+    def _expand_templates(self, msgs):
+        """Rebuilds the messages of logs from the templates learnt so far,
+        logs of templates not known yet being stored as they are. Returns
+        the logs without those defining templates."""
+        for m in msgs:
+            self.templates.learn(m)
+        msgs = [m for m in msgs if m.get("type") != "template"]
+
+        nunknown = 0
+        for m in msgs:
+            if not self.templates.expand(m):
+                nunknown += 1
+        if nunknown:
+            self.log.warning("log_templates_unknown", num_logs=nunknown)
+        return msgs
+
     def _write_messages(self, msgs):
         fn = self._send_msgs_to_target
-        msgs = [json.loads(m.body) for m in msgs]
+        # Envelopes are acked as one message, once all their records are written
+        msgs = [json.loads(r) for m in msgs for r in unpack_envelope(m.body)]
+        if self.templates is not None:
+            msgs = self._expand_templates(msgs)
 
         jobs = []
         for t in self.targets:
@@ -0,0 +1,303 @@
+import time
+import random
+import threading
+import ujson as json
+
+from deeputil import keeprunning
+from logagg import util
+from logagg.nsqsender import NSQSender
+from logagg.nsqtcp import NSQTCPSender
+
+
+class NSQNode(object):
+    """An nsqd the pool sends to, with how well it has been doing"""
+
+    SMOOTHING = 0.2  # Weight of the latest send in the average latency
+    MIN_EJECT_SECONDS = 1  # Time a node is left out after its first failure
+    MAX_EJECT_SECONDS = 60  # Longest time a failing node is left out
+
+    def __init__(self, sender, tcp_loc, http_loc):
+        self.sender = sender
+        self.locs = (tcp_loc, http_loc)
+        self.address = tcp_loc or http_loc
+        # Average seconds a send to the node took, None before the first
+        self.latency = None
+        # Nodes are probed before they are sent to
+        self.up = False
+        self.nfailures = 0
+        # When the node is probed again while it is down
+        self.probe_at = 0
+
+    def sent(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.SMOOTHING * (seconds - self.latency)
+
+    def failed(self):
+        self.up = False
+        self.nfailures += 1
+        eject_seconds = min(
+            self.MIN_EJECT_SECONDS * 2 ** (self.nfailures - 1), self.MAX_EJECT_SECONDS
+        )
+        self.probe_at = time.time() + eject_seconds
+        return eject_seconds
+
+    def recovered(self):
+        self.up = True
+        self.nfailures = 0
+
+
+class _PoolMonitor(object):
+    """The room nsq has for sends across the nodes up, as the least a send
+    has to be held back by any of them"""
+
+    POLL_INTERVAL = NSQSender.NSQ_READY_CHECK_INTERVAL
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    @property
+    def depth(self):
+        return dict((n.address, n.sender.monitor.depth) for n in self.pool.up_nodes())
+
+    def delay(self):
+        delays = [n.sender.monitor.delay() for n in self.pool.up_nodes()]
+        delays = [d for d in delays if d is not None]
+        if not delays:
+            # No node has room, or none is up and sends will fail anyway
+            return None if self.pool.up_nodes() else 0
+        return min(delays)
+
+
+class NSQPool(NSQSender):
+    """Sends to many nsqd nodes, given as (tcp address, http address) pairs
+    either of which may be None, or found through nsqlookupd.
+
+    Each send goes to a node up picked at random, weighted by how fast the
+    node has been taking sends and how far from full it is. A send that
+    fails is retried on the other nodes up and the node that failed is
+    left out for a while, longer each time it fails again, until a probe
+    finds it back. Sends in flight are spread across the nodes,
+    `max_in_flight` per node up.
+
+    >>> from logagg.fakensqd import FakeNSQD
+    >>> nsqd1, nsqd2 = FakeNSQD(), FakeNSQD()
+    >>> nsqd1.start(); nsqd2.start()
+    >>> pool = NSQPool('logs', 1000, nodes=[(nsqd1.address, None), (nsqd2.address, None)])
+    >>> for i in range(50):
+    ...     pool.send([str(i)])
+    >>> len(pool.up_nodes()), len(nsqd1.messages['logs']) > 0, len(nsqd2.messages['logs']) > 0
+    (2, True, True)
+
+    Sends go on when a node goes away
+
+    >>> nsqd2.stop()
+    >>> for i in range(50, 100):
+    ...     pool.send([str(i)])
+    >>> [n.up for n in pool.nodes]
+    [True, False]
+    >>> sorted(nsqd1.messages['logs'] + nsqd2.messages['logs'], key=int) == map(str, range(100))
+    True
+    >>> nsqd1.stop()
+    """
+
+    LOOKUP_INTERVAL = 30  # Seconds between asking nsqlookupd for the nodes
+    PROBE_INTERVAL = (
+        1
+    )  # How often nodes that are down are checked for being due a probe
+    NODES_URL = "http://%s/nodes"  # Url listing the nodes nsqlookupd knows of
+
+    def __init__(
+        self,
+        nsq_topic,
+        nsq_max_depth,
+        log=util.DUMMY,
+        max_in_flight=NSQSender.MAX_IN_FLIGHT,
+        envelope_codec=None,
+        nodes=(),
+        lookupd_http_addresses=(),
+    ):
+        super(NSQPool, self).__init__(
+            None, nsq_topic, nsq_max_depth, log, max_in_flight, envelope_codec
+        )
+        self.lookupd_http_addresses = lookupd_http_addresses
+        self.monitor = _PoolMonitor(self)
+
+        self.nodes = [self._make_node(tcp, http) for tcp, http in nodes]
+        # Nodes given, kept whatever nsqlookupd says
+        self.static_locs = [n.locs for n in self.nodes]
+        self._looked_up_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def max_in_flight(self):
+        return self.max_in_flight_per_node * max(1, len(self.up_nodes()))
+
+    @max_in_flight.setter
+    def max_in_flight(self, n):
+        self.max_in_flight_per_node = n
+
+    def _make_node(self, tcp_loc, http_loc):
+        args = (self.topic_name, self.nsq_max_depth, self.log)
+        kwargs = dict(max_in_flight=self.max_in_flight_per_node, ensure_topics=False)
+        if tcp_loc:
+            sender = NSQTCPSender(tcp_loc, *args, http_loc=http_loc, **kwargs)
+        else:
+            sender = NSQSender(http_loc, *args, **kwargs)
+        return NSQNode(sender, tcp_loc, http_loc)
+
+    def up_nodes(self):
+        return [n for n in self.nodes if n.up]
+
+    def _lookup(self):
+        """The (tcp address, http address) of the nodes nsqlookupd knows of"""
+        nodes = set()
+        for loc in self.lookupd_http_addresses:
+            url = self.NODES_URL % loc
+            data = self.session.get(url, timeout=self.REQUEST_TIMEOUT).json()
+            # nsqlookupd before 1.0 wraps its answers in "data"
+            for p in data.get("data", data)["producers"]:
+                host = p["broadcast_address"]
+                nodes.add(
+                    ("%s:%d" % (host, p["tcp_port"]), "%s:%d" % (host, p["http_port"]))
+                )
+        return nodes
+
+    def _update_nodes(self):
+        """Adds the nodes nsqlookupd found to the nodes given, and removes
+        those it no longer knows of. Finding no node at all is taken as
+        nsqlookupd not knowing yet, the nodes being kept.
+
+        >>> pool = NSQPool('logs', 1000, nodes=[('127.0.0.1:4150', None)],
+        ...                lookupd_http_addresses=['127.0.0.1:4161'])
+        >>> pool._lookup = lambda: set([('10.0.0.1:4150', '10.0.0.1:4151')])
+        >>> pool._update_nodes()
+        >>> [n.address for n in pool.nodes]
+        ['127.0.0.1:4150', '10.0.0.1:4150']
+        >>> pool._lookup = lambda: set()
+        >>> pool._update_nodes()
+        >>> [n.address for n in pool.nodes]
+        ['127.0.0.1:4150', '10.0.0.1:4150']
+        """
+        try:
+            found = self._lookup()
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception as e:
+            # The nodes known are kept while nsqlookupd cannot be reached
+            self.log.warning("nsqlookupd_unavailable", error=repr(e))
+            return
+        if not found:
+            self.log.warning("nsqlookupd_found_no_nodes")
+            return
+
+        # Nodes given are not added again when nsqlookupd finds them too
+        given = set(a for loc in self.static_locs for a in loc if a)
+        locs = self.static_locs + sorted(
+            loc for loc in found if not given.intersection(loc)
+        )
+
+        known = dict((n.locs, n) for n in self.nodes)
+        for loc in set(known) - set(locs):
+            self.log.info("nsqd_node_removed", address=known[loc].address)
+            known[loc].sender.monitor.stop()
+        for loc in locs:
+            if loc not in known:
+                self.log.info("nsqd_node_found", address=loc[0])
+                known[loc] = self._make_node(*loc)
+
+        self.nodes = [known[loc] for loc in locs]
+
+    def _probe(self, node):
+        try:
+            node.sender.ping()
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception as e:
+            self.log.warning(
+                "nsqd_node_probe_failed",
+                address=node.address,
+                error=repr(e),
+                retry_in=node.failed(),
+            )
+            return
+
+        node.sender._start_monitor()
+        node.recovered()
+        self.log.info("nsqd_node_up", address=node.address)
+
+    def _maintain(self):
+        """Looks the nodes up when it is time to, probing the nodes down
+        that are due a probe"""
+        with self._lock:
+            now = time.time()
+            if self.lookupd_http_addresses and (
+                self._looked_up_at is None
+                or now - self._looked_up_at >= self.LOOKUP_INTERVAL
+            ):
+                self._looked_up_at = now
+                self._update_nodes()
+
+            for node in self.nodes:
+                if not node.up and now >= node.probe_at:
+                    self._probe(node)
+
+    @keeprunning(PROBE_INTERVAL, on_error=util.log_exception)
+    def _maintain_forever(self):
+        self._maintain()
+        time.sleep(self.PROBE_INTERVAL)
+
+    def _start_monitor(self):
+        if self._thread is None:
+            self._maintain()
+            self._thread = util.start_daemon_thread(self._maintain_forever)
+
+    def _pick(self, exclude):
+        """A node up to send to, None when there is none"""
+        nodes, weights = [], []
+        for node in self.up_nodes():
+            delay = node.sender.monitor.delay()
+            if node in exclude or delay is None:
+                continue
+            # Nodes not sent to yet are tried right away
+            latency = node.latency if node.latency is not None else 0
+            nodes.append(node)
+            weights.append(1.0 / (latency + delay + 0.001))
+
+        r = random.random() * sum(weights)
+        for node, w in zip(nodes, weights):
+            r -= w
+            if r <= 0:
+                return node
+        return nodes[-1] if nodes else None
+
+    def _post_messages(self, msgs, topic_name):
+        self._start_monitor()
+        tried = set()
+        while True:
+            node = self._pick(tried)
+            if node is None:
+                raise Exception("no_nsqd_node_available")
+
+            ts = time.time()
+            try:
+                node.sender._post_messages(msgs, topic_name)
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception as e:
+                tried.add(node)
+                self.log.warning(
+                    "nsqd_node_failed",
+                    address=node.address,
+                    error=repr(e),
+                    retry_in=node.failed(),
+                )
+                continue
+
+            node.sent(time.time() - ts)
+            return
+
+    def handle_heartbeat(self, heartbeat):
+        self._send_messages([json.dumps(heartbeat)], topic_name=self.HEARTBEAT_TOPIC)
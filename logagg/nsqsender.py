@@ -1,9 +1,233 @@
 import time
+import zlib
+import struct
+import urllib
+import collections
 import ujson as json
+from multiprocessing.pool import ThreadPool
 
 import requests
+from requests.adapters import HTTPAdapter
 from deeputil import keeprunning
 from logagg import util
+from logagg.batchqueue import batch_logs
+
+
+UINT32 = struct.Struct(">I")
+
+
+def pack_messages(messages):
+    """Encodes messages the way nsq takes them in a binary mpub, as their
+    number followed by each one prefixed with its size
+
+    >>> data = pack_messages(['a', 'b\\nc'])
+    >>> data
+    '\\x00\\x00\\x00\\x02\\x00\\x00\\x00\\x01a\\x00\\x00\\x00\\x03b\\nc'
+    >>> unpack_messages(data)
+    ['a', 'b\\nc']
+    """
+    parts = [UINT32.pack(len(messages))]
+    for m in messages:
+        parts.append(UINT32.pack(len(m)))
+        parts.append(m)
+    return "".join(parts)
+
+
+def unpack_messages(data):
+    (n,) = UINT32.unpack_from(data)
+    messages, offset = [], UINT32.size
+    for _ in xrange(n):
+        (size,) = UINT32.unpack_from(data, offset)
+        offset += UINT32.size
+        messages.append(data[offset : offset + size])
+        offset += size
+    return messages
+
+
+ENVELOPE_MAGIC = "\x00envelope"  # Starts envelopes, log records never start with a NUL
+ENVELOPE_MAX_NBYTES = (
+    512 * 1024
+)  # Records packed in one envelope, below nsqd's max message size
+CODECS = {
+    "zlib": (lambda d: zlib.compress(d, 1), zlib.decompress),
+    "none": (str, str),
+}  # name -> (compress, decompress)
+
+
+def pack_envelopes(messages, codec="zlib", max_nbytes=ENVELOPE_MAX_NBYTES):
+    """Packs messages into as few envelopes as holding up to `max_nbytes`
+    of messages each takes. An envelope is one nsq message, a header naming
+    its codec and the number of messages it holds followed by the messages
+    packed as by `pack_messages` and compressed with the codec.
+
+    >>> envs = pack_envelopes(['{"a": 1}'] * 3, max_nbytes=16)
+    >>> len(envs), [envelope_nrecords(e) for e in envs]
+    (2, [2, 1])
+    >>> envs[0][:16]
+    '\\x00envelope zlib 2'
+    >>> unpack_envelope(envs[0])
+    ['{"a": 1}', '{"a": 1}']
+
+    Messages that are not envelopes are single records
+
+    >>> envelope_nrecords('{"a": 1}'), unpack_envelope('{"a": 1}')
+    (1, ['{"a": 1}'])
+    """
+    compress, _ = CODECS[codec]
+
+    envelopes, chunk, nbytes = [], [], 0
+    for m in messages:
+        if chunk and nbytes + len(m) > max_nbytes:
+            envelopes.append(_envelope(chunk, codec, compress))
+            chunk, nbytes = [], 0
+        chunk.append(m)
+        nbytes += len(m)
+
+    if chunk:
+        envelopes.append(_envelope(chunk, codec, compress))
+    return envelopes
+
+
+def pack_batches(batches, codec="zlib", max_nbytes=ENVELOPE_MAX_NBYTES):
+    """Packs the logs of batches into envelopes as `pack_envelopes` does,
+    a batch going whole in one envelope unless it is bigger than one. The
+    template definitions of a batch go in every envelope holding its logs.
+
+    >>> from logagg.batchqueue import LogBatch
+    >>> batches = [LogBatch('acks') for i in range(3)]
+    >>> for i, b in enumerate(batches):
+    ...     b.append('{"a": %d}' % i, (7, i)); b.append('{"b": %d}' % i, (7, i))
+    >>> batches[2].add_definition('6f43', '{"t": 2}')
+    >>> [unpack_envelope(e) for e in pack_batches(batches, max_nbytes=24)]
+    [['{"a": 0}', '{"b": 0}'], ['{"a": 1}', '{"b": 1}'], ['{"t": 2}', '{"a": 2}'], ['{"t": 2}', '{"b": 2}']]
+    """
+    compress, _ = CODECS[codec]
+
+    envelopes, chunk, nbytes = [], [], 0
+    for b in batches:
+        if chunk and nbytes + b.nbytes > max_nbytes:
+            envelopes.append(_envelope(chunk, codec, compress))
+            chunk, nbytes = [], 0
+
+        definitions = b.definitions.values()
+        if b.nbytes <= max_nbytes:
+            chunk.extend(definitions)
+            chunk.extend(b.logs)
+            nbytes += b.nbytes
+            continue
+
+        head_nbytes = sum(len(d) + 1 for d in definitions)
+        part, nbytes = list(definitions), head_nbytes
+        for log in b.logs:
+            if len(part) > len(definitions) and nbytes + len(log) + 1 > max_nbytes:
+                envelopes.append(_envelope(part, codec, compress))
+                part, nbytes = list(definitions), head_nbytes
+            part.append(log)
+            nbytes += len(log) + 1
+        envelopes.append(_envelope(part, codec, compress))
+        nbytes = 0
+
+    if chunk:
+        envelopes.append(_envelope(chunk, codec, compress))
+    return envelopes
+
+
+def _envelope(messages, codec, compress):
+    header = "%s %s %d\n" % (ENVELOPE_MAGIC, codec, len(messages))
+    return header + compress(pack_messages(messages))
+
+
+def _envelope_header(message):
+    if not message.startswith(ENVELOPE_MAGIC):
+        return None, None, 0
+    end = message.index("\n")
+    _, codec, n = message[:end].split(" ")
+    return codec, int(n), end + 1
+
+
+def envelope_nrecords(message):
+    """Number of log records an nsq message holds, without unpacking it"""
+    _, n, _ = _envelope_header(message)
+    return 1 if n is None else n
+
+
+def unpack_envelope(message):
+    """The log records an nsq message holds, itself when not an envelope"""
+    codec, _, start = _envelope_header(message)
+    if codec is None:
+        return [message]
+    _, decompress = CODECS[codec]
+    return unpack_messages(decompress(message[start:]))
+
+
+class DepthMonitor(object):
+    """Keeps the depth of an nsq topic, polled in the background, and turns
+    it into how long sends are to be held back.
+
+    Below SOFT_LIMIT_RATIO of `max_depth`, sends go right away. Above it
+    they are held back the longer the closer the depth gets to the max,
+    up to MAX_DELAY seconds, slowing the collector down gradually. At
+    `max_depth` nothing is sent until nsq drains. A depth that could not
+    be polled lately is not held against sends, failing sends are.
+
+    >>> m = DepthMonitor(lambda: 0, max_depth=1000)
+    >>> m.delay()
+    0
+    >>> m.update(400); m.delay()
+    0
+    >>> m.update(750); m.delay()
+    0.5
+    >>> m.update(1000); m.delay() is None
+    True
+    """
+
+    POLL_INTERVAL = 1  # How often the depth is polled
+    STALE_AFTER = 10  # Seconds after which a depth that was not polled again is ignored
+    SOFT_LIMIT_RATIO = 0.5  # Fraction of the max depth from which sends are held back
+    MAX_DELAY = 1.0  # Seconds a send is held back just under the max depth
+
+    def __init__(self, get_depth, max_depth, log=util.DUMMY):
+        self.get_depth = get_depth
+        self.max_depth = max_depth
+        self.log = log
+
+        self.depth = None
+        self.updated_at = None
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        if self._thread is None:
+            self._thread = util.start_daemon_thread(self._poll)
+
+    def stop(self):
+        self._stopped = True
+
+    @keeprunning(POLL_INTERVAL, on_error=util.log_exception)
+    def _poll(self):
+        if self._stopped:
+            raise keeprunning.terminate
+        self.update(self.get_depth())
+        time.sleep(self.POLL_INTERVAL)
+
+    def update(self, depth):
+        self.depth = depth
+        self.updated_at = time.time()
+
+    def delay(self):
+        """Seconds to hold the next send back, None while nsq is full"""
+        if self.updated_at is None or time.time() - self.updated_at > self.STALE_AFTER:
+            return 0
+
+        if self.depth >= self.max_depth:
+            return None
+
+        soft_limit = self.max_depth * self.SOFT_LIMIT_RATIO
+        if self.depth <= soft_limit:
+            return 0
+        return (
+            self.MAX_DELAY * (self.depth - soft_limit) / (self.max_depth - soft_limit)
+        )
 
 
 class NSQSender(object):
@@ -15,97 +239,254 @@ class NSQSender(object):
         "Heartbeat#ephemeral"
     )  # Topic name at which heartbeat is to be sent
     MPUB_URL = "http://%s/mpub?topic=%s"  # Url to post msgs to NSQ
+    STATS_URL = (
+        "http://%s/stats?format=json&topic=%s&include_clients=false"
+    )  # Url of the stats of a topic, without the clients of its channels
+    REQUEST_TIMEOUT = 5  # Seconds to wait for nsq to answer a stats request
+    MAX_IN_FLIGHT = 4  # mpub requests sent to nsq at once
 
-    def __init__(self, http_loc, nsq_topic, nsq_max_depth, log=util.DUMMY):
+    def __init__(
+        self,
+        http_loc,
+        nsq_topic,
+        nsq_max_depth,
+        log=util.DUMMY,
+        max_in_flight=MAX_IN_FLIGHT,
+        envelope_codec=None,
+        ensure_topics=True,
+    ):
         self.nsqd_http_address = http_loc
         self.topic_name = nsq_topic
         self.nsq_max_depth = nsq_max_depth
         self.log = log
+        self.max_in_flight = max_in_flight
+        # Codec of the envelopes logs are packed in, None sends one
+        # message per log
+        self.envelope_codec = envelope_codec
 
-        self.session = requests
-        self._ensure_topic(self.topic_name)
-        self._ensure_topic(self.HEARTBEAT_TOPIC)
+        # Connections to nsq are kept alive, one for every mpub in flight
+        # and one for stats and heartbeats
+        self.session = requests.Session()
+        self.session.mount(
+            "http://", HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight + 1)
+        )
+        # Threads sending mpubs, started with the first send
+        self._pool = None
+        self._pool_size = 0
+        # (batches, result) of the mpubs sent and not reported yet, oldest first
+        self._in_flight = collections.deque()
+        # Polls the depth of the topic from the first send on
+        self.monitor = DepthMonitor(
+            lambda: self._get_depth(self.topic_name), nsq_max_depth, log=log
+        )
+
+        if self.nsqd_http_address and ensure_topics:
+            self._ensure_topic(self.topic_name)
+            self._ensure_topic(self.HEARTBEAT_TOPIC)
 
     @keeprunning(
         NSQ_READY_CHECK_INTERVAL, exit_on_success=True, on_error=util.log_exception
     )
     def _ensure_topic(self, topic_name):
-        u = "http://%s/topic/create?topic=%s" % (self.nsqd_http_address, topic_name)
         try:
-            self.session.post(u, timeout=1)
+            self._create_topic(topic_name)
         except requests.exceptions.RequestException as e:
             self.log.exception("could_not_create_topic,retrying....", topic=topic_name)
             raise
+
+    def _create_topic(self, topic_name):
+        u = "http://%s/topic/create?topic=%s" % (
+            self.nsqd_http_address,
+            urllib.quote(topic_name, safe=""),
+        )
+        self.session.post(u, timeout=1).raise_for_status()
         self.log.info("created_topic ", topic=topic_name)
 
+    def ping(self):
+        """Raises unless nsqd can be sent to, creating the topics"""
+        self._create_topic(self.topic_name)
+        self._create_topic(self.HEARTBEAT_TOPIC)
+
     @keeprunning(
         NSQ_READY_CHECK_INTERVAL, exit_on_success=True, on_error=util.log_exception
     )
     def _is_ready(self, topic_name):
+        self._check_ready(topic_name)
+
+    def _check_ready(self, topic_name):
         """
         Is NSQ running and have space to receive messages?
         """
-        url = "http://%s/stats?format=json&topic=%s" % (
+        if self._get_depth(topic_name) >= self.nsq_max_depth:
+            raise Exception("nsq_is_full_waiting_to_clear")
+
+    def _get_depth(self, topic_name):
+        """Messages of the topic waiting at nsq, in the topic and its channels"""
+        # The "#" of ephemeral topics would start the fragment of the url
+        url = self.STATS_URL % (
             self.nsqd_http_address,
-            topic_name,
+            urllib.quote(topic_name, safe=""),
         )
-        # Cheacking for ephmeral channels
-        if "#" in topic_name:
-            topic_name, tag = topic_name.split("#", 1)
 
-        try:
-            data = self.session.get(url).json()
-            """
-            data = {u'start_time': 1516164866, u'version': u'1.0.0-compat', \
-                    u'health': u'OK', u'topics': [{u'message_count': 19019, \
-                    u'paused': False, u'topic_name': u'test_topic', u'channels': [], \
-                    u'depth': 19019, u'backend_depth': 9019, u'e2e_processing_latency': {u'count': 0, \
-                    u'percentiles': None}}]}
-            """
-            topics = data.get("topics", [])
-            topics = [t for t in topics if t["topic_name"] == topic_name]
-
-            if not topics:
-                raise Exception("topic_missing_at_nsq")
-
-            topic = topics[0]
-            depth = topic["depth"]
-            depth += sum(c.get("depth", 0) for c in topic["channels"])
-            self.log.debug(
-                "nsq_depth_check",
-                topic=topic_name,
-                depth=depth,
+        data = self.session.get(url, timeout=self.REQUEST_TIMEOUT).json()
+        """
+        data = {u'start_time': 1516164866, u'version': u'1.0.0-compat', \
+                u'health': u'OK', u'topics': [{u'message_count': 19019, \
+                u'paused': False, u'topic_name': u'test_topic', u'channels': [], \
+                u'depth': 19019, u'backend_depth': 9019, u'e2e_processing_latency': {u'count': 0, \
+                u'percentiles': None}}]}
+        """
+        topics = data.get("topics", [])
+        topics = [t for t in topics if t["topic_name"] == topic_name]
+
+        if not topics:
+            raise Exception("topic_missing_at_nsq")
+
+        topic = topics[0]
+        depth = topic["depth"]
+        depth += sum(c.get("depth", 0) for c in topic["channels"])
+        self.log.debug(
+            "nsq_depth_check",
+            topic=topic_name,
+            depth=depth,
+            max_depth=self.nsq_max_depth,
+        )
+        return depth
+
+    def _start_monitor(self):
+        # The depth of topics is only known through the http api
+        if self.nsqd_http_address:
+            self.monitor.start()
+
+    def _wait_for_room(self):
+        """Holds a send back as long as the depth of the topic asks for"""
+        self._start_monitor()
+        while True:
+            delay = self.monitor.delay()
+            if delay is not None:
+                break
+            self.log.info(
+                "nsq_is_full_waiting_to_clear",
+                depth=self.monitor.depth,
                 max_depth=self.nsq_max_depth,
             )
+            time.sleep(self.monitor.POLL_INTERVAL)
 
-            if depth < self.nsq_max_depth:
-                return
-            else:
-                raise Exception("nsq_is_full_waiting_to_clear")
-        except:
-            raise
+        if delay:
+            time.sleep(delay)
 
     @keeprunning(
         NSQ_READY_CHECK_INTERVAL, exit_on_success=True, on_error=util.log_exception
     )
     def _send_messages(self, msgs, topic_name):
-        url = self.MPUB_URL % (self.nsqd_http_address, topic_name)
+        self._post_messages(msgs, topic_name)
+
+    def _post_messages(self, msgs, topic_name):
+        url = self.MPUB_URL % (
+            self.nsqd_http_address,
+            urllib.quote(topic_name, safe=""),
+        )
+        # Messages holding newlines cannot be sent newline separated
+        if any("\n" in m for m in msgs):
+            url, data = url + "&binary=true", pack_messages(msgs)
+        else:
+            data = "\n".join(msgs)
+
         try:
             self.session.post(
-                url, data=msgs, timeout=5
-            )  # TODO What if session expires?
+                url, data=data, timeout=5
+            ).raise_for_status()  # A dropped keep-alive connection fails, and is retried
         except (SystemExit, KeyboardInterrupt):
             raise
         except requests.exceptions.RequestException as e:
             raise
-        self.log.debug("nsq push done ", nmsgs=len(msgs), nbytes=len(msgs))
+        self.log.debug("nsq push done ", nmsgs=len(msgs), nbytes=len(data))
+
+    def send(self, msgs, topic_name=None):
+        """Sends a list of messages to a topic, that of the sender when
+        None, waiting for nsq as long as it takes"""
+        self._wait_for_room()
+        self._send_messages(msgs, topic_name=topic_name or self.topic_name)
+
+    def try_send(self, msgs, topic_name=None):
+        """Sends a list of messages once, returns whether they were"""
+        self._start_monitor()
+        delay = self.monitor.delay()
+        if delay is None:
+            self.log.warning("nsq_is_full", depth=self.monitor.depth, nmsgs=len(msgs))
+            return False
+        time.sleep(delay)
+
+        try:
+            self._post_messages(msgs, topic_name or self.topic_name)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception as e:
+            self.log.warning("nsq_unavailable", error=repr(e), nmsgs=len(msgs))
+            return False
+        return True
+
+    def messages(self, batches):
+        """The nsq messages the logs of batches are sent as"""
+        if self.envelope_codec is None:
+            return batch_logs(batches)
+        return pack_batches(batches, self.envelope_codec)
+
+    def handle_logs(self, batches):
+        """Sends batches going to the same topic"""
+        self.send(self.messages(batches), batches[0].topic)
+
+    def _timed_handle_logs(self, batches):
+        ts = time.time()
+        self.handle_logs(batches)
+        return time.time() - ts
+
+    @property
+    def nin_flight(self):
+        """mpubs sent whose completion was not reported by `completed` yet"""
+        return len(self._in_flight)
+
+    def send_async(self, batches):
+        """Starts sending batches, waiting while `max_in_flight` sends are
+        still going on. Sending just one at a time, sends right away."""
+        if self.max_in_flight <= 1:
+            self._in_flight.append((batches, self._timed_handle_logs(batches)))
+            return
+
+        if self._pool_size < self.max_in_flight:
+            # Sends may be allowed to grow in flight, the threads of the
+            # previous pool end once their sends are done
+            if self._pool is not None:
+                self._pool.close()
+            self._pool = ThreadPool(self.max_in_flight)
+            self._pool_size = self.max_in_flight
+
+        while True:
+            pending = [r for _, r in self._in_flight if not r.ready()]
+            if len(pending) < self.max_in_flight:
+                break
+            pending[0].wait()
+
+        result = self._pool.apply_async(self._timed_handle_logs, (batches,))
+        self._in_flight.append((batches, result))
+
+    def completed(self):
+        """Returns (batches, seconds the send took) for the sends done, in
+        the order they were started, stopping at the first still going on
+        so that later sends are not reported before it"""
+        done = []
+        while self._in_flight:
+            batches, result = self._in_flight[0]
+            sent_async = not isinstance(result, float)
+            if sent_async and not result.ready():
+                break
+
+            self._in_flight.popleft()
+            done.append((batches, result.get() if sent_async else result))
 
-    def handle_logs(self, msgs):
-        self._is_ready(topic_name=self.topic_name)
-        msgs = "\n".join(m["log"] for m in msgs)
-        self._send_messages(msgs, topic_name=self.topic_name)
+        return done
 
     def handle_heartbeat(self, heartbeat):
-        msgs = json.dumps(heartbeat)
+        msgs = [json.dumps(heartbeat)]
         self._is_ready(topic_name=self.HEARTBEAT_TOPIC)
         self._send_messages(msgs, topic_name=self.HEARTBEAT_TOPIC)
@@ -0,0 +1,156 @@
+import socket
+import select
+import threading
+import ujson as json
+
+from logagg import util
+from logagg.nsqsender import NSQSender, UINT32, pack_messages
+
+
+class NSQError(Exception):
+    """An error frame nsqd answered a command with"""
+
+
+class NSQTCPSender(NSQSender):
+    """NSQSender publishing with the MPUB command of the TCP protocol of
+    nsqd over long lived connections, one per send in flight, rather than
+    with http requests. Messages may hold newlines.
+
+    Heartbeats nsqd sends on idle connections are answered before the
+    next command, connections nsqd closed are opened again. The depth of
+    the topic is only watched when `http_loc` is given too.
+
+    >>> from logagg.fakensqd import FakeNSQD
+    >>> nsqd = FakeNSQD(); nsqd.start()
+    >>> sender = NSQTCPSender(nsqd.address, 'logs', 1000)
+    >>> sender.send(['a', 'b\\nc'])
+    >>> nsqd.messages['logs']
+    ['a', 'b\\nc']
+
+    >>> nsqd.heartbeat(); sender.send(['d']); sender.send(['e'])
+    >>> nsqd.nops
+    1
+    >>> nsqd.drop_connections(); sender.send(['f'])
+    >>> nsqd.messages['logs'][-3:], nsqd.nconnections
+    (['d', 'e', 'f'], 2)
+
+    >>> nsqd.fail_next = 'E_MPUB_FAILED'
+    >>> sender.try_send(['g']), nsqd.messages['logs'][-1]
+    (False, 'f')
+    >>> nsqd.stop()
+    """
+
+    MAGIC = "  V2"  # Protocol version sent first on a connection
+    CONNECT_TIMEOUT = 5  # Seconds to wait for a connection to nsqd
+    RESPONSE_TIMEOUT = 5  # Seconds to wait for nsqd to answer a command
+    FRAME_RESPONSE = 0
+    FRAME_ERROR = 1
+    HEARTBEAT = "_heartbeat_"
+
+    def __init__(
+        self,
+        tcp_loc,
+        nsq_topic,
+        nsq_max_depth,
+        log=util.DUMMY,
+        max_in_flight=NSQSender.MAX_IN_FLIGHT,
+        http_loc=None,
+        envelope_codec=None,
+        ensure_topics=True,
+    ):
+        self.nsqd_tcp_address = tcp_loc
+        # Connection of each thread sending
+        self._local = threading.local()
+        super(NSQTCPSender, self).__init__(
+            http_loc,
+            nsq_topic,
+            nsq_max_depth,
+            log,
+            max_in_flight,
+            envelope_codec,
+            ensure_topics,
+        )
+
+    def _recv(self, sock, n):
+        data = []
+        while n:
+            d = sock.recv(n)
+            if not d:
+                raise socket.error("connection_closed_by_nsqd")
+            data.append(d)
+            n -= len(d)
+        return "".join(data)
+
+    def _read_frame(self, sock):
+        # The size counts the frame type along with the data
+        (size,) = UINT32.unpack(self._recv(sock, 4))
+        (frame_type,) = UINT32.unpack(self._recv(sock, 4))
+        return frame_type, self._recv(sock, size - 4)
+
+    def _read_response(self, sock):
+        while True:
+            frame_type, data = self._read_frame(sock)
+            if frame_type == self.FRAME_ERROR:
+                raise NSQError(data)
+            if data != self.HEARTBEAT:
+                return data
+            sock.sendall("NOP\n")
+
+    def _command(self, sock, command, body):
+        sock.sendall("%s\n%s%s" % (command, UINT32.pack(len(body)), body))
+        return self._read_response(sock)
+
+    def _answer_heartbeats(self, sock):
+        """Reads what nsqd sent on an idle connection, raising when it was
+        closed"""
+        while select.select([sock], [], [], 0)[0]:
+            frame_type, data = self._read_frame(sock)
+            if data != self.HEARTBEAT:
+                raise NSQError("unexpected_frame %r" % data)
+            sock.sendall("NOP\n")
+
+    def _connect(self):
+        host, port = self.nsqd_tcp_address.rsplit(":", 1)
+        sock = socket.create_connection((host, int(port)), self.CONNECT_TIMEOUT)
+        sock.settimeout(self.RESPONSE_TIMEOUT)
+        sock.sendall(self.MAGIC)
+        identity = dict(client_id=socket.gethostname(), user_agent="logagg")
+        self._command(sock, "IDENTIFY", json.dumps(identity))
+        self.log.info("connected_to_nsqd", address=self.nsqd_tcp_address)
+        return sock
+
+    def ping(self):
+        if self.nsqd_http_address:
+            super(NSQTCPSender, self).ping()
+        self._connect().close()
+
+    def _close(self):
+        sock, self._local.sock = getattr(self._local, "sock", None), None
+        if sock is not None:
+            sock.close()
+
+    def _connection(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            try:
+                self._answer_heartbeats(sock)
+            except (socket.error, NSQError):
+                self.log.info("reconnecting_to_nsqd", address=self.nsqd_tcp_address)
+                self._close()
+                sock = None
+
+        if sock is None:
+            sock = self._local.sock = self._connect()
+        return sock
+
+    def _post_messages(self, msgs, topic_name):
+        try:
+            self._command(self._connection(), "MPUB " + topic_name, pack_messages(msgs))
+        except (socket.error, NSQError):
+            # The connection may be in any state after an error, start over
+            self._close()
+            raise
+        self.log.debug("nsq push done ", nmsgs=len(msgs))
+
+    def handle_heartbeat(self, heartbeat):
+        self._send_messages([json.dumps(heartbeat)], topic_name=self.HEARTBEAT_TOPIC)
@@ -0,0 +1,493 @@
+import io
+import os
+import time
+import gzip
+import errno
+import hashlib
+
+from logagg import util
+
+FINGERPRINT_NBYTES = 1024  # Leading bytes of a file hashed to recognise it
+
+
+def fingerprint(f):
+    """Identifies a file by a hash of its first bytes, which unlike its
+    inode survive it being compressed or the inode being reused.
+
+    >>> import tempfile
+    >>> f = tempfile.TemporaryFile()
+    >>> f.write('first line\\n')
+    >>> fingerprint(f)
+    '11:e32c72173d6151f438f6ff3a85c56a46ed99ca81'
+    >>> f.write('more lines\\n')
+    >>> matches_fingerprint(f, '11:e32c72173d6151f438f6ff3a85c56a46ed99ca81')
+    True
+    >>> matches_fingerprint(f, '11:0000000000000000000000000000000000000000')
+    False
+    """
+    f.seek(0)
+    head = f.read(FINGERPRINT_NBYTES)
+    return "%d:%s" % (len(head), hashlib.sha1(head).hexdigest())
+
+
+def matches_fingerprint(f, fp):
+    nbytes, digest = fp.split(":", 1)
+    f.seek(0)
+    head = f.read(int(nbytes))
+    return len(head) == int(nbytes) and hashlib.sha1(head).hexdigest() == digest
+
+
+class ChunkedReader(object):
+    """Reads a growing log file in large chunks and hands out complete
+    lines only, checkpointing the acknowledged offset to a journal.
+
+    A checkpoint holds the inode, offset and fingerprint of the file the
+    offset belongs to. When the file at fpath turns out to be another one,
+    the rotated file the offset belongs to is looked up next to it, even
+    if it was gzipped since, and its tail is read before the new file.
+    Offsets left by pygtail in `<fpath>.offset` are used when the journal
+    has none for fpath.
+
+    >>> import tempfile, shutil
+    >>> from logagg.checkpoint import CheckpointJournal
+    >>> d = tempfile.mkdtemp()
+    >>> fpath = os.path.join(d, 'app.log')
+    >>> with open(fpath, 'w') as f: f.write('one\\ntwo\\nthr')
+    >>> journal = CheckpointJournal(os.path.join(d, 'checkpoint.journal'))
+
+    >>> r = ChunkedReader(fpath, journal, chunk_size=4)
+    >>> [(data, offset) for data, _, offset in r.read_chunks()]
+    [('one', 0), ('two', 4)]
+    >>> with open(fpath, 'a') as f: f.write('ee\\nfour\\n')
+    >>> [(data, offset) for data, _, offset in r.read_chunks()]
+    [('three', 8), ('four', 14)]
+
+    Reading resumes from the acknowledged offset
+
+    >>> r.checkpoint((os.stat(fpath).st_ino, 14))
+    >>> journal.commit()
+    >>> r.close()
+    >>> r = ChunkedReader(fpath, journal)
+    >>> r.unread() == (os.stat(fpath).st_ino, 14, 19)
+    True
+    >>> [(data, offset) for data, _, offset in r.read_chunks()]
+    [('four', 14)]
+
+    or from wherever the reader is moved to
+
+    >>> r.unread() == (os.stat(fpath).st_ino, 19, 19)
+    True
+    >>> r.seek(8)
+    >>> [(data, offset) for data, _, offset in r.read_chunks()]
+    [('three\\nfour', 8)]
+
+    and starts over when the file gets truncated
+
+    >>> with open(fpath, 'w') as f: f.write('five\\n')
+    >>> [(data, offset) for data, _, offset in r.read_chunks()]
+    [('five', 0)]
+    >>> r.checkpoint((os.stat(fpath).st_ino, 5))
+    >>> journal.commit()
+    >>> r.close()
+
+    When the file was rotated while the reader was not running
+
+    >>> with open(fpath, 'a') as f: f.write('six\\n')
+    >>> os.rename(fpath, fpath + '.1')
+    >>> with open(fpath, 'w') as f: f.write('seven\\n')
+    >>> r = ChunkedReader(fpath, journal)
+    >>> [data for data, _, _ in r.read_chunks()]
+    ['six', 'seven']
+    >>> r.checkpoint((r.inode, 2))
+    >>> journal.commit()
+    >>> r.close()
+
+    and even compressed since
+
+    >>> with open(fpath, 'a') as f: f.write('eight\\n')
+    >>> with open(fpath) as f, gzip.open(fpath + '.2.gz', 'wb') as gz:
+    ...     _ = gz.write(f.read())
+    >>> os.remove(fpath)
+    >>> with open(fpath, 'w') as f: f.write('nine\\n')
+    >>> r = ChunkedReader(fpath, journal)
+    >>> [data for data, _, _ in r.read_chunks()]
+    ['ven\\neight', 'nine']
+    >>> r.close()
+
+    Lines growing longer than max_nbytes are handed out before they end
+
+    >>> lpath = os.path.join(d, 'long.log')
+    >>> with open(lpath, 'w') as f: f.write('a\\n0123456789')
+    >>> r = ChunkedReader(lpath, journal, chunk_size=4, max_nbytes=6)
+    >>> [(data, offset, r.cut) for data, _, offset in r.read_chunks()]
+    [('a', 0, False), ('0123456789', 2, True)]
+    >>> with open(lpath, 'a') as f: f.write('ab\\ncd')
+    >>> [(data, offset, r.cut) for data, _, offset in r.read_chunks()]
+    [('ab', 12, False)]
+
+    Files without new data for MAX_IDLE seconds are closed, and opened
+    again where reading stopped once they change
+
+    >>> r.MAX_IDLE = 0
+    >>> list(r.read_chunks()), r.is_idle(float('inf'))
+    ([], False)
+    >>> with open(lpath, 'a') as f: f.write('\\n')
+    >>> [(data, offset) for data, _, offset in r.read_chunks()]
+    [('cd', 15)]
+
+    Deleted files are let go of, the position being kept
+
+    >>> os.remove(lpath)
+    >>> list(r.read_chunks()), r.is_idle(float('inf')), r.offset
+    ([], False, 18)
+
+    >>> r.close()
+    >>> journal.close()
+    >>> shutil.rmtree(d)
+    """
+
+    CHUNK_SIZE = 2 * 1024 ** 2  # Number of bytes read from the file at once
+    MAX_NBYTES = 1024 ** 2  # Longer lines are handed out before they end
+    MAX_IDLE = 60  # Seconds without new data after which the file is closed
+
+    def __init__(
+        self, fpath, checkpoints, chunk_size=CHUNK_SIZE, max_nbytes=MAX_NBYTES
+    ):
+        self.filename = fpath
+        self.checkpoints = checkpoints
+        self.chunk_size = chunk_size
+        self.max_nbytes = max_nbytes
+
+        # inode of the file being read and its fingerprint. When reading
+        # the tail of a rotated file, inode is the one the file had while
+        # it lived at fpath.
+        state = checkpoints.get(fpath) or self._read_pygtail_offset_file()
+        self.inode, self.offset, fp = state
+        self.fingerprints = {self.inode: fp}
+        # Path of the rotated file being read, None for the file at fpath
+        self.rotated_fpath = None
+
+        self._fh = None
+        # When data was last read from the open file
+        self.read_at = None
+        # Trailing bytes of the last read that do not end with a newline yet
+        self._tail = ""
+        # Whether the last line handed out was cut short of its newline
+        self.cut = False
+
+    def _read_pygtail_offset_file(self):
+        try:
+            with open(self.filename + ".offset") as f:
+                inode, offset = f.read().split()[:2]
+            return int(inode), int(offset), None
+        except (IOError, ValueError):
+            return None, 0, None
+
+    def checkpoint(self, position):
+        """Stages `position`, an (inode, offset) pair handed out along with
+        the data, as the offset up to which lines are processed. It is
+        persisted by the next commit of the checkpoint journal."""
+        inode, offset = position
+        fp = self.fingerprints.get(inode)
+        self.checkpoints.update(self.filename, inode, offset, fp)
+
+    def _is_same_file(self, fh, inode, fp):
+        if inode is not None and os.fstat(fh.fileno()).st_ino != inode:
+            return False
+        return fp is None or matches_fingerprint(fh, fp)
+
+    def _find_rotated(self, inode, fp):
+        """Looks for the file with `inode` and fingerprint `fp` among the
+        files named after fpath, as rotation leaves them: app.log.1,
+        app.log-20180101, app.log.2.gz ..."""
+        d, name = os.path.split(self.filename)
+        candidates = [
+            os.path.join(d, n)
+            for n in os.listdir(d or ".")
+            if n.startswith(name) and n != name and not n.endswith(".offset")
+        ]
+        plain = [c for c in candidates if not c.endswith(".gz")]
+        gzipped = [c for c in candidates if c.endswith(".gz")]
+
+        for c in plain:
+            try:
+                fh = io.open(c, "rb")
+            except IOError:
+                continue
+            if self._is_same_file(fh, inode, fp):
+                return c, fh
+            fh.close()
+
+        # gzipping gives a new inode, only the fingerprint can tell
+        if fp is None:
+            return None, None
+        gzipped.sort(key=os.path.getmtime, reverse=True)
+        for c in gzipped:
+            fh = gzip.open(c, "rb")
+            try:
+                if matches_fingerprint(fh, fp):
+                    return c, fh
+            except (IOError, EOFError):
+                pass
+            fh.close()
+
+        return None, None
+
+    def _open(self):
+        # io.open does plain read(2) calls, unlike stdio backed files it
+        # sees data appended after a previous read hit the end of file
+        try:
+            fh = io.open(self.filename, "rb")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+
+        inode, fp = self.inode, self.fingerprints.get(self.inode)
+        st = os.fstat(fh.fileno())
+
+        if inode is not None and not self._is_same_file(fh, inode, fp):
+            # The offset belongs to a file rotated away from fpath while
+            # we were not reading it, finish that one first
+            rotated_fpath, rotated_fh = self._find_rotated(inode, fp)
+            if rotated_fh is not None:
+                fh.close()
+                self.rotated_fpath, self._fh = rotated_fpath, rotated_fh
+                self._fh.seek(self.offset)
+                self.read_at = time.time()
+                self._tail, self.cut = "", False
+                return True
+            inode = None
+
+        if inode is None or self.offset > st.st_size:
+            self.inode, self.offset = st.st_ino, 0
+
+        self.rotated_fpath = None
+        self.fingerprints[self.inode] = fingerprint(fh)
+        fh.seek(self.offset)
+        self._fh = fh
+        self.read_at = time.time()
+        self._tail, self.cut = "", False
+        return True
+
+    def is_idle(self, now):
+        """Whether the file is open with no new data for MAX_IDLE seconds"""
+        return self._fh is not None and now - self.read_at >= self.MAX_IDLE
+
+    def _is_replaced(self):
+        """Tells whether the open file was rotated away or truncated"""
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return False
+
+        return st.st_ino != self.inode or st.st_size < self._fh.tell()
+
+    def _update_fingerprint(self):
+        # Files shorter than FINGERPRINT_NBYTES get their fingerprint
+        # extended as they grow
+        fp = self.fingerprints.get(self.inode)
+        if self.rotated_fpath or int(fp.split(":", 1)[0]) >= FINGERPRINT_NBYTES:
+            return
+
+        pos = self._fh.tell()
+        self.fingerprints[self.inode] = fingerprint(self._fh)
+        self._fh.seek(pos)
+
+    def unread(self):
+        """Returns (inode, offset, size) of the file, offset being where
+        the next read starts. Rotated files report nothing unread, they
+        are read to their end before anything else."""
+        if self._fh is None and not self._open():
+            return self.inode, self.offset, self.offset
+
+        if self.rotated_fpath:
+            return self.inode, self.offset, self.offset
+
+        return self.inode, self.offset, os.fstat(self._fh.fileno()).st_size
+
+    def seek(self, offset):
+        """Continues reading at `offset`, which must be the start of a line"""
+        self._fh.seek(offset)
+        self.offset = offset
+        self._tail, self.cut = "", False
+
+    def read_chunks(self):
+        """Yields (data, inode, offset) for everything appended to the file
+        since the previous call, where `data` holds complete lines (without
+        the final newline) starting at byte `offset` of the file. When
+        `cut` is set, the last line of `data` was cut short of its newline
+        and the next data continues it."""
+        if self._fh is None and not self._open():
+            return
+
+        while True:
+            chunk = self._fh.read(self.chunk_size)
+            if chunk:
+                self.read_at = time.time()
+
+            if not chunk:
+                if not os.path.exists(self.filename):
+                    # Deleted, or rotated away and not recreated yet. The
+                    # position is kept, reading resumes from it, in the
+                    # rotated file if need be, once the path is back.
+                    self.close()
+                    return
+                if not self._is_replaced():
+                    # Idle files are closed and opened again on change,
+                    # unless a line cut short is still to be continued
+                    if self.is_idle(time.time()) and not self.cut:
+                        self.close()
+                    return
+
+                # Reached the end of a rotated file. Hand out the last
+                # line even without a newline and continue with the
+                # new file at this path.
+                if self._tail and os.stat(self.filename).st_ino != self.inode:
+                    yield self._tail, self.inode, self.offset
+                self.close()
+                # positions in the old file may still have to be persisted
+                self.fingerprints = {self.inode: self.fingerprints.get(self.inode)}
+                self.inode, self.offset = None, 0
+                if not self._open():
+                    return
+                continue
+
+            buf = self._tail + chunk
+            end = buf.rfind("\n")
+            if end >= 0:
+                data, self._tail = buf[:end], buf[end + 1 :]
+                offset = self.offset
+                self.offset += end + 1
+                self.cut = False
+                self._update_fingerprint()
+                yield data, self.inode, offset
+            else:
+                self._tail = buf
+
+            # A line growing longer than max_nbytes is handed out before
+            # its newline comes, so that memory used stays bounded
+            if len(self._tail) > self.max_nbytes:
+                data, self._tail = self._tail, ""
+                offset = self.offset
+                self.offset += len(data)
+                self.cut = True
+                self._update_fingerprint()
+                yield data, self.inode, offset
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+class RecordAssembler(object):
+    """Joins the lines handed out by a ChunkedReader into records, partial
+    lines being joined to the record before them.
+
+    The last record read is held back as the next lines may continue it,
+    until a line starting a new record arrives or it is flushed, eg. once
+    the file stayed idle for a while. Records longer than `max_nbytes`
+    are split into pieces ending with SPLIT_MARKER, so that memory used
+    per file stays bounded. Each record is handed out with the (inode,
+    offset) at which it ends; pieces of a split record, but the last one,
+    carry the offset at which the record starts.
+
+    >>> a = RecordAssembler(util.ispartial, max_nbytes=12)
+    >>> list(a.feed('a\\nb\\n c', 7, 0))
+    [('a', (7, 2))]
+    >>> list(a.feed(' d', 7, 7))
+    []
+    >>> a.pending_since is not None
+    True
+    >>> list(a.flush()), a.pending_since
+    ([('b\\n c\\n d', (7, 10))], None)
+
+    >>> list(a.feed('0123456789abcdefghij\\n klm', 7, 10))
+    [('0123456[...]', (7, 10)), ('789abcd[...]', (7, 10))]
+    >>> list(a.feed('n', 7, 36))
+    [('efghij\\n klm', (7, 36))]
+
+    Data continuing a line the reader cut short is joined to it
+
+    >>> list(a.flush())
+    [('n', (7, 38))]
+    >>> list(a.feed('0123456789', 7, 38)), a.end
+    ([], 49)
+    >>> list(a.feed('abcd\\nx', 7, 48))
+    [('0123456[...]', (7, 38)), ('789abcd', (7, 53))]
+    """
+
+    MAX_NBYTES = 1024 ** 2  # Records longer than this are split into pieces
+    SPLIT_MARKER = "[...]"  # Appended to all but the last piece of a record
+
+    def __init__(self, ispartial, max_nbytes=MAX_NBYTES):
+        self.ispartial = ispartial
+        self.max_nbytes = max_nbytes
+
+        # Record held back, the inode and offsets it starts and ends at
+        self.record = None
+        self.inode, self.start, self.end = None, 0, 0
+        # When the record held back last grew
+        self.pending_since = None
+
+    def _split(self, record, inode, start, end):
+        if len(record) <= self.max_nbytes:
+            yield record, (inode, end)
+            return
+
+        n = self.max_nbytes - len(self.SPLIT_MARKER)
+        for i in range(0, len(record) - n, n):
+            yield record[i : i + n] + self.SPLIT_MARKER, (inode, start)
+        yield record[i + n :], (inode, end)
+
+    def feed(self, data, inode, offset):
+        """Yields (record, position) for the records completed by `data`,
+        complete lines starting at byte `offset` of the file"""
+        records = util.split_records(data, self.ispartial)
+
+        # The record held back spans bytes self.start to self.end of the
+        # file, `data` follows right after it
+        head, start = "", offset
+        if self.record is not None:
+            first = records[0]
+            if inode == self.inode and offset == self.end - 1:
+                # The reader cut the record short of its newline
+                head, start = self.record, self.start
+                self.record = None
+            elif inode == self.inode and self.ispartial(first.partition("\n")[0]):
+                head, start = self.record + "\n", self.start
+                self.record = None
+            else:
+                for r in self.flush():
+                    yield r
+
+        pos = offset
+        last = len(records) - 1
+        for i, record in enumerate(records):
+            end = pos + len(record) + 1
+            if i == 0:
+                record = head + record
+            if i == last:
+                break
+            for r in self._split(record, inode, start, end):
+                yield r
+            pos = start = end
+
+        self.record, self.inode, self.start, self.end = record, inode, start, end
+        self.pending_since = time.time()
+
+        # Hand out the pieces of a record growing too long right away
+        n = self.max_nbytes - len(self.SPLIT_MARKER)
+        while len(self.record) > self.max_nbytes:
+            yield self.record[:n] + self.SPLIT_MARKER, (inode, self.start)
+            self.record = self.record[n:]
+
+    def flush(self):
+        """Yields the record held back, if any"""
+        if self.record is None:
+            return
+
+        record, self.record, self.pending_since = self.record, None, None
+        for r in self._split(record, self.inode, self.start, self.end):
+            yield r
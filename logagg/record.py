@@ -0,0 +1,210 @@
+import os
+import binascii
+import datetime
+import itertools
+import ujson as json
+from operator import attrgetter
+
+LOG_STRUCTURE = {
+    "id": basestring,
+    "timestamp": basestring,
+    "file": basestring,
+    "host": basestring,
+    "formatter": basestring,
+    "raw": basestring,
+    "type": basestring,
+    "level": basestring,
+    "event": basestring,
+    "data": dict,
+    "error": bool,
+    "error_tb": basestring,
+}
+
+
+class SchemaValidator(object):
+    """A log structure, mapping keys to the types of their values, turned
+    into checks that need not build anything per log.
+
+    >>> v = SchemaValidator({'a': basestring, 'b': dict})
+    >>> v.fields
+    ('a', 'b')
+    >>> v.check_values((u'x', {})) is None
+    True
+    >>> sorted(v.check_values((1, {})).items())
+    [('datatype_expected', <type 'basestring'>), ('datatype_got', <type 'int'>), ('key_datatype_not_matched', 'a')]
+
+    >>> sorted(v.check_dict({'a': 'x', 'c': 1}).items())
+    [('extra_keys_found', ['c']), ('key_not_found', ['b'])]
+    """
+
+    def __init__(self, structure):
+        self.structure = structure
+        self.keys = frozenset(structure)
+        self.fields = tuple(sorted(structure))
+        self.types = tuple(structure[k] for k in self.fields)
+
+    def check_values(self, values):
+        """Checks the types of the values of a log, given in the order of
+        `fields`. Returns None or what does not match."""
+        if all(map(isinstance, values, self.types)):
+            return None
+
+        for value, expected, key in zip(values, self.types, self.fields):
+            if not isinstance(value, expected):
+                return dict(
+                    key_datatype_not_matched=key,
+                    datatype_expected=expected,
+                    datatype_got=type(value),
+                )
+        return None
+
+    def check_dict(self, log):
+        keys = log.viewkeys()
+        if keys != self.keys:
+            return dict(
+                key_not_found=sorted(self.keys - keys),
+                extra_keys_found=sorted(keys - self.keys),
+            )
+        return self.check_values([log[k] for k in self.fields])
+
+
+LOG_VALIDATOR = SchemaValidator(LOG_STRUCTURE)
+_record_values = attrgetter(*LOG_VALIDATOR.fields)
+# Keys of the log brought out of its data when found there
+_LIFTED_KEYS = LOG_VALIDATOR.keys - frozenset(["data"])
+
+
+class IdGenerator(object):
+    """Unique log ids as 32 hex digits, like uuid1().hex but a lot cheaper:
+    a random prefix drawn once per process followed by a counter.
+
+    >>> ids = IdGenerator()
+    >>> a, b = ids.next(), ids.next()
+    >>> len(a), a[:16] == b[:16], int(b[16:], 16) - int(a[16:], 16)
+    (32, True, 1)
+    """
+
+    def __init__(self):
+        self._pid = None
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._prefix = binascii.hexlify(os.urandom(8))
+        self._counter = itertools.count()
+
+    def next(self):
+        # Forked workers must not hand out their parent's ids
+        if self._pid != os.getpid():
+            self._reset()
+        return "%s%016x" % (self._prefix, next(self._counter))
+
+
+log_ids = IdGenerator()
+
+
+class LogRecord(object):
+    """A log being formatted, holding exactly the keys of LOG_STRUCTURE.
+
+    Starts with the default values of a log read from `fpath`, which the
+    values returned by formatters are merged into. Keys not part of the
+    structure make the record invalid. The defaults being valid, values
+    are type checked as they are merged in, `validate` only looking again
+    at those that did not match. The id and timestamp are only generated
+    and the level defaulted when none was found in the line.
+
+    >>> r = LogRecord('/var/log/app.log', 'a line', 'logagg.formatters.basescript', 'host')
+    >>> r.update({'data': {'a': 1, 'level': 'info', 'type': 'metric'}, 'event': 'started'})
+    >>> r.finalize()
+    >>> r.validate() is None
+    True
+    >>> d = r.to_dict()
+    >>> d['data'], d['level'], d['type'], d['event'], len(d['id'])
+    ({'a': 1}, 'info', 'metric', 'started', 32)
+    >>> sorted(json.loads(r.to_json())) == sorted(LOG_STRUCTURE)
+    True
+
+    >>> r.update({'level': 10})
+    >>> sorted(r.validate().items())
+    [('datatype_expected', <type 'basestring'>), ('datatype_got', <type 'int'>), ('key_datatype_not_matched', 'level')]
+    >>> r.update({'level': 'error', 'unknown': 1})
+    >>> r.validate()
+    {'extra_keys_found': ['unknown']}
+    """
+
+    FIELDS = LOG_VALIDATOR.fields
+    __slots__ = FIELDS + ("level_given", "_extra_keys", "_mismatched")
+    DEFAULT_LEVEL = "debug"
+
+    def __init__(self, fpath, raw, formatter, host):
+        self.id = None
+        self.timestamp = None
+        self.file = fpath
+        self.host = host
+        self.formatter = formatter
+        self.event = "event"
+        self.data = {}
+        self.raw = raw
+        self.type = "log"
+        # Set to DEFAULT_LEVEL by finalize when the line gives none
+        self.level = None
+        self.level_given = False
+        self.error = False
+        self.error_tb = ""
+        self._extra_keys = None
+        # keys set to a value not matching LOG_STRUCTURE
+        self._mismatched = None
+
+    def update(self, log):
+        structure = LOG_STRUCTURE
+        for key, value in log.iteritems():
+            expected = structure.get(key)
+            if expected is None:
+                if self._extra_keys is None:
+                    self._extra_keys = []
+                self._extra_keys.append(key)
+                continue
+
+            setattr(self, key, value)
+            if not isinstance(value, expected):
+                if self._mismatched is None:
+                    self._mismatched = []
+                self._mismatched.append(key)
+
+    def finalize(self):
+        """Brings the keys of the log found in its data out of it and
+        fills in the level, id and timestamp when they are still missing"""
+        data = self.data
+        if data and isinstance(data, dict):
+            keys = _LIFTED_KEYS.intersection(data)
+            if keys:
+                self.update(dict((k, data.pop(k)) for k in keys))
+
+        self.level_given = self.level is not None
+        if not self.level_given:
+            self.level = self.DEFAULT_LEVEL
+        if self.id is None:
+            self.id = log_ids.next()
+        if self.timestamp is None:
+            self.timestamp = datetime.datetime.utcnow().isoformat()
+
+    def validate(self):
+        """Returns None when the record matches LOG_STRUCTURE, otherwise
+        what does not match"""
+        if self._extra_keys:
+            return dict(extra_keys_found=sorted(self._extra_keys))
+
+        for key in self._mismatched or ():
+            value, expected = getattr(self, key), LOG_STRUCTURE[key]
+            if not isinstance(value, expected):
+                return dict(
+                    key_datatype_not_matched=key,
+                    datatype_expected=expected,
+                    datatype_got=type(value),
+                )
+        return None
+
+    def to_dict(self):
+        return dict(zip(self.FIELDS, _record_values(self)))
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
@@ -0,0 +1,169 @@
+import re
+import time
+import collections
+
+# A run of records repeating one another: the first of them, their number
+# and the last of them, whose timestamp ends the run
+Repeated = collections.namedtuple("Repeated", "record count last")
+
+# Timestamps found near the start of lines, in the ISO 8601, common log,
+# django and syslog formats
+TIMESTAMP = re.compile(
+    r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?"
+    r"|\d{2}/\w{3}/\d{4}[: ]\d{2}:\d{2}:\d{2}(?: [+-]\d{4})?"
+    r"|\w{3} [ \d]\d \d{2}:\d{2}:\d{2}"
+)
+TIMESTAMP_NCHARS = 80  # Leading characters of a line a timestamp is looked for in
+
+
+def split_timestamp(line):
+    """The parts of a line before and after the timestamp found near its
+    start, None when there is none
+
+    >>> split_timestamp('2017-08-17T07:56:33.489+0200 I REPL [x] up')
+    ('', ' I REPL [x] up')
+    >>> split_timestamp('up') is None
+    True
+    """
+    # Most lines start with their timestamp
+    m = TIMESTAMP.match(line) or TIMESTAMP.search(line, 1, TIMESTAMP_NCHARS)
+    if m is None:
+        return None
+    return line[: m.start()], line[m.end() :]
+
+
+def has_timestamp_between(line, head, tail):
+    """Whether a line is `head` and `tail` around a timestamp
+
+    >>> head, tail = split_timestamp('[22/Sep/2017 06:32:15] ERROR [app:10] failed')
+    >>> has_timestamp_between('[22/Sep/2017 06:32:19] ERROR [app:10] failed', head, tail)
+    True
+    >>> has_timestamp_between('[22/Sep/2017 06:32:19] ERROR [app:11] failed', head, tail)
+    False
+    """
+    if not (line.startswith(head) and line.endswith(tail)):
+        return False
+    m = TIMESTAMP.match(line, len(head))
+    return m is not None and m.end() == len(line) - len(tail)
+
+
+def _fields_key(fields):
+    if fields is None:
+        return None
+    return sorted((k, v) for k, v in fields.iteritems() if k != "timestamp")
+
+
+class _Run(object):
+    __slots__ = ("record", "key", "count", "last", "position", "since")
+
+    def __init__(self, record, position, now):
+        self.record = record
+        # (head, tail, fmtfn, fields) the records repeating the first one
+        # have around their timestamp, worked out when a record differing
+        # from the last one comes. False when the first has no timestamp.
+        self.key = None
+        self.count = 1
+        self.last = record
+        self.position = position
+        self.since = now
+
+
+class RepeatCollapser(object):
+    """Collapses the consecutive records of a file that are identical, or
+    identical apart from their timestamp, into one Repeated record, so that
+    crash loops and retry storms are formatted and sent once per run.
+
+    A run is handed out when a different record comes or once it went on
+    for `window` seconds. A run of repeats still going on when the records
+    read so far run out is held back, the file not being checkpointed past
+    it, until it goes on for `window` seconds or the file stays idle as
+    long, see `pending_since`. Records seen once are never held back.
+
+    >>> c = RepeatCollapser(window=5)
+    >>> lines = ['[22/Sep/2017 06:32:1%d] ERROR failed' % i for i in range(3)] + ['ok']
+    >>> for record, position in c.collapse(zip(lines, range(4)), now=0):
+    ...     print(record, position)
+    (Repeated(record='[22/Sep/2017 06:32:10] ERROR failed', count=3, last='[22/Sep/2017 06:32:12] ERROR failed'), 2)
+    ('ok', 3)
+
+    >>> list(c.collapse([('ok', 4), ('ok', 5)], now=1)), c.pending_since
+    ([], 1)
+    >>> list(c.collapse([], now=6)), c.pending_since
+    ([(Repeated(record='ok', count=2, last='ok'), 5)], None)
+    """
+
+    WINDOW = 5  # Longest time in seconds repeats are collapsed for
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.run = None
+
+    @property
+    def pending_since(self):
+        """When the run of repeats held back started, None when there is
+        none"""
+        run = self.run
+        return run.since if run is not None and run.count > 1 else None
+
+    @staticmethod
+    def _key(record):
+        # Demuxers hand out records as (line, fmtfn, fields)
+        line, fmtfn, fields = (
+            record if isinstance(record, tuple) else (record, None, None)
+        )
+        parts = split_timestamp(line)
+        if parts is None:
+            return False
+        return parts + (fmtfn, _fields_key(fields))
+
+    def _same(self, run, record):
+        """Whether a record is the same as the last of the run, or as the
+        first apart from the timestamp"""
+        if record == run.last:
+            return True
+        if run.key is None:
+            run.key = self._key(run.record)
+        if run.key is False:
+            return False
+
+        head, tail, fmtfn, fields = run.key
+        if isinstance(record, tuple):
+            line = record[0]
+            if record[1] is not fmtfn or _fields_key(record[2]) != fields:
+                return False
+        elif fmtfn is not None or fields is not None:
+            return False
+        else:
+            line = record
+        return has_timestamp_between(line, head, tail)
+
+    def _hand_out(self):
+        run, self.run = self.run, None
+        if run.count == 1:
+            return run.record, run.position
+        return Repeated(run.record, run.count, run.last), run.position
+
+    def collapse(self, records, now=None, hold=True):
+        """Yields the (record, position) pairs of `records`, runs of repeats
+        as one Repeated at the position of the last of them. `hold` keeps
+        a run still going on when records run out to see if it goes on.
+        Records read at once are taken as coming at the same time."""
+        t = time.time() if now is None else now
+        for record, position in records:
+            run = self.run
+            if run is not None and self._same(run, record):
+                run.count += 1
+                run.last, run.position = record, position
+                if t - run.since >= self.window:
+                    yield self._hand_out()
+                continue
+
+            if run is not None:
+                yield self._hand_out()
+            self.run = _Run(record, position, t)
+
+        run = self.run
+        if run is None:
+            return
+        if not hold or run.count == 1 or t - run.since >= self.window:
+            yield self._hand_out()
@@ -0,0 +1,113 @@
+import fnmatch
+
+
+class Conditions(object):
+    """Values of the fields of logs that match. A log matches when each
+    field given has one of its values, levels being matched regardless of
+    case and files by glob patterns. No condition matches every log.
+
+    >>> c = Conditions({'type': ['metric'], 'level': ['info', 'warning']})
+    >>> class Log(object):
+    ...     type, level, event, formatter, file = 'metric', 'INFO', 'e', 'f', '/var/log/a.log'
+    >>> c.matches(Log())
+    True
+    >>> Log.type = 'log'; c.matches(Log())
+    False
+    >>> Conditions({'file': ['/var/log/*.log']}).matches(Log())
+    True
+    """
+
+    FIELDS = ("type", "event", "level", "formatter", "file")
+
+    def __init__(self, conditions):
+        for field in conditions:
+            if field not in self.FIELDS:
+                raise ValueError(
+                    "cannot match by %r, only by %s" % (field, self.FIELDS)
+                )
+
+        # field -> values or patterns the field of a log is to match
+        self.conditions = dict((f, frozenset(v)) for f, v in conditions.iteritems())
+        if "level" in self.conditions:
+            self.conditions["level"] = frozenset(
+                v.lower() for v in self.conditions["level"]
+            )
+
+    def matches(self, log):
+        for field, values in self.conditions.iteritems():
+            value = getattr(log, field)
+            if field == "level":
+                value = value.lower()
+            if field == "file":
+                if not any(fnmatch.fnmatch(value, p) for p in values):
+                    return False
+            elif value not in values:
+                return False
+        return True
+
+
+def parse_spec(spec):
+    """Splits a spec given as <name>[=<value>[,<value>...]]:... into the
+    Conditions on log fields it names and its other options, options
+    given without a value being True
+
+    >>> conditions, options = parse_spec('topic=metrics:type=metric,gauge:drop')
+    >>> sorted(conditions.conditions), sorted(options.items())
+    (['type'], [('drop', True), ('topic', 'metrics')])
+    """
+    conditions, options = {}, {}
+    for part in spec.split(":"):
+        name, sep, value = part.partition("=")
+        if name in Conditions.FIELDS:
+            conditions[name] = value.split(",")
+        else:
+            options[name] = value if sep else True
+    return Conditions(conditions), options
+
+
+class Route(object):
+    """An nsq topic along with the Conditions of the logs that go to it
+
+    >>> r = parse_route('topic=metrics:type=metric:level=info,warning')
+    >>> r.topic, sorted(r.conditions.conditions)
+    ('metrics', ['level', 'type'])
+    """
+
+    def __init__(self, topic, conditions):
+        self.topic = topic
+        self.conditions = conditions
+
+    def matches(self, log):
+        return self.conditions.matches(log)
+
+
+def parse_route(spec):
+    """Reads a route given as topic=<topic>:<field>=<value>[,<value>...]..."""
+    conditions, options = parse_spec(spec)
+    topic = options.pop("topic", None)
+    if not topic or options:
+        raise ValueError("route %r is to name a topic and fields only" % spec)
+    return Route(topic, conditions)
+
+
+class Router(object):
+    """Picks the topic of a log, the one of the first route it matches,
+    None for logs matching no route to go to the topic of the sender
+
+    >>> router = Router([parse_route('topic=metrics:type=metric')])
+    >>> class Log(object):
+    ...     type = 'metric'
+    >>> router.topic_of(Log())
+    'metrics'
+    >>> Log.type = 'log'; router.topic_of(Log()) is None
+    True
+    """
+
+    def __init__(self, routes=()):
+        self.routes = list(routes)
+
+    def topic_of(self, log):
+        for route in self.routes:
+            if route.matches(log):
+                return route.topic
+        return None
@@ -0,0 +1,111 @@
+import hashlib
+import ujson as json
+
+from logagg.routing import parse_spec
+
+
+class Rule(object):
+    """Changes made to the formatted logs matching some Conditions, before
+    they are serialized. In the order they are made:
+
+    - `drop` leaves the logs out altogether
+    - `keep` keeps only the keys of data listed
+    - `hash` replaces the values of keys of data by a hash of them, which
+      can still be grouped by, `redact` by REDACTED
+    - `drop_raw` empties the raw line of logs that were parsed into data
+
+    >>> r = parse_rule('formatter=logagg.formatters.haproxy:keep=status,_headers,ip:hash=_headers:redact=ip:drop_raw')
+    >>> from logagg.record import LogRecord
+    >>> log = LogRecord('/var/log/haproxy.log', 'a line', 'logagg.formatters.haproxy', 'host')
+    >>> log.update({'data': {'status': 200, 'bytes': 10, '_headers': ['user@mail.net'], 'ip': '1.1.1.1'}})
+    >>> r.apply(log)
+    True
+    >>> sorted(log.data.items()), log.raw
+    ([('_headers', '14ea2b4433479c88'), ('ip', 'REDACTED'), ('status', 200)], '')
+
+    >>> parse_rule('event=healthcheck:drop').apply(log)
+    True
+    >>> log.event = 'healthcheck'; parse_rule('event=healthcheck:drop').apply(log)
+    False
+    """
+
+    REDACTED = "REDACTED"  # Value of redacted keys
+    HASH_NCHARS = 16  # Hex digits of the hash kept
+
+    def __init__(
+        self, conditions, drop=False, keep=None, hash=(), redact=(), drop_raw=False
+    ):
+        self.conditions = conditions
+        self.drop = drop
+        # Keys of data kept, None keeps them all
+        self.keep = frozenset(keep) if keep is not None else None
+        self.hash = hash
+        self.redact = redact
+        self.drop_raw = drop_raw
+
+    def _hash(self, value):
+        if not isinstance(value, basestring):
+            value = json.dumps(value)
+        elif isinstance(value, unicode):
+            value = value.encode("utf8")
+        return hashlib.sha1(value).hexdigest()[: self.HASH_NCHARS]
+
+    def apply(self, log):
+        """Changes a LogRecord when it matches, returns False when it is to
+        be left out"""
+        if not self.conditions.matches(log):
+            return True
+        if self.drop:
+            return False
+
+        data = log.data
+        if self.keep is not None:
+            for key in [k for k in data if k not in self.keep]:
+                del data[key]
+        for key in self.hash:
+            if key in data:
+                data[key] = self._hash(data[key])
+        for key in self.redact:
+            if key in data:
+                data[key] = self.REDACTED
+
+        if self.drop_raw and data and not log.error:
+            log.raw = ""
+        return True
+
+
+def parse_rule(spec):
+    """Reads a rule given as <field>=<value>[,<value>...]:...:<action>..., see Rule"""
+    conditions, options = parse_spec(spec)
+    kwargs = {}
+    for action, value in options.iteritems():
+        if action in ("drop", "drop_raw"):
+            kwargs[action] = True
+        elif action in ("keep", "hash", "redact") and value is not True:
+            kwargs[action] = value.split(",")
+        else:
+            raise ValueError("unknown action %r in rule %r" % (action, spec))
+    return Rule(conditions, **kwargs)
+
+
+class RuleSet(object):
+    """Rules applied in order to each formatted log, all those it matches
+
+    >>> rules = RuleSet([parse_rule('type=metric:drop_raw'), parse_rule('level=debug:drop')])
+    >>> from logagg.record import LogRecord
+    >>> log = LogRecord('/var/log/a.log', 'a line', 'formatter', 'host')
+    >>> log.update({'data': {'a': 1}, 'type': 'metric', 'level': 'info'})
+    >>> rules.apply(log), log.raw
+    (True, '')
+    >>> log.level = 'DEBUG'; rules.apply(log)
+    False
+    """
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+
+    def apply(self, log):
+        for rule in self.rules:
+            if not rule.apply(log):
+                return False
+        return True
@@ -0,0 +1,297 @@
+import time
+import random
+import threading
+import collections
+
+from logagg.routing import parse_spec
+
+# A record read from a file kept by sampling, along with the fraction of
+# the records like it that were kept
+Sampled = collections.namedtuple("Sampled", "record sample_rate")
+
+# Fields of logs known before their lines are parsed
+SOURCE_FIELDS = frozenset(["file", "formatter"])
+
+
+class Source(object):
+    """What is known of a record before it is parsed, matched by the
+    conditions of limits on files and formatters"""
+
+    __slots__ = ("file", "formatter")
+
+    def __init__(self, fpath, formatter):
+        self.file = fpath
+        self.formatter = formatter
+
+
+class Sample(object):
+    """Keeps each of the logs matching some Conditions with a probability
+    of `rate`
+
+    >>> random.seed(1)
+    >>> s = parse_limit('sample', 'file=/var/log/debug*.log:rate=0.1')
+    >>> rates = [s.admit(Source('/var/log/debug.log', 'f'), 0) for i in range(1000)]
+    >>> 50 < sum(1 for r in rates if r is not None) < 150, set(rates) == set([None, 0.1])
+    (True, True)
+    """
+
+    def __init__(self, conditions, rate):
+        self.conditions = conditions
+        self.rate = rate
+        self.per = None
+
+    def admit(self, log, now):
+        """Returns the fraction of the logs like `log` that are kept, None
+        when `log` is dropped"""
+        return self.rate if random.random() < self.rate else None
+
+    def summaries(self, now):
+        return []
+
+    def take_drops(self):
+        return []
+
+
+class _Bucket(object):
+    __slots__ = ("tokens", "updated_at", "window_start", "nseen", "inflow", "ndropped")
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated_at = now
+        self.window_start = now
+        # Logs seen in the current window and per second in the last one
+        self.nseen = 0
+        self.inflow = None
+        # Logs dropped since the last summary
+        self.ndropped = 0
+
+
+class RateLimit(object):
+    """Keeps no more than about `rate` logs a second of those matching
+    some Conditions, per file or per event as `per` says, allowing bursts
+    of up to `burst` logs.
+
+    Over the rate, logs are sampled with the probability that brings the
+    inflow of the last second down to the rate, so that the logs kept
+    carry the fraction they stand for. A token bucket caps what gets
+    through while a sudden flood is still being measured.
+
+    >>> random.seed(1)
+    >>> limit = parse_limit('rate-limit', 'rate=100:burst=10')
+    >>> src = Source('/var/log/app.log', 'f')
+    >>> kept = [limit.admit(src, i / 1000.0) for i in range(3000)]
+    >>> len([r for r in kept if r is not None]) < 400
+    True
+    >>> min(r for r in kept if r is not None)
+    0.1
+    >>> [(key, s['ndropped'] > 2000) for key, s in limit.summaries(3.0)]
+    [('/var/log/app.log', True)]
+    >>> limit.summaries(3.0)
+    []
+    """
+
+    WINDOW = 1.0  # Seconds over which the inflow of logs is measured
+    SUMMARY_INTERVAL = 10  # Seconds between summaries of the logs dropped
+
+    def __init__(self, conditions, rate, burst=None, per="file"):
+        if per not in ("file", "event"):
+            raise ValueError("rate limits are per file or per event, not %r" % per)
+        self.conditions = conditions
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.per = per
+
+        # file or event -> _Bucket
+        self.buckets = {}
+        self._summarized_at = None
+        self._lock = threading.Lock()
+
+    def admit(self, log, now):
+        """Returns the fraction of the logs like `log` that are kept, None
+        when `log` is dropped"""
+        key = getattr(log, self.per)
+        with self._lock:
+            b = self.buckets.get(key)
+            if b is None:
+                b = self.buckets[key] = _Bucket(self.burst, now)
+
+            if now - b.window_start >= self.WINDOW:
+                b.inflow = b.nseen / (now - b.window_start)
+                b.window_start, b.nseen = now, 0
+            b.nseen += 1
+
+            b.tokens = min(self.burst, b.tokens + (now - b.updated_at) * self.rate)
+            b.updated_at = now
+
+            rate = 1.0
+            if b.inflow is not None and b.inflow > self.rate:
+                rate = self.rate / b.inflow
+                if random.random() >= rate:
+                    b.ndropped += 1
+                    return None
+
+            if b.tokens < 1:
+                b.ndropped += 1
+                return None
+            b.tokens -= 1
+            return rate
+
+    def summaries(self, now):
+        """(file or event, stats) of those that had logs dropped, once
+        every SUMMARY_INTERVAL"""
+        with self._lock:
+            last = self._summarized_at
+            if last is not None and now - last < self.SUMMARY_INTERVAL:
+                return []
+            self._summarized_at = now
+
+            summaries = []
+            for key, b in self.buckets.items():
+                if b.ndropped:
+                    summaries.append(
+                        (
+                            key,
+                            dict(ndropped=b.ndropped, inflow=b.inflow, rate=self.rate),
+                        )
+                    )
+                    b.ndropped = 0
+                elif now - b.updated_at >= self.SUMMARY_INTERVAL:
+                    # Events seen once in a while do not keep a bucket
+                    del self.buckets[key]
+            return summaries
+
+    def take_drops(self):
+        """(file or event, number) of the logs dropped since the last call,
+        for worker processes to hand them over to the collector"""
+        with self._lock:
+            drops = []
+            for key, b in self.buckets.iteritems():
+                if b.ndropped:
+                    drops.append((key, b.ndropped))
+                    b.ndropped = 0
+            return drops
+
+    def add_drops(self, key, ndropped, now):
+        """Counts logs a worker process dropped in the next summary"""
+        with self._lock:
+            b = self.buckets.get(key)
+            if b is None:
+                b = self.buckets[key] = _Bucket(self.burst, now)
+            b.ndropped += ndropped
+
+
+def parse_limit(kind, spec):
+    """Reads a `sample` or `rate-limit` given as
+    <field>=<value>[,<value>...]:...:rate=<rate>[:burst=<n>][:per=file|event]"""
+    conditions, options = parse_spec(spec)
+    try:
+        rate = float(options.pop("rate"))
+        if kind == "sample":
+            limit = Sample(conditions, rate)
+        else:
+            burst = options.pop("burst", None)
+            limit = RateLimit(
+                conditions,
+                rate,
+                float(burst) if burst is not None else None,
+                options.pop("per", "file"),
+            )
+    except (KeyError, ValueError) as e:
+        raise ValueError("bad %s %r: %r" % (kind, spec, e))
+
+    if options:
+        raise ValueError("unknown options %s in %s %r" % (sorted(options), kind, spec))
+    return limit
+
+
+class Limits(object):
+    """Samples and rate limits, applied in order. Those that only look at
+    files and formatters are applied to records before they are parsed,
+    the others to formatted logs.
+
+    >>> limits = Limits([parse_limit('sample', 'file=/var/log/a.log:rate=0.5'),
+    ...                  parse_limit('rate-limit', 'per=event:rate=10')])
+    >>> len(limits.before_parse), len(limits.after_parse)
+    (1, 1)
+
+    Logs dropped in worker processes are handed over to be summed up
+
+    >>> worker = Limits([parse_limit('rate-limit', 'rate=1:burst=1')])
+    >>> list(worker.sample('/var/log/a.log', 'f', [('a', 1), ('b', 2), ('c', 3)]))
+    [('a', 1)]
+    >>> drops = worker.take_drops()
+    >>> drops, worker.take_drops()
+    ([(0, '/var/log/a.log', 2)], [])
+    >>> limits = Limits([parse_limit('rate-limit', 'rate=1:burst=1')])
+    >>> limits.add_drops(drops)
+    >>> [(per, key, stats['ndropped']) for per, key, stats in limits.summaries()]
+    [('file', '/var/log/a.log', 2)]
+    """
+
+    def __init__(self, limits=()):
+        self.before_parse, self.after_parse = [], []
+        for limit in limits:
+            fields = frozenset(limit.conditions.conditions)
+            if limit.per != "event" and fields <= SOURCE_FIELDS:
+                self.before_parse.append(limit)
+            else:
+                self.after_parse.append(limit)
+
+    @staticmethod
+    def _admit(limits, log, now):
+        rate = 1.0
+        for limit in limits:
+            if not limit.conditions.matches(log):
+                continue
+            r = limit.admit(log, now)
+            if r is None:
+                return None
+            rate *= r
+        return rate
+
+    def sample(self, fpath, formatter, records):
+        """The (record, position) pairs read from a file that are kept,
+        records standing for others being wrapped in Sampled"""
+        if not self.before_parse:
+            for r in records:
+                yield r
+            return
+
+        source = Source(fpath, formatter)
+        for record, position in records:
+            rate = self._admit(self.before_parse, source, time.time())
+            if rate is None:
+                continue
+            if rate < 1:
+                record = Sampled(record, rate)
+            yield record, position
+
+    def admit(self, log):
+        """The fraction of the logs like a formatted log that are kept,
+        None when it is dropped"""
+        if not self.after_parse:
+            return 1.0
+        return self._admit(self.after_parse, log, time.time())
+
+    def summaries(self):
+        now = time.time()
+        for limit in self.before_parse + self.after_parse:
+            for key, stats in limit.summaries(now):
+                yield limit.per, key, stats
+
+    def take_drops(self):
+        """(index, file or event, number) of the logs each limit dropped
+        since the last call"""
+        return [
+            (i, key, ndropped)
+            for i, limit in enumerate(self.before_parse + self.after_parse)
+            for key, ndropped in limit.take_drops()
+        ]
+
+    def add_drops(self, drops):
+        """Counts the logs a worker process dropped, as its `take_drops`
+        returned them, in the summaries"""
+        now = time.time()
+        limits = self.before_parse + self.after_parse
+        for i, key, ndropped in drops:
+            limits[i].add_drops(key, ndropped, now)
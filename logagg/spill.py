@@ -0,0 +1,229 @@
+import os
+import zlib
+import errno
+import struct
+
+from logagg import util
+
+
+class SpillLog(object):
+    """Logs that could not be sent, kept on disk until they can be.
+
+    Each `append` writes one compressed record holding logs packed as by
+    `nsqsender.pack_messages`, fsync-ed before returning so that the offsets the logs were read
+    up to can be checkpointed. Records are appended to segment files of
+    about `segment_nbytes` and read back in order. The position up to
+    which records were sent is kept in a cursor file and segments that
+    were read entirely are removed. The segments never add up to more
+    than `max_nbytes`, `append` refuses records beyond it.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> spill = SpillLog(d, max_nbytes=64, segment_nbytes=16)
+    >>> spill.append('a\\nb'), spill.append('c' * 100), spill.append('d')
+    (True, True, True)
+    >>> len(spill), len(spill.segments)
+    (3, 2)
+
+    >>> data, cursor = spill.peek()
+    >>> data
+    'a\\nb'
+    >>> spill.advance(cursor)
+    >>> spill.close()
+
+    Records not sent yet are read back after a restart
+
+    >>> spill = SpillLog(d, max_nbytes=64, segment_nbytes=16)
+    >>> len(spill)
+    2
+    >>> data, cursor = spill.peek(); spill.advance(cursor)
+    >>> data, cursor = spill.peek(); spill.advance(cursor)
+    >>> data, len(spill), spill.nbytes
+    ('d', 0, 0)
+    >>> spill.peek()
+    (None, None)
+
+    >>> spill.append(os.urandom(128))
+    False
+    >>> spill.close()
+    >>> shutil.rmtree(d)
+    """
+
+    MAX_NBYTES = 1024 ** 3  # Disk space the spilled logs may take
+    SEGMENT_NBYTES = 64 * (1024 ** 2)  # Size after which a new segment is started
+    COMPRESSION_LEVEL = 1  # zlib level, spilling has to keep up with the readers
+
+    HEADER = struct.Struct(">I")  # Length of the compressed record
+    SEGMENT_SUFFIX = ".spill"
+    CURSOR_FNAME = "cursor"
+
+    def __init__(
+        self,
+        dpath,
+        max_nbytes=MAX_NBYTES,
+        segment_nbytes=SEGMENT_NBYTES,
+        log=util.DUMMY,
+    ):
+        self.dpath = dpath
+        self.max_nbytes = max_nbytes
+        self.segment_nbytes = segment_nbytes
+        self.log = log
+
+        if not os.path.isdir(dpath):
+            os.makedirs(dpath)
+
+        # Sequence numbers of the segments on disk, oldest first
+        self.segments = sorted(
+            int(f[: -len(self.SEGMENT_SUFFIX)])
+            for f in os.listdir(dpath)
+            if f.endswith(self.SEGMENT_SUFFIX)
+        )
+        # Segment and offset of the next record to read
+        self.cursor = self._read_cursor()
+        self._drop_read_segments()
+        if not self.segments or self.segments[0] != self.cursor[0]:
+            self.cursor = (self.segments[0] if self.segments else self.cursor[0]), 0
+
+        # Number of records and bytes not read yet
+        self.nrecords = 0
+        self.nbytes = 0
+        for seq in self.segments:
+            self._scan(seq)
+
+        # Segment being read and the one being written
+        self._rfh, self._rseq = None, None
+        self._wfh = None
+        if self.nrecords:
+            self.log.info(
+                "loaded_spilled_logs", nrecords=self.nrecords, nbytes=self.nbytes
+            )
+
+    def __len__(self):
+        return self.nrecords
+
+    def _fpath(self, seq):
+        return os.path.join(self.dpath, "%016d%s" % (seq, self.SEGMENT_SUFFIX))
+
+    def _read_cursor(self):
+        try:
+            with open(os.path.join(self.dpath, self.CURSOR_FNAME)) as f:
+                seq, offset = f.read().split()
+            return int(seq), int(offset)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            self.log.warning("ignoring_corrupt_spill_cursor", dpath=self.dpath)
+
+        return (self.segments[0] if self.segments else 0), 0
+
+    def _write_cursor(self):
+        fpath = os.path.join(self.dpath, self.CURSOR_FNAME)
+        with open(fpath + ".tmp", "w") as f:
+            f.write("%d %d" % self.cursor)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(fpath + ".tmp", fpath)
+
+    def _drop_read_segments(self):
+        while self.segments and self.segments[0] < self.cursor[0]:
+            os.remove(self._fpath(self.segments.pop(0)))
+
+    def _scan(self, seq):
+        """Counts the unread records of a segment, dropping whatever a
+        crash left half written at its end"""
+        fpath = self._fpath(seq)
+        offset = self.cursor[1] if seq == self.cursor[0] else 0
+        hsize = self.HEADER.size
+
+        with open(fpath, "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(hsize)
+                if len(header) < hsize:
+                    break
+                (n,) = self.HEADER.unpack(header)
+                if len(f.read(n)) < n:
+                    break
+                offset += hsize + n
+                self.nrecords += 1
+                self.nbytes += hsize + n
+
+        if len(header) and seq == self.segments[-1]:
+            self.log.warning("dropping_torn_spill_record", fpath=fpath)
+            with open(fpath, "r+b") as f:
+                f.truncate(offset)
+
+    def append(self, data):
+        """Writes `data` to disk. Returns False, leaving it out, when the
+        spill is full."""
+        record = zlib.compress(data, self.COMPRESSION_LEVEL)
+        nbytes = self.HEADER.size + len(record)
+        if self.nbytes + nbytes > self.max_nbytes:
+            return False
+
+        if self._wfh is None or self._wfh.tell() >= self.segment_nbytes:
+            self._start_segment()
+
+        self._wfh.write(self.HEADER.pack(len(record)) + record)
+        self._wfh.flush()
+        os.fsync(self._wfh.fileno())
+
+        self.nrecords += 1
+        self.nbytes += nbytes
+        return True
+
+    def _start_segment(self):
+        if self._wfh is not None:
+            self._wfh.close()
+
+        seq = self.segments[-1] + 1 if self.segments else self.cursor[0]
+        self.segments.append(seq)
+        self._wfh = open(self._fpath(seq), "ab")
+
+    def peek(self):
+        """Returns the oldest record not read yet along with the cursor to
+        `advance` to once it is sent, (None, None) when there is none"""
+        if not self.nrecords:
+            return None, None
+
+        seq, offset = self.cursor
+        while True:
+            if self._rseq != seq:
+                self._close_reader()
+                self._rfh, self._rseq = open(self._fpath(seq), "rb"), seq
+            self._rfh.seek(offset)
+            header = self._rfh.read(self.HEADER.size)
+            if header:
+                break
+            # End of this segment, records continue in the next one
+            seq, offset = self.segments[self.segments.index(seq) + 1], 0
+
+        (n,) = self.HEADER.unpack(header)
+        data = zlib.decompress(self._rfh.read(n))
+        return data, (seq, offset + self.HEADER.size + n)
+
+    def _close_reader(self):
+        if self._rfh is not None:
+            self._rfh.close()
+        self._rfh, self._rseq = None, None
+
+    def advance(self, cursor):
+        """Marks the record `peek` returned along with `cursor` as sent"""
+        if cursor[0] == self.cursor[0]:
+            nbytes = cursor[1] - self.cursor[1]
+        else:
+            # The record is the first one of the next segment
+            nbytes = cursor[1]
+
+        self.cursor = cursor
+        self.nrecords -= 1
+        self.nbytes -= nbytes
+        self._write_cursor()
+        self._drop_read_segments()
+
+    def close(self):
+        self._close_reader()
+        if self._wfh is not None:
+            self._wfh.close()
+            self._wfh = None
@@ -0,0 +1,404 @@
+import os
+import re
+import glob
+import time
+import errno
+import fnmatch
+import struct
+import select
+import ctypes
+import ctypes.util
+import threading
+
+from logagg import util
+
+
+class Inotify(object):
+    """Minimal ctypes binding to the linux inotify API.
+
+    >>> ino = Inotify()
+    >>> ino.read_events(timeout=0)
+    []
+    >>> ino.close()
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+    READ_SIZE = 64 * 1024
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.fd = fd
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        """Waits at most `timeout` seconds and returns a list of
+        (wd, mask, name) tuples for the events that arrived"""
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r:
+            return []
+
+        try:
+            buf = os.read(self.fd, self.READ_SIZE)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+
+        events = []
+        pos, hsize = 0, self.EVENT_HEADER.size
+        while pos + hsize <= len(buf):
+            wd, mask, _, nlen = self.EVENT_HEADER.unpack_from(buf, pos)
+            pos += hsize
+            name = buf[pos : pos + nlen].rstrip("\0")
+            pos += nlen
+            events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FilePattern(object):
+    """A glob pattern compiled for matching paths one component at a time,
+    with glob's semantics: wildcards do not match "/" and names starting
+    with a dot are only matched by patterns starting with one.
+
+    `prefix` is the directory up to the first component with a wildcard,
+    files matching the pattern can only show up below it.
+
+    >>> p = FilePattern('/var/log/*/app-*.log')
+    >>> p.prefix, p.depth
+    ('/var/log', 2)
+    >>> [p.match(f) for f in ('/var/log/web/app-1.log',
+    ...     '/var/log/web/old/app-1.log', '/var/log/web/db.log',
+    ...     '/var/log/.web/app-1.log', '/var/lib/web/app-1.log')]
+    [True, False, False, False, False]
+
+    Directories that may come to hold matching files
+
+    >>> [p.match_dir(d) for d in ('/var/log', '/var/log/web', '/var/log/web/old')]
+    [True, True, False]
+
+    >>> p = FilePattern('/var/log/syslog')
+    >>> p.prefix, p.match('/var/log/syslog'), p.match('/var/log/syslog.1')
+    ('/var/log', True, False)
+    """
+
+    MAGIC = re.compile("[*?[]")
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+        parts = pattern.split(os.sep)
+        n = 0
+        while n < len(parts) - 1 and not self.MAGIC.search(parts[n]):
+            n += 1
+        self.prefix = os.sep.join(parts[:n]) or os.sep
+        self._start = self.prefix.rstrip(os.sep) + os.sep
+
+        # components below prefix, the last one matches file names
+        self._globs = parts[n:]
+        self._parts = [
+            (re.compile(fnmatch.translate(p)), p.startswith(".")) for p in self._globs
+        ]
+        self.depth = len(self._parts)
+
+    def _match_parts(self, path):
+        if not path.startswith(self._start):
+            return None
+
+        names = path[len(self._start) :].split(os.sep)
+        if len(names) > self.depth:
+            return None
+        for name, (regex, dotted) in zip(names, self._parts):
+            if name.startswith(".") and not dotted:
+                return None
+            if not regex.match(name):
+                return None
+        return names
+
+    def match(self, fpath):
+        names = self._match_parts(fpath)
+        return names is not None and len(names) == self.depth
+
+    def match_dir(self, dpath):
+        if dpath == self.prefix:
+            return True
+        names = self._match_parts(dpath)
+        return names is not None and len(names) < self.depth
+
+    def glob_dirs(self):
+        """Returns the existing directories that may hold matching files
+        or the directories leading to them, prefix being always one"""
+        dpaths = [self.prefix]
+        for n in range(1, self.depth):
+            pattern = self._start + os.sep.join(self._globs[:n])
+            dpaths.extend(d for d in glob.glob(pattern) if os.path.isdir(d))
+        return dpaths
+
+    def glob_files(self):
+        return [f for f in glob.glob(self.pattern) if os.path.isfile(f)]
+
+
+def _file_signature(fpath):
+    try:
+        st = os.stat(fpath)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+
+class Tailer(object):
+    """Tracks any number of files from a single thread and reports the
+    ones that changed.
+
+    Files are watched with inotify when available; files that could not
+    be watched (and every file, when inotify is unavailable) are stat-ed
+    every `poll_interval` seconds instead. Paths created in directories
+    added with `add_dir` are reported too, whether tracked or not.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> fpath = os.path.join(d, 'app.log')
+    >>> open(fpath, 'w').close()
+
+    >>> for use_inotify in (True, False):
+    ...     t = Tailer(poll_interval=0.01, use_inotify=use_inotify)
+    ...     t.add(fpath)
+    ...     added = t.wait(timeout=0)
+    ...     with open(fpath, 'a') as f: f.write('line\\n')
+    ...     changed = t.wait(timeout=1)
+    ...     idle = t.wait(timeout=0.05)
+    ...     [list(added), list(changed), list(idle)] == [[fpath], [fpath], []]
+    ...     t.close()
+    True
+    True
+
+    >>> t = Tailer()
+    >>> t.add_dir(d)
+    True
+    >>> open(os.path.join(d, 'new.log'), 'w').close()
+    >>> [os.path.basename(f) for f in t.wait(timeout=1)]
+    ['new.log']
+    >>> t.add_dir(os.path.join(d, 'missing'))
+    False
+    >>> t.close()
+
+    >>> import shutil; shutil.rmtree(d)
+    """
+
+    POLL_INTERVAL = 0.25  # How often un-watched files are stat-ed for changes
+    RESCAN_INTERVAL = 5  # How often watched files are stat-ed to catch rotation
+
+    WATCH_MASK = (
+        Inotify.IN_MODIFY
+        | Inotify.IN_ATTRIB
+        | Inotify.IN_CLOSE_WRITE
+        | Inotify.IN_MOVE_SELF
+        | Inotify.IN_DELETE_SELF
+    )
+    DIR_WATCH_MASK = (
+        Inotify.IN_CREATE
+        | Inotify.IN_MOVED_TO
+        | Inotify.IN_ONLYDIR
+        | Inotify.IN_MOVE_SELF
+        | Inotify.IN_DELETE_SELF
+    )
+    GONE_MASK = Inotify.IN_MOVE_SELF | Inotify.IN_DELETE_SELF | Inotify.IN_IGNORED
+
+    def __init__(self, poll_interval=POLL_INTERVAL, use_inotify=True, log=util.DUMMY):
+        self.poll_interval = poll_interval
+        self.log = log
+
+        self._lock = threading.Lock()
+        # fpath -> last seen (inode, size, mtime)
+        self.files = {}
+        # files that were added but not yet reported
+        self._new_files = set()
+        # inotify watch descriptor <-> fpath
+        self._wd_fpaths = {}
+        self._fpath_wds = {}
+        # watched directory <-> inotify watch descriptor
+        self.dirs = {}
+        self._wd_dirs = {}
+        self._last_poll_ts = 0
+        self._last_rescan_ts = time.time()
+
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError, TypeError):
+                self.log.warning("inotify_unavailable_falling_back_to_polling")
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, fpath):
+        return fpath in self.files
+
+    def add(self, fpath):
+        with self._lock:
+            if fpath in self.files:
+                return
+            self.files[fpath] = _file_signature(fpath)
+            self._new_files.add(fpath)
+            self._watch(fpath)
+
+    def remove(self, fpath):
+        with self._lock:
+            self.files.pop(fpath, None)
+            self._new_files.discard(fpath)
+            self._unwatch(fpath)
+
+    def add_dir(self, dpath):
+        """Watches directory `dpath` for paths created in it. Returns
+        whether it is watched, which it can not be without inotify."""
+        with self._lock:
+            if dpath in self.dirs:
+                return True
+            if not self.inotify:
+                return False
+
+            try:
+                wd = self.inotify.add_watch(dpath, self.DIR_WATCH_MASK)
+            except OSError as e:
+                self.log.debug("inotify_dir_watch_failed", dpath=dpath, errno=e.errno)
+                return False
+
+            self.dirs[dpath] = wd
+            self._wd_dirs[wd] = dpath
+            return True
+
+    def _watch(self, fpath):
+        if not self.inotify or fpath in self._fpath_wds:
+            return
+
+        try:
+            wd = self.inotify.add_watch(fpath, self.WATCH_MASK)
+        except OSError as e:
+            # Missing file or watch limit reached, this file gets polled
+            self.log.debug("inotify_watch_failed", fpath=fpath, errno=e.errno)
+            return
+
+        self._wd_fpaths[wd] = fpath
+        self._fpath_wds[fpath] = wd
+
+    def _unwatch(self, fpath, rm_watch=True):
+        wd = self._fpath_wds.pop(fpath, None)
+        if wd is None:
+            return
+        self._wd_fpaths.pop(wd, None)
+        if rm_watch:
+            self.inotify.rm_watch(wd)
+
+    def _stat_changed(self, fpaths, changed):
+        for fpath in fpaths:
+            sig, old_sig = _file_signature(fpath), self.files.get(fpath)
+            if sig != old_sig:
+                self.files[fpath] = sig
+                changed.add(fpath)
+                # a new inode at the same path means the file was rotated
+                if not sig or not old_sig or sig[0] != old_sig[0]:
+                    self._unwatch(fpath)
+            if sig:
+                self._watch(fpath)
+
+    def _handle_events(self, events, changed, created):
+        for wd, mask, name in events:
+            dpath = self._wd_dirs.get(wd)
+            if dpath is not None:
+                if mask & self.GONE_MASK:
+                    del self._wd_dirs[wd]
+                    if self.dirs.get(dpath) == wd:
+                        del self.dirs[dpath]
+                elif name:
+                    created.add(os.path.join(dpath, name))
+                continue
+
+            fpath = self._wd_fpaths.get(wd)
+            if fpath is None:
+                continue
+
+            changed.add(fpath)
+            if mask & self.GONE_MASK:
+                # The watched inode no longer lives at fpath, fall back to
+                # polling for this path until a new file shows up there
+                self._unwatch(fpath, rm_watch=not mask & Inotify.IN_IGNORED)
+
+    def wait(self, timeout=None):
+        """Blocks for at most `timeout` seconds and returns the set of
+        tracked file paths that have changed since the last call, along
+        with the paths created in watched directories"""
+        with self._lock:
+            changed = self._new_files
+            self._new_files = set()
+            unwatched = len(self.files) - len(self._fpath_wds)
+
+        if timeout is None:
+            timeout = self.poll_interval
+        if changed:
+            timeout = 0
+        elif unwatched:
+            timeout = min(timeout, self.poll_interval)
+
+        if self.inotify:
+            events = self.inotify.read_events(timeout)
+        else:
+            events = []
+            time.sleep(timeout)
+
+        now = time.time()
+        created = set()
+        with self._lock:
+            self._handle_events(events, changed, created)
+
+            if now - self._last_rescan_ts >= self.RESCAN_INTERVAL:
+                self._last_rescan_ts = now
+                self._stat_changed(list(self.files), changed)
+            elif now - self._last_poll_ts >= self.poll_interval:
+                self._last_poll_ts = now
+                unwatched = [f for f in self.files if f not in self._fpath_wds]
+                self._stat_changed(unwatched, changed)
+
+            # files removed while we were waiting
+            changed.intersection_update(self.files)
+
+        return changed | created
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
@@ -0,0 +1,326 @@
+import re
+import hashlib
+import threading
+import collections
+import ujson as json
+
+from logagg.routing import parse_spec
+from logagg.record import LogRecord
+
+# A log whose message was replaced by a template: the serialized log, the
+# id of the template and the log defining the template as a dict, None
+# once the miner handed it out
+Templated = collections.namedtuple("Templated", "log template_id definition")
+
+WILDCARD = "<*>"  # Stands for the parameters in the text of templates
+_has_digit = re.compile(r"\d").search
+
+
+class Template(object):
+    """Tokens of the messages of a cluster, None where they differ"""
+
+    __slots__ = ("field", "tokens", "id", "announced")
+
+    def __init__(self, field, tokens):
+        self.field = field
+        self.tokens = list(tokens)
+        self._changed()
+
+    def _changed(self):
+        key = json.dumps([self.field, self.tokens])
+        if isinstance(key, unicode):
+            key = key.encode("utf8")
+        self.id = hashlib.sha1(key).hexdigest()[:16]
+        # Whether the definition was handed out since the template changed
+        self.announced = False
+
+    def similarity(self, tokens):
+        """Fraction of the tokens equal to those of the template"""
+        same = 0
+        for t, token in zip(self.tokens, tokens):
+            if t == token:
+                same += 1
+        return float(same) / len(tokens)
+
+    def merge(self, tokens):
+        changed = False
+        for i, (t, token) in enumerate(zip(self.tokens, tokens)):
+            if t is not None and t != token:
+                self.tokens[i] = None
+                changed = True
+        if changed:
+            self._changed()
+
+    def params(self, tokens):
+        return [token for t, token in zip(self.tokens, tokens) if t is None]
+
+    def text(self):
+        return " ".join(WILDCARD if t is None else t for t in self.tokens)
+
+    def definition(self):
+        return dict(
+            template_id=self.id,
+            field=self.field,
+            template=self.text(),
+            # A copy, merges change the tokens of the template in place
+            tokens=list(self.tokens),
+        )
+
+
+class TemplateMiner(object):
+    """Clusters the messages of logs matching some Conditions into
+    templates online, in the way of Drain: messages are sorted by their
+    number of tokens and first tokens down a tree of fixed depth, then
+    joined to the most similar template of the leaf they reach, tokens
+    that differ becoming parameters. Messages are split on single spaces,
+    so that they are rebuilt exactly from their template and parameters.
+
+    `field` names the key of data holding the message, or `event`.
+
+    >>> m = parse_miner('formatter=logagg.formatters.mongodb')
+    >>> t, params = m.mine('Connection accepted from 10.0.0.1:4312 #1')
+    >>> t.text(), params
+    ('Connection accepted from 10.0.0.1:4312 #1', [])
+    >>> t, params = m.mine('Connection accepted from 10.0.0.7:5120 #2')
+    >>> t.text(), params
+    ('Connection accepted from <*> <*>', ['10.0.0.7:5120', '#2'])
+    >>> m.mine('Connection ended from 10.0.0.7:5120 #2')[0] is t
+    False
+    >>> m.ntemplates
+    2
+    """
+
+    DEPTH = 2  # Leading tokens messages are sorted by before being compared
+    SIMILARITY = 0.5  # Least fraction of equal tokens to join a template
+    MAX_CHILDREN = (
+        100
+    )  # Tokens a node of the tree tells apart, others going to WILDCARD
+    MAX_TEMPLATES = 5000  # Templates kept, messages of new ones being left as they are
+    MAX_TOKENS = 100  # Longer messages are left as they are
+
+    def __init__(self, conditions, field="message", similarity=SIMILARITY):
+        self.conditions = conditions
+        self.field = field
+        self.similarity = similarity
+        # number of tokens -> tree of nodes mapping tokens to nodes, the
+        # nodes at DEPTH holding their templates under None
+        self.root = {}
+        self.ntemplates = 0
+
+    def _leaf(self, tokens):
+        node = self.root.setdefault(len(tokens), {})
+        for token in tokens[: self.DEPTH]:
+            if _has_digit(token):
+                token = WILDCARD
+            child = node.get(token)
+            if child is None:
+                if len(node) >= self.MAX_CHILDREN:
+                    token = WILDCARD
+                    child = node.get(token)
+                if child is None:
+                    child = node[token] = {}
+            node = child
+        return node.setdefault(None, [])
+
+    def mine(self, message):
+        """The template of a message and its parameters, (None, None) for
+        messages left as they are"""
+        tokens = message.split(" ")
+        if len(tokens) > self.MAX_TOKENS:
+            return None, None
+
+        templates = self._leaf(tokens)
+        best, best_similarity = None, -1
+        for t in templates:
+            s = t.similarity(tokens)
+            if s > best_similarity:
+                best, best_similarity = t, s
+
+        if best is None or best_similarity < self.similarity:
+            if self.ntemplates >= self.MAX_TEMPLATES:
+                return None, None
+            best = Template(self.field, tokens)
+            templates.append(best)
+            self.ntemplates += 1
+        else:
+            best.merge(tokens)
+        return best, best.params(tokens)
+
+    def message_of(self, log):
+        if self.field == "event":
+            return log.event
+        return log.data.get(self.field)
+
+
+def parse_miner(spec):
+    """Reads a template miner given as <field>=<value>[,<value>...]:...
+    [:field=<key of data>|event][:similarity=<fraction>]"""
+    conditions, options = parse_spec(spec)
+    kwargs = {}
+    try:
+        if "field" in options:
+            kwargs["field"] = options.pop("field")
+        if "similarity" in options:
+            kwargs["similarity"] = float(options.pop("similarity"))
+    except ValueError as e:
+        raise ValueError("bad template miner %r: %r" % (spec, e))
+
+    if options:
+        raise ValueError(
+            "unknown options %s in template miner %r" % (sorted(options), spec)
+        )
+    return TemplateMiner(conditions, **kwargs)
+
+
+class TemplateMiners(object):
+    """Miners a formatted log is matched against, the first it matches
+    replacing its message by the template id and parameters put in
+    `data._template`
+
+    >>> miners = TemplateMiners([parse_miner('formatter=logagg.formatters.basescript:field=event')])
+    >>> log = LogRecord('/var/log/a.log', 'a line', 'logagg.formatters.basescript', 'host')
+    >>> log.update({'event': 'user 42 logged in', 'data': {}}); log.finalize()
+    >>> tid, definition = miners.encode(log)
+    >>> log.data['_template'] == [tid], definition['type'], definition['data']['template']
+    (True, 'template', 'user 42 logged in')
+
+    Templates change as messages join them, each change being handed out
+
+    >>> log.update({'event': 'user 7 logged in', 'data': {}})
+    >>> tid, definition = miners.encode(log)
+    >>> log.data['_template'][1:], definition['data']['template']
+    (['7'], 'user <*> logged in')
+    >>> log.update({'event': 'user 9 logged in', 'data': {}})
+    >>> miners.encode(log)[1] is None
+    True
+    """
+
+    def __init__(self, miners=()):
+        self.miners = list(miners)
+        # Templates change as messages join them, so a message is mined and
+        # its parameters taken out by one reader thread at a time
+        self._lock = threading.Lock()
+
+    def encode(self, log):
+        """Replaces the message of a LogRecord by its template. Returns the
+        template id along with the log defining it when it is new or
+        changed, None for logs left as they are."""
+        if log.error:
+            return None
+
+        for miner in self.miners:
+            if not miner.conditions.matches(log):
+                continue
+            message = miner.message_of(log)
+            if not isinstance(message, basestring):
+                return None
+
+            with self._lock:
+                template, params = miner.mine(message)
+                if template is None:
+                    return None
+                tid, definition = template.id, None
+                if not template.announced:
+                    template.announced = True
+                    definition = self.definition_log(log, template)
+
+            # The template id goes first, followed by the parameters
+            if miner.field == "event":
+                log.event = ""
+            else:
+                del log.data[miner.field]
+            log.data["_template"] = [tid] + params
+            return tid, definition
+        return None
+
+    @staticmethod
+    def definition_log(log, template):
+        d = LogRecord(log.file, "", log.formatter, log.host)
+        d.update(
+            dict(
+                type="template",
+                event="log_template",
+                level="info",
+                data=template.definition(),
+            )
+        )
+        d.finalize()
+        return d.to_dict()
+
+
+class TemplateCache(object):
+    """Templates learnt from the logs defining them, rebuilding the
+    messages of the logs that were shipped as template ids and parameters
+
+    >>> miners = TemplateMiners([parse_miner('type=log')])
+    >>> log = LogRecord('/var/log/a.log', 'a line', 'f', 'host')
+    >>> log.update({'data': {'message': 'took 12 ms', 'a': 1}}); log.finalize()
+    >>> _, definition = miners.encode(log)
+    >>> cache = TemplateCache()
+    >>> encoded = log.to_dict()
+    >>> cache.expand(encoded)
+    False
+    >>> cache.learn(definition)
+    >>> cache.expand(encoded)
+    True
+    >>> sorted(encoded['data'].items())
+    [('a', 1), ('message', 'took 12 ms'), ('template_id', '6f432ec7725755bb')]
+
+    Definitions handed out stay as they were when the template changes
+
+    >>> log.update({'data': {'message': 'took 12 ms on a'}})
+    >>> _, definition = miners.encode(log)
+    >>> encoded = log.to_dict()
+    >>> log.update({'data': {'message': 'took 15 ms on b'}})
+    >>> _ = miners.encode(log)
+    >>> cache.learn(definition)
+    >>> cache.expand(encoded), encoded['data']['message']
+    (True, 'took 12 ms on a')
+
+    Logs whose parameters do not fill their template are left as they are
+
+    >>> encoded['data'] = {'_template': ['6f432ec7725755bb', '12', 'extra']}
+    >>> cache.expand(encoded), sorted(encoded['data'])
+    (False, ['_template'])
+    """
+
+    MAX_TEMPLATES = 100000  # Templates kept before the cache is emptied
+
+    def __init__(self):
+        # template id -> definition
+        self.templates = {}
+
+    def learn(self, log):
+        if log.get("type") != "template":
+            return
+        if len(self.templates) >= self.MAX_TEMPLATES:
+            self.templates.clear()
+        definition = log["data"]
+        self.templates[definition["template_id"]] = definition
+
+    def expand(self, log):
+        """Puts the message of a log back in place of its template id and
+        parameters, keeping the id in `data.template_id`. Returns False
+        when the template is not known yet or the parameters do not fill
+        it."""
+        data = log.get("data")
+        if not isinstance(data, dict) or "_template" not in data:
+            return True
+        tid = data["_template"][0]
+        definition = self.templates.get(tid)
+        if definition is None:
+            return False
+
+        tokens, params = definition["tokens"], data["_template"][1:]
+        if len(params) != tokens.count(None):
+            return False
+
+        params = iter(params)
+        message = " ".join(next(params) if t is None else t for t in tokens)
+        del data["_template"]
+        data["template_id"] = tid
+        if definition["field"] == "event":
+            log["event"] = message
+        else:
+            data[definition["field"]] = message
+        return True
@@ -108,6 +108,7 @@ def is_number(x):
     return isinstance(x, numbers.Number)
 
 
+import re
 from re import match
 
 
@@ -135,3 +136,40 @@ def ispartial(x):
         return False
     else:
         return False
+
+
+# Splits a chunk of lines into records at every newline that is not
+# followed by a partial line
+ispartial.boundary = re.compile(r"\n(?![ \t])")
+
+
+def split_records(data, ispartial):
+    """
+    Splits `data`, a chunk of newline separated lines, into records by
+    joining every partial line to the line before it. Uses the `boundary`
+    regex of the `ispartial` predicate to split the whole chunk at once
+    and falls back to calling the predicate on each line otherwise.
+
+    >>> split_records('a\\n b\\n\\tc\\nd\\n\\ne', ispartial)
+    ['a\\n b\\n\\tc', 'd', '', 'e']
+    >>> split_records('a\\n b\\nc', lambda l: l.startswith(' '))
+    ['a\\n b', 'c']
+
+    The first record may itself be a partial line, continuing the last
+    record of the previous chunk
+
+    >>> split_records(' x\\ny', ispartial)
+    [' x', 'y']
+    """
+    boundary = getattr(ispartial, "boundary", None)
+    if boundary is not None:
+        return boundary.split(data)
+
+    records = []
+    for line in data.split("\n"):
+        if records and ispartial(line):
+            records[-1].append(line)
+        else:
+            records.append([line])
+
+    return ["\n".join(r) for r in records]
@@ -10,9 +10,6 @@ setup(
     author_email="contact@deepcompute.com",
     url="https://github.com/deep-compute/logagg",
     license="MIT",
-    dependency_links=[
-        "https://github.com/deep-compute/pygtail/tarball/master/#egg=pygtail-0.6.1"
-    ],
     install_requires=[
         "basescript==0.2.0",
         "pymongo==3.6.0",
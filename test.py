@@ -7,6 +7,24 @@ from logagg import formatters
 from logagg import util
 from logagg import collector
 from logagg import forwarders
+from logagg import tailer
+from logagg import reader
+from logagg import backfill
+from logagg import checkpoint
+from logagg import dockerlog
+from logagg import record
+from logagg import batchqueue
+from logagg import spill
+from logagg import nsqsender
+from logagg import nsqtcp
+from logagg import nsqpool
+from logagg import routing
+from logagg import rules
+from logagg import sampling
+from logagg import aggregate
+from logagg import templates
+from logagg import repeats
+from logagg import fakensqd
 
 
 def suite_maker():
@@ -18,4 +36,40 @@ def suite_maker():
     suite.addTests(doctest.DocTestSuite(forwarders))
 
     suite.addTests(doctest.DocTestSuite(util))
+
+    suite.addTests(doctest.DocTestSuite(tailer))
+
+    suite.addTests(doctest.DocTestSuite(reader))
+
+    suite.addTests(doctest.DocTestSuite(backfill))
+
+    suite.addTests(doctest.DocTestSuite(checkpoint))
+
+    suite.addTests(doctest.DocTestSuite(dockerlog))
+
+    suite.addTests(doctest.DocTestSuite(record))
+
+    suite.addTests(doctest.DocTestSuite(batchqueue))
+
+    suite.addTests(doctest.DocTestSuite(spill))
+
+    suite.addTests(doctest.DocTestSuite(nsqsender))
+
+    suite.addTests(doctest.DocTestSuite(nsqtcp))
+
+    suite.addTests(doctest.DocTestSuite(nsqpool))
+
+    suite.addTests(doctest.DocTestSuite(routing))
+
+    suite.addTests(doctest.DocTestSuite(rules))
+
+    suite.addTests(doctest.DocTestSuite(sampling))
+
+    suite.addTests(doctest.DocTestSuite(aggregate))
+
+    suite.addTests(doctest.DocTestSuite(templates))
+
+    suite.addTests(doctest.DocTestSuite(repeats))
+
+    suite.addTests(doctest.DocTestSuite(fakensqd))
     return suite